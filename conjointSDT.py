@@ -23,12 +23,27 @@
 import sys, os, re
 import csv
 import pickle
-import copy
+import json
+import math
+import random
+import multiprocessing
+import asyncio
+import http
+import time
+import urllib.parse
+import array
+import mmap
+import argparse
+import hashlib
+import collections
+import itertools
+import bisect
 from fractions import Fraction
 # Import TK
 from tkinter import *
 from tkinter import messagebox
 from tkinter import filedialog
+from tkinter import ttk
 
 
 ### Map function replacement for Python 3.0 - Thanks to Katarina Jensen
@@ -44,6 +59,10 @@ def map(func, *iterables):
 default_options = {}
 default_options["listbox_width"] = 30
 default_options["listbox_height"] = 30
+default_options["history_limit"] = 1000
+default_options["cache_dir"] = os.path.join(os.path.expanduser("~"), ".conjointSDT", "cache")
+default_options["cache_max_bytes"] = 64*2**20
+default_options["use_cache"] = 1
 
 # License Environmental Variables
 version = "3.0"
@@ -52,7 +71,251 @@ copyright = "Copyright (c) 2022 Anton Strezhnev, Jens Hainmueller, Daniel J. Hop
 GPL = "This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.\n\nThis program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.\n\nYou should have received a copy of the GNU General Public License along with this program. If not, see <http://www.gnu.org/licenses/>."
 companion = "This software program was designed as a companion to"
 citation = 'Hainmueller, Jens, Daniel J. Hopkins, and Teppei Yamamoto. "Causal inference in conjoint analysis: Understanding multidimensional choices via stated preference experiments." Political Analysis 22, no. 1 (2014): 1-30.'
-        
+
+# virtualListbox draws only the rows of a list that are currently in view
+# Row text is pulled on demand from the model, so redrawing costs the same for 10 rows or 100,000
+# Rows can be narrowed down with set_filter(); selections and callbacks always use indices into the full list
+# arguments: listbox - TK Listbox used as the viewport, vscroll - its vertical Scrollbar,
+#            row_count - function returning the number of rows, row_text - function returning the text of row i
+class virtualListbox:
+
+    def __init__(self, listbox, vscroll, row_count, row_text):
+        self.listbox = listbox
+        self.vscroll = vscroll
+        self.row_count = row_count
+        self.row_text = row_text
+        self.height = int(listbox.cget("height"))
+        self.top = 0
+        self.selected = None
+        self.select_callback = None
+        self.filtered = None
+        self.positions = None
+
+        self.listbox.config(exportselection=0, yscrollcommand="")
+        self.vscroll.config(command=self.yview)
+        self.listbox.bind('<<ListboxSelect>>', self.on_select)
+        self.listbox.bind('<MouseWheel>', self.on_wheel)
+        self.listbox.bind('<Button-4>', self.on_wheel)
+        self.listbox.bind('<Button-5>', self.on_wheel)
+        self.listbox.bind('<Up>', lambda event: self.move_selection(-1))
+        self.listbox.bind('<Down>', lambda event: self.move_selection(1))
+
+    # Bind a function to be called (with the TK event) when the user selects a row
+    def bind_select(self, callback):
+        self.select_callback = callback
+
+    # Same return format as Listbox.curselection(), but indices refer to the full list
+    def curselection(self):
+        if self.selected == None or self.selected >= self.row_count():
+            return ()
+        return (self.selected,)
+
+    # -- Mapping between rows in view and rows of the full list --
+    def view_count(self):
+        if self.filtered != None:
+            return len(self.filtered)
+        return self.row_count()
+
+    def model_index(self, view_index):
+        if self.filtered != None:
+            return self.filtered[view_index]
+        return view_index
+
+    def view_index(self, model_index):
+        if self.filtered != None:
+            return self.positions.get(model_index)
+        return model_index
+
+    # Show only the rows whose (full list) indices are given, or every row if indices is None
+    def set_filter(self, indices):
+        self.filtered = indices
+        if indices != None:
+            self.positions = {m: v for v, m in enumerate(indices)}
+        else:
+            self.positions = None
+        self.top = 0
+        if self.selected != None and self.view_index(self.selected) != None:
+            self.see(self.selected)
+        self.render()
+
+    def select(self, index):
+        self.selected = index
+        if index != None:
+            self.see(index)
+        self.render()
+
+    # Scroll so that row index (of the full list) is visible
+    def see(self, index):
+        view = self.view_index(index)
+        if view == None:
+            return
+        if view < self.top:
+            self.top = view
+        elif view >= self.top + self.height:
+            self.top = view - self.height + 1
+        self.clamp_top()
+
+    def clamp_top(self):
+        self.top = max(0, min(self.top, self.view_count() - self.height))
+
+    # Redraw the visible window
+    def render(self):
+        self.clamp_top()
+        count = self.view_count()
+        bottom = min(count, self.top + self.height)
+        self.listbox.delete(0, END)
+        for i in range(self.top, bottom):
+            self.listbox.insert(END, self.row_text(self.model_index(i)))
+        if self.selected != None:
+            view = self.view_index(self.selected)
+            if view != None and self.top <= view < bottom:
+                self.listbox.selection_set(view - self.top)
+        if count > 0:
+            self.vscroll.set(self.top/count, bottom/count)
+        else:
+            self.vscroll.set(0, 1)
+
+    # Redraw a single row (index into the full list), if it is visible
+    def render_row(self, index):
+        view = self.view_index(index)
+        if view != None and self.top <= view < self.top + self.height and index < self.row_count():
+            self.listbox.delete(view - self.top)
+            self.listbox.insert(view - self.top, self.row_text(index))
+            if self.selected == index:
+                self.listbox.selection_set(view - self.top)
+
+    # Called by the model notification layer: action is "insert", "delete", "update" or "reset"
+    def model_changed(self, action, index=None):
+        if action == "update":
+            self.render_row(index)
+            return
+        if action == "insert" and self.selected != None and index <= self.selected:
+            self.selected = self.selected + 1
+        elif action == "delete" and self.selected != None:
+            if index == self.selected:
+                self.selected = None
+            elif index < self.selected:
+                self.selected = self.selected - 1
+        elif action == "reset":
+            self.selected = None
+            self.top = 0
+            self.filtered = None
+            self.positions = None
+        # Keep a filter pointing at the same rows until its owner re-applies it
+        if self.filtered != None and action in ("insert", "delete"):
+            shift = 1 if action == "insert" else -1
+            self.filtered = [m + shift if m >= index else m for m in self.filtered if not (action == "delete" and m == index)]
+            self.positions = {m: v for v, m in enumerate(self.filtered)}
+        if action == "insert":
+            self.see(index)
+        self.render()
+
+    # Scrollbar callback: ("moveto", fraction) or ("scroll", n, "units"/"pages")
+    def yview(self, *args):
+        if args[0] == "moveto":
+            self.top = int(float(args[1])*self.view_count())
+        elif args[0] == "scroll":
+            step = int(args[1])
+            if args[2] == "pages":
+                step = step*self.height
+            self.top = self.top + step
+        self.render()
+
+    def on_wheel(self, event):
+        if event.num == 4 or getattr(event, "delta", 0) > 0:
+            self.yview("scroll", -1, "units")
+        else:
+            self.yview("scroll", 1, "units")
+        return "break"
+
+    def move_selection(self, step):
+        count = self.view_count()
+        if count > 0:
+            view = None
+            if self.selected != None:
+                view = self.view_index(self.selected)
+            if view == None:
+                self.select(self.model_index(self.top))
+            else:
+                self.select(self.model_index(max(0, min(count - 1, view + step))))
+            if self.select_callback != None:
+                self.select_callback(None)
+        return "break"
+
+    def on_select(self, event):
+        visible = self.listbox.curselection()
+        if len(visible) > 0:
+            self.selected = self.model_index(self.top + int(visible[0]))
+        if self.select_callback != None:
+            self.select_callback(event)
+
+# searchIndex is an incremental substring index over short strings (attribute names, levels, restrictions)
+# Every substring of up to 3 characters is indexed: queries of 1-3 characters are a single lookup and
+# longer queries intersect the sets of their 3-character pieces, then check the few candidates left
+# Keys are arbitrary hashable items; adding the same key twice keeps a count so it can be removed twice
+class searchIndex:
+
+    def __init__(self):
+        self.grams = {}
+        self.texts = {}
+        self.counts = {}
+
+    def clear(self):
+        self.grams = {}
+        self.texts = {}
+        self.counts = {}
+
+    def grams_of(self, text):
+        grams = set()
+        for n in range(1, 4):
+            for i in range(len(text) - n + 1):
+                grams.add(text[i:i+n])
+        return grams
+
+    def add(self, key, text):
+        if key in self.counts:
+            self.counts[key] = self.counts[key] + 1
+            return
+        text = text.lower()
+        self.counts[key] = 1
+        self.texts[key] = text
+        for gram in self.grams_of(text):
+            self.grams.setdefault(gram, set()).add(key)
+
+    def remove(self, key):
+        if key not in self.counts:
+            return
+        self.counts[key] = self.counts[key] - 1
+        if self.counts[key] > 0:
+            return
+        del self.counts[key]
+        text = self.texts.pop(key)
+        for gram in self.grams_of(text):
+            keys = self.grams.get(gram)
+            if keys != None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del self.grams[gram]
+
+    # Returns the set of keys whose text contains (or, with prefix=True, starts with) query
+    def search(self, query, prefix=False):
+        query = query.lower()
+        if query == "":
+            return set(self.texts)
+        if len(query) <= 3:
+            matches = set(self.grams.get(query, ()))
+        else:
+            pieces = sorted((self.grams.get(query[i:i+3], set()) for i in range(len(query) - 2)), key=len)
+            matches = set(pieces[0])
+            for piece in pieces[1:]:
+                matches &= piece
+                if len(matches) == 0:
+                    break
+            matches = {key for key in matches if query in self.texts[key]}
+        if prefix:
+            matches = {key for key in matches if self.texts[key].startswith(query)}
+        return matches
+
 # conjointGUI is the main GUI control class
 # arguments: parent - TK window parent class
 class conjointGUI:
@@ -135,9 +398,13 @@ class conjointGUI:
         # Edit Menu
         self.editmenu = Menu(self.menu, tearoff=0)
         self.menu.add_cascade(label="Edit", menu=self.editmenu)
+        self.editmenu.add_command(label="Undo", command=self.undo, accelerator="Ctrl+Z")
+        self.editmenu.add_command(label="Redo", command=self.redo, accelerator="Ctrl+Y")
+        self.editmenu.add_separator()
         self.editmenu.add_command(label="Settings", command=self.open_settings)
         self.editmenu.add_command(label="Restrictions", command=self.edit_restrictions)
         self.editmenu.add_command(label="Randomization Weights", command=self.probability_menu)
+        self.editmenu.add_command(label="Conditional Weights", command=self.conditional_menu)
         self.editmenu.add_command(label="Attribute Order Constraints", command=self.edit_orderconstraints)
         self.editmenu.add_separator()
         self.editmenu.add_command(label="Export to PHP", command=self.export_qualtrics)
@@ -149,6 +416,16 @@ class conjointGUI:
         self.menu.add_cascade(label="About", menu=self.aboutmenu)
         self.aboutmenu.add_command(label="License", command=self.show_license)
         
+        # Search bar - type-ahead filter over attribute and level names
+        self.search_frame = Frame(self.myParent)
+        self.search_frame.pack(side=TOP, pady=5)
+        self.search_label = Label(self.search_frame, text="Search")
+        self.search_label.pack(side=LEFT)
+        self.search_var = StringVar()
+        self.search_entry = Entry(self.search_frame, width=40, textvariable=self.search_var)
+        self.search_entry.pack(side=LEFT)
+        self.search_var.trace_add("write", self.apply_main_filter)
+        
         # Initialize main frame - Two halves (left_frame/right_frame)
         self.left_frame = Frame(self.myParent)
         self.left_frame.pack(side=LEFT, padx=10)
@@ -161,6 +438,8 @@ class conjointGUI:
         self.restrictions = []
         self.constraints = []
         self.probabilities = {}
+        self.conditional_weights = {}
+        self.prob_sums = {}
         self.activeAttribute = None
         self.randomize_resp_attr = IntVar()
         self.randomize_resp_attr.set(1)
@@ -168,6 +447,20 @@ class conjointGUI:
         self.weighted_randomize_attr.set(0)
         self.no_duplicate_profiles = IntVar()
         self.no_duplicate_profiles.set(0)
+        self.record_telemetry = IntVar()
+        self.record_telemetry.set(0)
+        self.retry_budget_num = StringVar()
+        self.retry_budget_num.set(str(default_settings["retry_budget"]))
+        self.lazy_tasks = IntVar()
+        self.lazy_tasks.set(0)
+        self.session_cache = IntVar()
+        self.session_cache.set(1)
+        self.order_once = IntVar()
+        self.order_once.set(0)
+        self.fit_marginals = IntVar()
+        self.fit_marginals.set(0)
+        self.fallback = IntVar()
+        self.fallback.set(1)
         self.task_num = StringVar()
         self.task_num.set("5")
         self.profile_num = StringVar()
@@ -194,23 +487,41 @@ class conjointGUI:
         
         # List boxes and scroll bars (vertical/horizontal)
         self.box_attributes_vscroll = Scrollbar(self.left_box_frame)
-        self.box_attributes = Listbox(self.left_box_frame, height=listbox_height, width=listbox_width)
+        self.attributes_listbox = Listbox(self.left_box_frame, height=listbox_height, width=listbox_width)
         self.box_levels_vscroll = Scrollbar(self.right_box_frame)
-        self.box_levels = Listbox(self.right_box_frame, height=listbox_height, width=listbox_width)
+        self.levels_listbox = Listbox(self.right_box_frame, height=listbox_height, width=listbox_width)
         
         # Pack Boxes/Scroll Bars
-        self.box_attributes.pack(side=LEFT)
+        self.attributes_listbox.pack(side=LEFT)
         self.box_attributes_vscroll.pack(side=LEFT,fill=Y)
-        self.box_levels.pack(side=LEFT)
+        self.levels_listbox.pack(side=LEFT)
         self.box_levels_vscroll.pack(side=LEFT,fill=Y)
         
-        # Configure Scroll Bars
-        self.box_attributes_vscroll.config(command=self.box_attributes.yview)
-        self.box_attributes.config(yscrollcommand=self.box_attributes_vscroll.set)
-        self.box_levels_vscroll.config(command=self.box_levels.yview)
-        self.box_levels.config(yscrollcommand=self.box_levels_vscroll.set)
+        # Virtual views over the listboxes - only the visible rows are drawn
+        self.box_attributes = virtualListbox(self.attributes_listbox, self.box_attributes_vscroll, lambda: len(self.attribute_list), lambda i: self.attribute_list[i])
+        self.box_levels = virtualListbox(self.levels_listbox, self.box_levels_vscroll, self.active_level_count, lambda i: self.level_dict[self.activeAttribute][i])
                 
-        self.box_attributes.bind('<<ListboxSelect>>',self.update_levels)
+        self.box_attributes.bind_select(self.update_levels)
+        
+        # Model change notifications: views subscribe to a part of the design and are told which row changed
+        self.listeners = {}
+        self.clear_history()
+        self.myParent.bind_all('<Control-z>', self.undo)
+        self.myParent.bind_all('<Control-y>', self.redo)
+        self.myParent.bind_all('<Control-Z>', self.redo)
+        # The search index is kept up to date first, so views can filter against it when they are notified
+        self.search_index = searchIndex()
+        self.search_rows = None
+        # Exports are reused from the cache unless turned off in the Settings menu (not saved with the design)
+        self.cache = artifactCache()
+        self.use_cache = IntVar()
+        self.use_cache.set(default_options["use_cache"])
+        self.subscribe("attributes", self.search_attributes_changed)
+        self.subscribe("levels", self.search_levels_changed)
+        self.subscribe("restrictions", self.search_restrictions_changed)
+        self.subscribe("reset", self.rebuild_search_index)
+        self.subscribe("attributes", self.attributes_changed)
+        self.subscribe("levels", self.levels_changed)
         
         # Buttons 
         # Left Panel (Attributes)
@@ -263,22 +574,26 @@ class conjointGUI:
         if in_file_name != None:
             if re.search("\.sdt",in_file_name[-4:]) != None:
                 try:
-                    open_file = open(in_file_name,"rb")
-                    pick_in = pickle.Unpickler(open_file)
-                    self.attribute_list = pick_in.load()
-                    self.level_dict = pick_in.load()
-                    self.restrictions = pick_in.load()
-                    self.constraints = pick_in.load()
-                    self.probabilities = pick_in.load()                    
-                    
-                    task = pick_in.load()
-                   
-                    self.task_num.set(str(task))
-                    profile = pick_in.load()
-                    
-                    self.profile_num.set(str(profile))
+                    design = read_design(in_file_name)
+                    self.attribute_list = design["attributes"]
+                    self.level_dict = design["level_dict"]
+                    self.restrictions = design["restrictions"]
+                    self.constraints = design["constraints"]
+                    self.probabilities = design["probabilities"]
+                    self.conditional_weights = design["conditional_weights"]
+                    self.task_num.set(str(design["tasks"]))
+                    self.profile_num.set(str(design["profiles"]))
+                    self.weighted_randomize_attr.set(int(design["weighted"]))
+                    self.randomize_resp_attr.set(int(design["randomize"]))
+                    self.no_duplicate_profiles.set(int(design["no_duplicates"]))
+                    self.record_telemetry.set(int(design["telemetry"]))
+                    self.retry_budget_num.set(str(design["retry_budget"]))
+                    self.lazy_tasks.set(int(design["lazy_tasks"]))
+                    self.session_cache.set(int(design["session_cache"]))
+                    self.order_once.set(int(design["order_once"]))
+                    self.fit_marginals.set(int(design["fit_marginals"]))
+                    self.fallback.set(int(design["fallback"]))
                     self.activeAttribute = self.attribute_list[0]
-                    open_file.close()
                     
                     self.file_name = in_file_name
                     self.update_file_name(in_file_name)
@@ -301,16 +616,7 @@ class conjointGUI:
             if re.search("\.sdt",out_file_name[-4:]) != None:
                 try:
                     self.synchronize_attribute_levels()
-                    save_file = open(out_file_name,"wb")
-                    pick_out = pickle.Pickler(save_file)
-                    pick_out.dump(self.attribute_list)
-                    pick_out.dump(self.level_dict)
-                    pick_out.dump(self.restrictions)
-                    pick_out.dump(self.constraints)
-                    pick_out.dump(self.probabilities)
-                    pick_out.dump(self.task_num.get())
-                    pick_out.dump(self.profile_num.get())
-                    save_file.close()
+                    write_design(out_file_name, self.design())
                     self.file_name = out_file_name
                     self.update_file_name(out_file_name)
                 except:
@@ -324,19 +630,33 @@ class conjointGUI:
         else:
             try:
                 self.synchronize_attribute_levels()
-                save_file = open(self.file_name,"wb")
-                pick_out = pickle.Pickler(save_file)
-                pick_out.dump(self.attribute_list)
-                pick_out.dump(self.level_dict)
-                pick_out.dump(self.restrictions)
-                pick_out.dump(self.constraints)
-                pick_out.dump(self.probabilities)
-                pick_out.dump(self.task_num.get())
-                pick_out.dump(self.profile_num.get())
-                save_file.close()
+                write_design(self.file_name, self.design())
             except:
                 self.saveas_survey()
                 
+    # The current design as a dictionary (same layout as read_design)
+    def design(self):
+        design = {}
+        design["attributes"] = self.attribute_list
+        design["level_dict"] = self.level_dict
+        design["restrictions"] = self.restrictions
+        design["constraints"] = self.constraints
+        design["probabilities"] = self.probabilities
+        design["tasks"] = self.task_num.get()
+        design["profiles"] = self.profile_num.get()
+        design["weighted"] = int(self.weighted_randomize_attr.get())
+        design["randomize"] = int(self.randomize_resp_attr.get())
+        design["no_duplicates"] = int(self.no_duplicate_profiles.get())
+        design["telemetry"] = int(self.record_telemetry.get())
+        design["retry_budget"] = self.retry_budget_num.get()
+        design["lazy_tasks"] = int(self.lazy_tasks.get())
+        design["session_cache"] = int(self.session_cache.get())
+        design["order_once"] = int(self.order_once.get())
+        design["fit_marginals"] = int(self.fit_marginals.get())
+        design["fallback"] = int(self.fallback.get())
+        design["conditional_weights"] = self.conditional_weights
+        return design
+
     # Imports attribute and level data from a csv file
     # Each row is an attribute + levels. First value is the attribute name, all others are levels
     def import_csv(self):
@@ -355,6 +675,7 @@ class conjointGUI:
                     self.attribute_list = []
                     self.level_dict = {}
                     self.probabilities = {}
+                    self.conditional_weights = {}
                     self.options = default_options
                     self.restrictions = []
                     self.constraints = []
@@ -366,6 +687,20 @@ class conjointGUI:
                     self.weighted_randomize_attr.set(0)
                     self.no_duplicate_profiles = IntVar()
                     self.no_duplicate_profiles.set(0)
+                    self.record_telemetry = IntVar()
+                    self.record_telemetry.set(0)
+                    self.retry_budget_num = StringVar()
+                    self.retry_budget_num.set(str(default_settings["retry_budget"]))
+                    self.lazy_tasks = IntVar()
+                    self.lazy_tasks.set(0)
+                    self.session_cache = IntVar()
+                    self.session_cache.set(1)
+                    self.order_once = IntVar()
+                    self.order_once.set(0)
+                    self.fit_marginals = IntVar()
+                    self.fit_marginals.set(0)
+                    self.fallback = IntVar()
+                    self.fallback.set(1)
                     self.task_num = StringVar()
                     self.task_num.set("5")
                     self.profile_num = StringVar()
@@ -428,6 +763,21 @@ class conjointGUI:
         self.no_duplicate_profiles_button = Checkbutton(self.settings, text="Prevent identical profiles", variable = self.no_duplicate_profiles)
         self.no_duplicate_profiles_button.pack()
         
+        self.record_telemetry_button = Checkbutton(self.settings, text="Record generation time and retries (PHP/JavaScript)", variable = self.record_telemetry)
+        self.record_telemetry_button.pack()
+        
+        self.lazy_tasks_button = Checkbutton(self.settings, text="Generate each task on the page before it (JavaScript)", variable = self.lazy_tasks)
+        self.lazy_tasks_button.pack()
+        
+        self.session_cache_button = Checkbutton(self.settings, text="Keep profiles when the page is reloaded (JavaScript)", variable = self.session_cache)
+        self.session_cache_button.pack()
+        
+        self.order_once_button = Checkbutton(self.settings, text="Store the attribute order once per respondent", variable = self.order_once)
+        self.order_once_button.pack()
+        
+        self.fit_marginals_button = Checkbutton(self.settings, text="Fit weights so level shares match them despite restrictions", variable = self.fit_marginals)
+        self.fit_marginals_button.pack()
+        
         self.weighted_randomize_rule = Frame(self.settings,height=1,width=200,bg="black")
         self.weighted_randomize_rule.pack(pady=10)
         
@@ -450,6 +800,20 @@ class conjointGUI:
         self.entry_profiles = Entry(self.profiles_box, width=5, textvariable=self.profile_num)
         self.entry_profiles.pack(side=LEFT)
         
+        self.retry_box = Frame(self.settings)
+        self.retry_box.pack()
+        
+        self.entry_retry_label = Label(self.retry_box, text="Draws per Profile before Fallback")
+        self.entry_retry_label.pack(side=LEFT)
+        self.entry_retry = Entry(self.retry_box, width=5, textvariable=self.retry_budget_num)
+        self.entry_retry.pack(side=LEFT)
+        
+        self.fallback_button = Checkbutton(self.settings, text="Draw from the allowed profiles past the retry budget (PHP/JavaScript)", variable = self.fallback)
+        self.fallback_button.pack()
+        
+        self.use_cache_button = Checkbutton(self.settings, text="Reuse cached exports of unchanged designs", variable = self.use_cache)
+        self.use_cache_button.pack()
+        
         self.settings_save = Button(self.settings, text="Save Settings", command=self.settings.destroy)
         self.settings_save.pack()
         
@@ -469,6 +833,12 @@ class conjointGUI:
         self.restrict_text_header = Label(self.restrict_header, text="Specified Restrictions")
         self.restrict_header.pack()
         self.restrict_text_header.pack()
+        self.restrict_search_label = Label(self.restrict_header, text="Search")
+        self.restrict_search_var = StringVar(self.myParent)
+        self.restrict_search_entry = Entry(self.restrict_header, width=30, textvariable=self.restrict_search_var)
+        self.restrict_search_label.pack(side=LEFT)
+        self.restrict_search_entry.pack(side=LEFT)
+        self.restrict_search_var.trace_add("write", self.apply_restriction_filter)
         
         
         # Frame to fit to
@@ -481,18 +851,19 @@ class conjointGUI:
         # List boxes and scroll bars (vertical/horizontal)
         self.box_restrictions_vscroll = Scrollbar(self.restrict_main)
         self.box_restrictions_xscroll = Scrollbar(self.restrict_main_box, orient=HORIZONTAL)
-        self.box_restrictions = Listbox(self.restrict_main_box, height=listbox_height, width=listbox_width)
+        self.restrictions_listbox = Listbox(self.restrict_main_box, height=listbox_height, width=listbox_width)
         
         # Pack Boxes/Scroll Bars
-        self.box_restrictions.pack()
+        self.restrictions_listbox.pack()
         self.box_restrictions_xscroll.pack(fill=X)
         self.box_restrictions_vscroll.pack(side=LEFT,fill=Y)
         
         # Config Boxes/Scroll
-        self.box_restrictions_vscroll.config(command=self.box_restrictions.yview)
-        self.box_restrictions.config(yscrollcommand=self.box_restrictions_vscroll.set)
-        self.box_restrictions_xscroll.config(command=self.box_restrictions.xview)
-        self.box_restrictions.config(xscrollcommand=self.box_restrictions_xscroll.set)
+        self.box_restrictions = virtualListbox(self.restrictions_listbox, self.box_restrictions_vscroll, lambda: len(self.restrictions), self.restriction_text)
+        self.box_restrictions_xscroll.config(command=self.restrictions_listbox.xview)
+        self.restrictions_listbox.config(xscrollcommand=self.box_restrictions_xscroll.set)
+        self.subscribe("restrictions", self.restrictions_changed)
+        self.restrictions_listbox.bind('<Destroy>', lambda event: self.unsubscribe("restrictions", self.restrictions_changed))
         
         self.restrict_footer = Frame(self.restrict_window)
         self.restrict_footer.pack()
@@ -518,29 +889,21 @@ class conjointGUI:
         self.attr_rest_label.pack()
         self.level_rest_label.pack()
         
-        attr_list = self.attribute_list
+        # Type-ahead combo boxes: typing narrows the drop-down list to the matching attributes/levels
+        self.attr_var = StringVar(self.myParent)
+        self.level_var = StringVar(self.myParent)
+        self.restrictions_attribute_select = ttk.Combobox(self.restrict_select_left, textvariable=self.attr_var, width=30)
+        self.restrictions_level_select = ttk.Combobox(self.restrict_select_right, textvariable=self.level_var, width=30)
+        self.restrictions_attribute_select.bind('<<ComboboxSelected>>', self.update_restriction_levels)
+        self.restrictions_attribute_select.bind('<KeyRelease>', self.type_ahead_restriction_attribute)
+        self.restrictions_level_select.bind('<KeyRelease>', self.type_ahead_restriction_level)
         if len(self.attribute_list) > 0:
-            self.attr_var = StringVar(self.myParent)
-            self.attr_var.set(attr_list[0])
-            self.restrictions_attribute_select = OptionMenu(self.restrict_select_left, self.attr_var, command=self.update_restriction_levels, *tuple(attr_list))
-            
-            level_list = self.level_dict[self.attr_var.get()]
-            
-            if level_list == []:
-                self.level_var = StringVar(self.myParent)
-                self.level_var.set("No Levels")
-                self.restrictions_level_select = OptionMenu(self.restrict_select_right, self.level_var, tuple([]))
-            else:
-                self.level_var = StringVar(self.myParent)
-                self.level_var.set(level_list[0])
-                self.restrictions_level_select = OptionMenu(self.restrict_select_right, self.level_var, *tuple(level_list))
+            self.restrictions_attribute_select['values'] = tuple(self.attribute_list)
+            self.attr_var.set(self.attribute_list[0])
+            self.update_restriction_levels(None)
         else:
-            self.attr_var = StringVar(self.myParent)
             self.attr_var.set("No Attributes")
-            self.restrictions_attribute_select = OptionMenu(self.restrict_select_left, self.attr_var, tuple([]))
-            self.level_var = StringVar(self.myParent)
-            self.level_var.set("No Levels")  
-            self.restrictions_level_select = OptionMenu(self.restrict_select_right, self.level_var, tuple([]))
+            self.level_var.set("No Levels")
         self.update_restriction_list()
 
         self.restrictions_attribute_select.pack()
@@ -553,14 +916,12 @@ class conjointGUI:
         self.restrictions_edit.pack()
         
     def new_restriction(self):
-        self.restrictions.append([])
-        self.update_restriction_list()
+        self.model_insert_restriction(len(self.restrictions), [])
     
     def delete_restriction(self):
         select = map(int, self.box_restrictions.curselection())
         if len(select) > 0:
-            self.restrictions.pop(select[0])
-            self.update_restriction_list()
+            self.model_delete_restriction(select[0])
             
     def edit_restriction(self):
         select = map(int, self.box_restrictions.curselection())
@@ -570,38 +931,59 @@ class conjointGUI:
             if attribute in self.attribute_list and level in self.level_dict[attribute]:
                 exist = 0
                 id = None
-                for m in range(len(self.restrictions[int(select[0])])):
-                    key = self.restrictions[int(select[0])][m]
+                restriction = list(self.restrictions[int(select[0])])
+                for m in range(len(restriction)):
+                    key = restriction[m]
                     if key[0] == attribute:
                         exist = 1
                         id = m
                 
                 if exist == 0:
-                    self.restrictions[int(select[0])].append((attribute, level))
+                    restriction.append((attribute, level))
                 else:
-                    self.restrictions[int(select[0])][id] = (attribute, level)
+                    restriction[id] = (attribute, level)
                     
-                self.update_restriction_list()
+                self.model_set_restriction(int(select[0]), restriction)
             else:
                 messagebox.showerror(title="Cannot Add Restriction",message="Attribute or level does not exist")
         
     def update_restriction_list(self):
-        self.box_restrictions.delete(0,END)
-        if len(self.restrictions) > 0:
-            for i in range(len(self.restrictions)):
-                txt = str(i+1) + " - " + str(self.restrictions[i])
-                self.box_restrictions.insert(END,txt)
+        self.box_restrictions.model_changed("reset")
+
+    # Text is only built for the rows in view
+    def restriction_text(self, i):
+        return str(i+1) + " - " + str(self.restrictions[i])
+
+    def restrictions_changed(self, action, index, attr, old=None):
+        self.box_restrictions.model_changed(action, index)
+        if self.restrict_search_var.get() != "":
+            self.apply_restriction_filter()
         
+    # Fill the level drop-down for the chosen attribute (one call, rather than one menu entry per level)
     def update_restriction_levels(self, misc):
-        new_level_list = self.level_dict[self.attr_var.get()]
+        new_level_list = self.level_dict.get(self.attr_var.get(), [])
+        self.restrictions_level_select['values'] = tuple(new_level_list)
         if new_level_list != []:
-            self.restrictions_level_select['menu'].delete(0, END)
-            for level in new_level_list:
-                self.restrictions_level_select['menu'].add_command(label=level, command=lambda temp = level: self.restrictions_level_select.setvar(self.restrictions_level_select.cget("textvariable"), value = temp))
             self.level_var.set(new_level_list[0])
         else:
-            self.restrictions_level_select['menu'].delete(0, END)
             self.level_var.set("No Levels")
+
+    def type_ahead_restriction_attribute(self, event):
+        self.restrictions_attribute_select['values'] = tuple(self.attribute_list[i] for i in self.filter_attribute_names(self.attr_var.get()))
+        if self.attr_var.get() in self.level_dict:
+            self.update_restriction_levels(None)
+
+    def type_ahead_restriction_level(self, event):
+        attr = self.attr_var.get()
+        if attr in self.level_dict:
+            level_index = self.filter_levels(attr, self.level_var.get(), by_attribute=False)
+            if level_index == None:
+                self.restrictions_level_select['values'] = tuple(self.level_dict[attr])
+            else:
+                self.restrictions_level_select['values'] = tuple(self.level_dict[attr][i] for i in level_index)
+
+    def apply_restriction_filter(self, *args):
+        self.box_restrictions.set_filter(self.filter_restrictions(self.restrict_search_var.get()))
     
     ### Update Attribute Order randomization constraints
     # Edit the Restrictions
@@ -628,18 +1010,19 @@ class conjointGUI:
         # List boxes and scroll bars (vertical/horizontal)
         self.box_constraint_vscroll = Scrollbar(self.constraint_main)
         self.box_constraint_xscroll = Scrollbar(self.constraint_main_box, orient=HORIZONTAL)
-        self.box_constraint = Listbox(self.constraint_main_box, height=constrbox_height, width=constrbox_width)
+        self.constraint_listbox = Listbox(self.constraint_main_box, height=constrbox_height, width=constrbox_width)
         
         # Pack Boxes/Scroll Bars
-        self.box_constraint.pack()
+        self.constraint_listbox.pack()
         self.box_constraint_xscroll.pack(fill=X)
         self.box_constraint_vscroll.pack(side=LEFT,fill=Y)
         
         # Config Boxes/Scroll
-        self.box_constraint_vscroll.config(command=self.box_constraint.yview)
-        self.box_constraint.config(yscrollcommand=self.box_constraint_vscroll.set)
-        self.box_constraint_xscroll.config(command=self.box_constraint.xview)
-        self.box_constraint.config(xscrollcommand=self.box_constraint_xscroll.set)
+        self.box_constraint = virtualListbox(self.constraint_listbox, self.box_constraint_vscroll, lambda: len(self.constraints), self.constraint_text)
+        self.box_constraint_xscroll.config(command=self.constraint_listbox.xview)
+        self.constraint_listbox.config(xscrollcommand=self.box_constraint_xscroll.set)
+        self.subscribe("constraints", self.constraints_changed)
+        self.constraint_listbox.bind('<Destroy>', lambda event: self.unsubscribe("constraints", self.constraints_changed))
         
         self.constraint_footer = Frame(self.constraint_window)
         self.constraint_footer.pack()
@@ -684,14 +1067,12 @@ class conjointGUI:
         self.constraint_edit.pack()
         
     def new_constraint(self):
-        self.constraints.append([])
-        self.update_constraint_list()
+        self.model_insert_constraint(len(self.constraints), [])
     
     def delete_constraint(self):
         select = map(int, self.box_constraint.curselection())
         if len(select) > 0:
-            self.constraints.pop(select[0])
-            self.update_constraint_list()
+            self.model_delete_constraint(select[0])
             
     def edit_constraint(self):
         select = map(int, self.box_constraint.curselection())
@@ -707,19 +1088,18 @@ class conjointGUI:
                 if exist == 1:
                      messagebox.showerror(title="Cannot Add Attribute",message="An Attribute can only be a part of one order randomization constraint")
                 elif exist == 0:
-                    self.constraints[int(select[0])].append(attribute)
-                
-                    
-                self.update_constraint_list()
+                    self.model_set_constraint(int(select[0]), self.constraints[int(select[0])] + [attribute])
             else:
                 messagebox.showerror(title="Cannot Add Constraint",message="Attribute does not exist")
         
     def update_constraint_list(self):
-        self.box_constraint.delete(0,END)
-        if len(self.constraints) > 0:
-            for i in range(len(self.constraints)):
-                txt = str(i+1) + " - " + str(self.constraints[i])
-                self.box_constraint.insert(END,txt)
+        self.box_constraint.model_changed("reset")
+
+    def constraint_text(self, i):
+        return str(i+1) + " - " + str(self.constraints[i])
+
+    def constraints_changed(self, action, index, attr, old=None):
+        self.box_constraint.model_changed(action, index)
         
     ## Specify weighted randomization
     
@@ -733,7 +1113,99 @@ class conjointGUI:
             if (length > 0):
                 for p in range(len(self.level_dict[k])):
                     self.probabilities[k].append(1/length)
-    
+
+    # -- Incremental weight maintenance --
+    # Each edit only touches the weights of the attribute being edited. Custom weights on
+    # every other attribute are left alone and the edited attribute is renormalized so its
+    # existing levels keep their relative sizes.
+
+    # A new level (at position index, default last) gets an even share (1/n)
+    # and the old levels are rescaled to fill the rest
+    def add_level_probability(self, attr, index=None):
+        weights = self.probabilities.get(attr, [])
+        n = len(weights) + 1
+        if index == None:
+            index = len(weights)
+        if len(weights) > 0:
+            old = normalize_weights(weights)
+            share = Fraction(n-1, n)
+            new_weights = [float(Fraction(w)*share) for w in old]
+            new_weights.insert(index, 1/n)
+            self.probabilities[attr] = new_weights
+        else:
+            self.probabilities[attr] = [1.0]
+
+    # Drop the weight of a removed level and rescale the remaining levels to sum to 1
+    def remove_level_probability(self, attr, index):
+        weights = list(self.probabilities.get(attr, []))
+        if index < len(weights):
+            weights.pop(index)
+        self.probabilities[attr] = normalize_weights(weights)
+
+    def rename_attribute_probability(self, old_attr, new_attr):
+        if old_attr != new_attr:
+            self.probabilities[new_attr] = self.probabilities.pop(old_attr, [])
+
+    def remove_attribute_probability(self, attr):
+        if attr in self.probabilities:
+            del self.probabilities[attr]
+
+    # Conditional weight tables name attributes and levels, so renames are carried into them
+    # (tables are replaced rather than edited, as the undo history may hold them)
+    def rename_conditional_attribute(self, old_attr, new_attr):
+        tables = {}
+        for child, table in self.conditional_weights.items():
+            parents = [new_attr if parent == old_attr else parent for parent in table["parents"]]
+            tables[new_attr if child == old_attr else child] = {"parents": parents, "rows": table["rows"]}
+        self.conditional_weights = tables
+
+    def rename_conditional_level(self, attr, old_level, level):
+        for child, table in list(self.conditional_weights.items()):
+            if attr in table["parents"] and old_level != level:
+                a = table["parents"].index(attr)
+                rows = {tuple(level if b == a and name == old_level else name for b, name in enumerate(levels)): weights for levels, weights in table["rows"].items()}
+                self.conditional_weights[child] = {"parents": table["parents"], "rows": rows}
+
+    # A level inserted into an attribute with conditional weights gets an even share of every row, as in
+    # add_level_probability. Returns the new tables
+    def conditional_level_inserted(self, attr, index):
+        tables = dict(self.conditional_weights)
+        if attr in tables:
+            n = len(self.level_dict[attr])
+            rows = {}
+            for levels, weights in tables[attr]["rows"].items():
+                row = [float(Fraction(w)*Fraction(n-1, n)) for w in normalize_weights(weights)]
+                row.insert(index, 1/n)
+                rows[levels] = row
+            tables[attr] = {"parents": tables[attr]["parents"], "rows": rows}
+        return tables
+
+    # A deleted level is taken out of its attribute's rows (which are renormalized), and the rows for that
+    # level of a parent are dropped. Returns the new tables
+    def conditional_level_deleted(self, attr, index, level):
+        tables = {}
+        for child, table in self.conditional_weights.items():
+            if child != attr and attr not in table["parents"]:
+                tables[child] = table
+                continue
+            rows = table["rows"]
+            if child == attr:
+                rows = {levels: normalize_weights([w for k, w in enumerate(weights) if k != index]) for levels, weights in rows.items()}
+            if attr in table["parents"]:
+                a = table["parents"].index(attr)
+                rows = {levels: weights for levels, weights in rows.items() if levels[a] != level}
+            tables[child] = {"parents": table["parents"], "rows": rows}
+        return tables
+
+    # Replace all conditional weight tables (a copy, since the undo history keeps the dictionaries it is given)
+    # and notify the views of every table that changed
+    def replace_conditional(self, tables):
+        old_tables = self.conditional_weights
+        self.conditional_weights = dict(tables)
+        for child in set(old_tables) | set(tables):
+            if old_tables.get(child) is not tables.get(child):
+                self.notify("conditional", "update", None, child, old_tables.get(child))
+
     # Update the probabilities with a new set
     def update_probabilities(self, update_dictionary):
         self.probabilities = update_dictionary
@@ -744,7 +1216,9 @@ class conjointGUI:
             listbox_width = 30
             listbox_height = 30
             
-            self.tempProbabilities = copy.deepcopy(self.probabilities)       
+            # Weight lists are never edited in place (edits swap in a new list), so a shallow copy is enough
+            self.tempProbabilities = dict(self.probabilities)
+            self.prob_sums = {}
             
             # Main New Window Frame
             self.prob_window = Toplevel()
@@ -753,6 +1227,15 @@ class conjointGUI:
             self.prob_window.grab_set()    
             self.probactiveAttribute = self.attribute_list[0]
             
+            self.prob_search_frame = Frame(self.prob_window)
+            self.prob_search_frame.pack(side=TOP, pady=5)
+            self.prob_search_label = Label(self.prob_search_frame, text="Search")
+            self.prob_search_label.pack(side=LEFT)
+            self.prob_search_var = StringVar(self.prob_window)
+            self.prob_search_entry = Entry(self.prob_search_frame, width=40, textvariable=self.prob_search_var)
+            self.prob_search_entry.pack(side=LEFT)
+            self.prob_search_var.trace_add("write", self.apply_prob_filter)
+            
             self.left_prob_frame = Frame(self.prob_window)
             self.left_prob_frame.pack(side=LEFT, padx=10)
             self.right_prob_frame = Frame(self.prob_window)
@@ -775,30 +1258,32 @@ class conjointGUI:
             
             # List boxes and scroll bars (vertical/horizontal)
             self.prob_box_attributes_vscroll = Scrollbar(self.left_prob_box_frame)
-            self.prob_box_attributes = Listbox(self.left_prob_box_frame, height=listbox_height, width=listbox_width)
+            self.prob_attributes_listbox = Listbox(self.left_prob_box_frame, height=listbox_height, width=listbox_width)
             self.prob_box_levels_vscroll = Scrollbar(self.right_prob_box_frame)
-            self.prob_box_levels = Listbox(self.right_prob_box_frame, height=listbox_height, width=listbox_width)
+            self.prob_levels_listbox = Listbox(self.right_prob_box_frame, height=listbox_height, width=listbox_width)
             
             # Pack Boxes/Scroll Bars
-            self.prob_box_attributes.pack(side=LEFT)
+            self.prob_attributes_listbox.pack(side=LEFT)
             self.prob_box_attributes_vscroll.pack(side=LEFT,fill=Y)
-            self.prob_box_levels.pack(side=LEFT)
+            self.prob_levels_listbox.pack(side=LEFT)
             self.prob_box_levels_vscroll.pack(side=LEFT,fill=Y)
             
-            # Configure Scroll Bars
-            self.prob_box_attributes_vscroll.config(command=self.prob_box_attributes.yview)
-            self.prob_box_attributes.config(yscrollcommand=self.prob_box_attributes_vscroll.set)
-            self.prob_box_levels_vscroll.config(command=self.prob_box_levels.yview)
-            self.prob_box_levels.config(yscrollcommand=self.prob_box_levels_vscroll.set)
+            # Virtual views over the listboxes
+            self.prob_box_attributes = virtualListbox(self.prob_attributes_listbox, self.prob_box_attributes_vscroll, lambda: len(self.attribute_list), lambda i: self.attribute_list[i])
+            self.prob_box_levels = virtualListbox(self.prob_levels_listbox, self.prob_box_levels_vscroll, self.prob_level_count, self.prob_level_text)
             
-            self.prob_box_attributes.bind('<<ListboxSelect>>',self.update_prob_levels)
+            self.prob_box_attributes.bind_select(self.update_prob_levels)
     
             # Buttons 
             # Left Panel (Save/Reset)
             self.right_prob_button_frame = Frame(self.right_prob_frame)
             self.right_prob_button_frame.pack(side=BOTTOM)
             self.prob_edit = Button(self.right_prob_button_frame, text="Edit Weight", command=self.edit_level_prob)
+            self.prob_paste = Button(self.right_prob_button_frame, text="Paste Weights", command=self.paste_weights)
+            self.prob_load = Button(self.right_prob_button_frame, text="Load Weights from .csv", command=self.load_weights_csv)
             self.prob_edit.pack(side=RIGHT)
+            self.prob_paste.pack(side=RIGHT)
+            self.prob_load.pack(side=RIGHT)
     
             # Right Panel (Edit)
             self.left_prob_button_frame = Frame(self.left_prob_frame)
@@ -824,6 +1309,7 @@ class conjointGUI:
             if (length > 0):
                 for p in range(len(self.level_dict[k])):
                     self.tempProbabilities[k].append(1/length)
+        self.prob_sums = {}
                     
         self.update_prob_levels(1)
         
@@ -843,8 +1329,15 @@ class conjointGUI:
                 res = Fraction(data)
                 true_result = float(res)
                 if len(levelSel) > 0 and true_result >= 0 and true_result <= 1 and selAct != None:
-                    self.tempProbabilities[selAct][int(levelSel[0])] = true_result
-                    self.update_prob_levels(1)
+                    weights = list(self.tempProbabilities[selAct])
+                    old_result = weights[int(levelSel[0])]
+                    weights[int(levelSel[0])] = true_result
+                    self.tempProbabilities[selAct] = weights
+                    # Only the edited weight changes, so adjust the cached sum rather than re-summing
+                    if selAct in self.prob_sums:
+                        self.prob_sums[selAct] = self.prob_sums[selAct] - Fraction(old_result) + Fraction(true_result)
+                    self.update_prob_label()
+                    self.prob_box_levels.render_row(int(levelSel[0]))
                     self.top.destroy()
                 else:
                     self.top.destroy()
@@ -853,56 +1346,109 @@ class conjointGUI:
         else:
             self.top.destroy()
 
+    # -- Bulk weight editing --
+    # Validates a whole table of weights ({attribute: [weights]}) at once and commits it to
+    # tempProbabilities with a single redraw of the dialog
+    def set_temp_weights(self, weight_table):
+        parsed, errors = validate_weight_table(weight_table, self.level_dict)
+        if len(errors) > 0:
+            messagebox.showerror(title="Error",message="Error: Could not set weights\n\n" + "\n".join(errors))
+            return False
+        for attr in parsed:
+            self.tempProbabilities[attr] = parsed[attr]
+            self.prob_sums[attr] = Fraction(1)
+        self.update_prob_levels(1)
+        return True
+
+    # Set weights on the saved design directly (outside of the weight dialog)
+    def set_weights(self, weight_table):
+        parsed, errors = validate_weight_table(weight_table, self.level_dict)
+        if len(errors) == 0:
+            self.begin_history_group()
+            for attr in parsed:
+                self.model_set_weights(attr, parsed[attr])
+            self.end_history_group()
+        return errors
+
+    # Paste a column of weights (e.g. copied from a spreadsheet) for the active attribute
+    # The last value on each line is taken as the weight so "level, weight" rows also work
+    def paste_weights(self):
+        if self.probactiveAttribute != None:
+            self.paste_window = Toplevel()
+            self.paste_window.title("Paste Weights - " + self.probactiveAttribute)
+            self.paste_window.grab_set()
+            paste_label = Label(self.paste_window, text="Paste one weight per level, in level order")
+            paste_label.pack()
+            self.paste_text = Text(self.paste_window, height=20, width=40)
+            self.paste_text.pack()
+            self.paste_text.focus_set()
+            paste_ok = Button(self.paste_window, text="OK", command=self.commit_pasted_weights)
+            paste_ok.pack()
+            paste_cancel = Button(self.paste_window, text="Cancel", command=lambda: self.paste_window.destroy())
+            paste_cancel.pack()
+
+    def commit_pasted_weights(self):
+        weights = parse_weight_column(self.paste_text.get("1.0", END))
+        if self.set_temp_weights({self.probactiveAttribute: weights}):
+            self.paste_window.destroy()
+            self.prob_window.grab_set()
+
+    # Load weights for one or more attributes from a .csv file
+    # Each row is an attribute followed by its weights in level order (same layout as Import from .csv)
+    def load_weights_csv(self):
+        in_file_name = filedialog.askopenfilename(**self.csv_opt)
+        if in_file_name != None and in_file_name != "" and in_file_name != ():
+            if re.search("\.csv",in_file_name[-4:]) != None:
+                try:
+                    weight_table = read_weights_csv(in_file_name)
+                except:
+                    messagebox.showerror(title="Error",message="Error: Could not open file")
+                    return
+                self.set_temp_weights(weight_table)
+            else:
+                messagebox.showerror(title="Invalid File Name",message="Invalid file extension. File must have the .csv extension")
+        self.prob_window.grab_set()
+
     def update_prob_attributes(self):
-        self.prob_box_attributes.delete(0,END)
-        for k in self.attribute_list:
-            self.prob_box_attributes.insert(END, k)
+        self.prob_box_attributes.model_changed("reset")
         
     # Update levels in the probability box
     def update_prob_levels(self, index):
 
         item = map(int, self.prob_box_attributes.curselection())
-        sums = self.compute_prob_sums()
 
         if len(item) > 0:
             self.probactiveAttribute = self.attribute_list[item[0]]
-            if self.probactiveAttribute != None:
-                val = sums[self.probactiveAttribute]
-                if val.denominator >= 1000:
-                    self.levels_prob_label.config(text="Levels - " + self.probactiveAttribute + " - " + "Sum = " + str(float(val.numerator/val.denominator)))
-                elif val == 1:
-                    self.levels_prob_label.config(text="Levels - " + self.probactiveAttribute + " - " + "Sum = " + str(val))
-                else:
-                    self.levels_prob_label.config(text="Levels - " + self.probactiveAttribute+ " - " + "Sum = " + str(val.numerator) + "/" + str(val.denominator))
-            self.prob_box_levels.delete(0,END)
-            for k in range(len(self.level_dict[self.attribute_list[item[0]]])):
-                level_name = self.level_dict[self.attribute_list[item[0]]][k]
-                Frac = Fraction(self.tempProbabilities[self.attribute_list[item[0]]][k]).limit_denominator()
-                if Frac.denominator >= 1000:
-                    level_prob_str = level_name + ": " + str(self.tempProbabilities[self.attribute_list[item[0]]][k])
-                else:
-                    level_prob_str = level_name + ": " + str(Frac.numerator)+ "/" + str(Frac.denominator)
-                self.prob_box_levels.insert(END,level_prob_str)
-        else:
-            self.prob_box_levels.delete(0,END)
-            if self.probactiveAttribute != None:
-                val = sums[self.probactiveAttribute]
-                if val.denominator >= 1000:
-                    self.levels_prob_label.config(text="Levels - " + self.probactiveAttribute + " - " + "Sum = " + str(float(val.numerator/val.denominator)))
-                elif val == 1:
-                    self.levels_prob_label.config(text="Levels - " + self.probactiveAttribute + " - " + "Sum = " + str(val))
-                else:
-                    self.levels_prob_label.config(text="Levels - " + self.probactiveAttribute+ " - " + "Sum = " + str(val.numerator) + "/" + str(val.denominator))
-            
-            if self.probactiveAttribute != None:
-                for k in range(len(self.level_dict[self.probactiveAttribute])):
-                    level_name = self.level_dict[self.probactiveAttribute][k]
-                    Frac = Fraction(self.tempProbabilities[self.probactiveAttribute][k]).limit_denominator()
-                    if Frac.denominator >= 1000:
-                        level_prob_str = level_name + ": " +  str(self.tempProbabilities[self.probactiveAttribute][k])
-                    else:
-                        level_prob_str = level_name + ": " +  str(Frac.numerator)+ "/" + str(Frac.denominator)
-                    self.prob_box_levels.insert(END,level_prob_str)
+        self.update_prob_label()
+        self.prob_box_levels.model_changed("reset")
+        if self.prob_search_var.get() != "":
+            self.prob_box_levels.set_filter(self.filter_levels(self.probactiveAttribute, self.prob_search_var.get()))
+
+    def apply_prob_filter(self, *args):
+        query = self.prob_search_var.get()
+        self.prob_box_attributes.set_filter(self.filter_attributes(query))
+        self.prob_box_levels.set_filter(self.filter_levels(self.probactiveAttribute, query))
+
+    # Show the (cached) weight sum of the active attribute in the levels label
+    def update_prob_label(self):
+        if self.probactiveAttribute != None:
+            val = self.prob_sum(self.probactiveAttribute)
+            if val.denominator >= 1000:
+                self.levels_prob_label.config(text="Levels - " + self.probactiveAttribute + " - " + "Sum = " + str(float(val.numerator/val.denominator)))
+            elif val == 1:
+                self.levels_prob_label.config(text="Levels - " + self.probactiveAttribute + " - " + "Sum = " + str(val))
+            else:
+                self.levels_prob_label.config(text="Levels - " + self.probactiveAttribute+ " - " + "Sum = " + str(val.numerator) + "/" + str(val.denominator))
+
+    def prob_level_count(self):
+        if self.probactiveAttribute in self.level_dict:
+            return len(self.level_dict[self.probactiveAttribute])
+        return 0
+
+    def prob_level_text(self, k):
+        level_name = self.level_dict[self.probactiveAttribute][k]
+        weight = self.tempProbabilities[self.probactiveAttribute][k]
+        return level_name + ": " + weight_text(weight)
 
     # Save probabilities    
     def save_probs(self):
@@ -910,7 +1456,12 @@ class conjointGUI:
         validation = self.validate_probabilities()
         
         if validation[0]:
-            self.probabilities = copy.deepcopy(self.tempProbabilities)
+            # Only attributes whose weight list was replaced are recorded, as a single undo step
+            self.begin_history_group()
+            for attr in self.tempProbabilities:
+                if self.tempProbabilities[attr] is not self.probabilities.get(attr):
+                    self.model_set_weights(attr, self.tempProbabilities[attr])
+            self.end_history_group()
             self.prob_window.destroy()
         else:
             errmsg = "Error: The following attribute weights do not sum to 1\n"
@@ -939,18 +1490,145 @@ class conjointGUI:
     def compute_prob_sums(self):
         sums = {}
         for attr in self.tempProbabilities:
-            sum_out = Fraction()
-            for k in self.tempProbabilities[attr]:
-                sum_out = sum_out + Fraction(k)
-            sums[attr] = sum_out.limit_denominator()
+            sums[attr] = self.prob_sum(attr)
         return(sums)
+
+    # Exact sums are cached in self.prob_sums and only recomputed for attributes that are missing
+    def prob_sum(self, attr):
+        if attr not in self.prob_sums:
+            self.prob_sums[attr] = weight_sum(self.tempProbabilities[attr])
+        return self.prob_sums[attr].limit_denominator()
         
+    # -- Conditional weights --
+    # Edit the weights of an attribute's levels given the levels of the attributes it depends on (its parents).
+    # The table has one tab-separated row per combination of parent levels: the parent levels, then one weight
+    # per level. Rows left out use the attribute's own weights.
+    def conditional_menu(self):
+        if len(self.attribute_list) > 0:
+            self.cond_window = Toplevel()
+            self.cond_window.title("Edit Conditional Weights")
+            self.cond_window.grab_set()
+            self.cond_child = None
+            self.cond_parents = []
+
+            self.left_cond_frame = Frame(self.cond_window)
+            self.left_cond_frame.pack(side=LEFT, padx=10)
+            self.right_cond_frame = Frame(self.cond_window)
+            self.right_cond_frame.pack(side=RIGHT, padx=10)
+
+            # Attribute and the attributes its weights depend on
+            self.cond_child_label = Label(self.left_cond_frame, text="Attribute")
+            self.cond_child_label.pack(side=TOP, pady=5)
+            self.cond_child_box = Listbox(self.left_cond_frame, height=12, width=30, exportselection=False)
+            self.cond_child_box.pack()
+            self.cond_parent_label = Label(self.left_cond_frame, text="Depends on")
+            self.cond_parent_label.pack(side=TOP, pady=5)
+            self.cond_parent_box = Listbox(self.left_cond_frame, height=12, width=30, selectmode=MULTIPLE, exportselection=False)
+            self.cond_parent_box.pack()
+            for attr in self.attribute_list:
+                self.cond_child_box.insert(END, attr)
+                self.cond_parent_box.insert(END, attr)
+            self.cond_child_box.bind("<<ListboxSelect>>", self.show_conditional)
+
+            # Weight table
+            self.cond_table_label = Label(self.right_cond_frame, text="Weights (used with weighted randomization)")
+            self.cond_table_label.pack(side=TOP, pady=5)
+            self.cond_text = Text(self.right_cond_frame, height=26, width=70, wrap=NONE)
+            self.cond_text.pack()
+
+            self.cond_button_frame = Frame(self.right_cond_frame)
+            self.cond_button_frame.pack(side=BOTTOM)
+            self.cond_fill = Button(self.cond_button_frame, text="Fill Rows", command=self.fill_conditional_rows)
+            self.cond_save = Button(self.cond_button_frame, text="Save Table", command=self.save_conditional)
+            self.cond_remove = Button(self.cond_button_frame, text="Remove Table", command=self.remove_conditional)
+            self.cond_close = Button(self.cond_button_frame, text="Close", command=self.cond_window.destroy)
+            self.cond_fill.pack(side=LEFT)
+            self.cond_save.pack(side=LEFT)
+            self.cond_remove.pack(side=LEFT)
+            self.cond_close.pack(side=LEFT)
+
+            self.cond_child_box.selection_set(0)
+            self.show_conditional()
+        else:
+            messagebox.showerror(title="Error",message="Error: No Attributes to Load")
+
+    # Show the table of the selected attribute, with its parents selected
+    def show_conditional(self, event=None):
+        selection = map(int, self.cond_child_box.curselection())
+        if len(selection) == 0:
+            return
+        self.cond_child = self.attribute_list[selection[0]]
+        table = self.conditional_weights.get(self.cond_child, {"parents": [], "rows": {}})
+        # A table whose parents were removed is shown empty
+        if not all(parent in self.attribute_list for parent in table["parents"]):
+            table = {"parents": [], "rows": {}}
+        self.cond_parent_box.selection_clear(0, END)
+        for parent in table["parents"]:
+            self.cond_parent_box.selection_set(self.attribute_list.index(parent))
+        self.write_conditional_rows(list(table["parents"]), table["rows"])
+
+    # Rewrite the rows for the selected parents, keeping the weights already typed in for them
+    def fill_conditional_rows(self):
+        if self.cond_child == None:
+            return
+        parents = [self.attribute_list[int(i)] for i in self.cond_parent_box.curselection()]
+        rows = {}
+        if parents == self.cond_parents:
+            rows = parse_conditional_rows(self.cond_text.get("1.0", END), len(parents))
+        size = 1
+        for parent in parents:
+            size = size*len(self.level_dict[parent])
+        if size > 10000:
+            messagebox.showerror(title="Error",message="Error: Too many combinations of levels (" + str(size) + ") to list")
+            self.cond_window.grab_set()
+            return
+        self.write_conditional_rows(parents, rows)
+
+    def write_conditional_rows(self, parents, rows):
+        self.cond_parents = parents
+        self.cond_text.delete("1.0", END)
+        if len(parents) == 0:
+            return
+        child = self.cond_child
+        lines = ["# " + "\t".join(parents + self.level_dict[child])]
+        for levels in itertools.product(*[self.level_dict[parent] for parent in parents]):
+            weights = rows.get(levels, self.probabilities.get(child, []))
+            lines.append("\t".join(list(levels) + [weight_text(w) if not isinstance(w, str) else w for w in weights]))
+        self.cond_text.insert("1.0", "\n".join(lines) + "\n")
+
+    def save_conditional(self):
+        if self.cond_child == None:
+            return
+        parents = [self.attribute_list[int(i)] for i in self.cond_parent_box.curselection()]
+        if parents != self.cond_parents:
+            messagebox.showerror(title="Error",message="Error: Fill the rows for the selected attributes before saving")
+        else:
+            rows = parse_conditional_rows(self.cond_text.get("1.0", END), len(parents))
+            table, errors = validate_conditional_weights(self.cond_child, parents, rows, self.level_dict, self.conditional_weights)
+            if len(errors) > 0:
+                messagebox.showerror(title="Error",message="Error: Could not set conditional weights\n\n" + "\n".join(errors))
+            else:
+                self.model_set_conditional(self.cond_child, table)
+        self.cond_window.grab_set()
+
+    def remove_conditional(self):
+        if self.cond_child != None and self.cond_child in self.conditional_weights:
+            self.model_set_conditional(self.cond_child, None)
+        self.cond_parent_box.selection_clear(0, END)
+        self.write_conditional_rows([], {})
+
+    # The export cache, or None when it is turned off
+    def export_cache(self):
+        if int(self.use_cache.get()) == 1:
+            return self.cache
+        return None
+
     # Export the design information to .php
     def export_qualtrics(self):
         out_php_name = filedialog.asksaveasfilename(**self.file_php)
         if out_php_name != None:
             if re.search("\.php",out_php_name[-4:]) != None:
-                qualtrics_out(out_php_name, self.attribute_list, self.level_dict, self.restrictions, self.constraints, self.probabilities, self.weighted_randomize_attr.get(), int(self.profile_num.get()), int(self.task_num.get()),int(self.randomize_resp_attr.get()), int(self.no_duplicate_profiles.get()))
+                export_design("php", out_php_name, self.design(), self.export_cache())
             else:
                 messagebox.showerror(title="Invalid File Name",message="Invalid file extension. File must have the .php extension")
 
@@ -958,21 +1636,21 @@ class conjointGUI:
     def export_qualtrics_js(self):
         out_js_name = filedialog.asksaveasfilename(**self.file_js)
         if out_js_name != None:
-            qualtrics_out_js(out_js_name, self.attribute_list, self.level_dict, self.restrictions, self.constraints, self.probabilities, self.weighted_randomize_attr.get(), int(self.profile_num.get()), int(self.task_num.get()),int(self.randomize_resp_attr.get()), int(self.no_duplicate_profiles.get()))
+            export_design("js", out_js_name, self.design(), self.export_cache())
             
 
     # Export the design information to R
     def export_R(self):
         out_R_name = filedialog.asksaveasfilename(**self.file_dat)
         if out_R_name != None:
-            R_out(out_R_name, self.attribute_list, self.level_dict, self.restrictions, self.constraints, self.probabilities, self.weighted_randomize_attr.get(), int(self.profile_num.get()), int(self.task_num.get()),int(self.randomize_resp_attr.get()))
+            export_design("R", out_R_name, self.design(), self.export_cache())
             
     # Create a default template to pass into Qualtrics
     def export_question(self):
         out_html_name = filedialog.asksaveasfilename(**self.file_html)
         if out_html_name != None:
             if re.search("\.html",out_html_name[-5:]) != None:
-                html_out(out_html_name, len(self.attribute_list), int(self.profile_num.get()), int(self.task_num.get()))
+                html_out(out_html_name, len(self.attribute_list), int(self.profile_num.get()), int(self.task_num.get()), int(self.order_once.get()) == 1)
             else:
                 messagebox.showerror(title="Invalid File Name",message="Invalid file extension. File must have the .html extension")
 
@@ -998,13 +1676,7 @@ class conjointGUI:
         data = self.entry0.get()
         if data:
             if data.strip(" ") != "":
-                self.attribute_list.append(data)
-                self.level_dict[data] = []
-                if len(self.attribute_list) == 1:
-                    self.activeAttribute = data
-                self.clear_probabilities()
-                self.update_listbox_attributes()
-                self.update_listbox_levels()
+                self.model_insert_attribute(len(self.attribute_list), data)
                 self.top.destroy()
             else:
                 self.top.destroy()
@@ -1017,16 +1689,11 @@ class conjointGUI:
             if data.strip(" ") != "":
                 attrit = map(int, self.box_attributes.curselection())
                 if len(attrit) > 0:
-                    self.level_dict[self.attribute_list[attrit[0]]].append(data)
-                    self.clear_probabilities()
-                    self.update_listbox_levels()
-                    self.update_listbox_attributes()
+                    attr = self.attribute_list[attrit[0]]
+                    self.model_insert_level(attr, len(self.level_dict[attr]), data)
                     self.top.destroy()
                 elif self.activeAttribute != None:
-                    self.level_dict[self.activeAttribute].append(data)
-                    self.clear_probabilities()
-                    self.update_listbox_levels()
-                    self.update_listbox_attributes()
+                    self.model_insert_level(self.activeAttribute, len(self.level_dict[self.activeAttribute]), data)
                     self.top.destroy()
             else:
                 self.top.destroy()
@@ -1039,14 +1706,10 @@ class conjointGUI:
             if data.strip(" ") != "":
                 selAct = map(int, self.box_attributes.curselection())
                 if len(selAct) > 0:
-                    oldAtt = self.attribute_list[int(selAct[0])]
-                    self.attribute_list[int(selAct[0])] = data
-                    self.level_dict[data] = self.level_dict[oldAtt]
-                    if oldAtt in self.level_dict: del self.level_dict[oldAtt]
-                    self.activeAttribute = data
-                    self.clear_probabilities()
-                    self.update_listbox_attributes()                    
-                    self.update_listbox_levels()
+                    self.model_rename_attribute(int(selAct[0]), data)
+                    if self.activeAttribute != data:
+                        self.activeAttribute = data
+                        self.update_listbox_levels()
                     
                     self.top.destroy()
                 else:
@@ -1063,11 +1726,7 @@ class conjointGUI:
                 levelSel = map(int, self.box_levels.curselection())
                 selAct = self.activeAttribute
                 if len(levelSel) > 0 and selAct != None:
-                    self.level_dict[selAct][int(levelSel[0])] = data
-                    self.clear_probabilities()
-                    self.update_listbox_levels()
-                    self.update_listbox_attributes()
-                    self.clear_probabilities()
+                    self.model_rename_level(selAct, int(levelSel[0]), data)
                     self.top.destroy()
                 else:
                     self.top.destroy()
@@ -1102,30 +1761,336 @@ class conjointGUI:
     def remove_attribute(self):
         attrit = map(int, self.box_attributes.curselection())
         if len(attrit) > 0:
-            
-            self.attribute_list.remove(self.attribute_list[attrit[0]])
-            self.level_dict[attrit[0]] = []
-            if len(self.attribute_list) > 0:
-                self.activeAttribute = self.attribute_list[0]
-            else:
-                self.activeAttribute = None   
-            self.synchronize_attribute_levels()
-            self.clear_probabilities()
-            self.update_listbox_attributes()
-            self.update_listbox_levels()
+            self.model_delete_attribute(attrit[0])
         
     def synchronize_attribute_levels(self):
         self.level_dict = {new_key: self.level_dict[new_key] for new_key in self.attribute_list}
-        self.probabilities = {new_key: self.probabilities[new_key] for new_key in self.attribute_list}
+        # Weights that are missing or out of step with their levels fall back to even weights
+        sync_probs = {}
+        for new_key in self.attribute_list:
+            weights = self.probabilities.get(new_key, [])
+            if len(weights) != len(self.level_dict[new_key]):
+                weights = normalize_weights([1]*len(self.level_dict[new_key]))
+            sync_probs[new_key] = weights
+        self.probabilities = sync_probs
     
     def remove_level(self):
         attrit = self.activeAttribute
         level = map(int, self.box_levels.curselection())
         if len(level) > 0 and attrit != None:
-            self.level_dict[attrit].pop(level[0])
-            self.clear_probabilities()
+            self.model_delete_level(attrit, level[0])
+
+    # -- Design model edits --
+    # Every change to attributes, levels, restrictions, constraints and weights goes through these methods.
+    # They keep the weights in step with the levels, notify the views of the single row that changed
+    # and record the edit (with its inverse) in the undo history.
+    def model_insert_attribute(self, index, attr, levels=None, weights=None):
+        self.attribute_list.insert(index, attr)
+        self.level_dict[attr] = list(levels) if levels != None else []
+        if weights != None:
+            self.probabilities[attr] = list(weights)
+        else:
+            self.probabilities[attr] = normalize_weights([1]*len(self.level_dict[attr]))
+        self.record(("model_delete_attribute", (index,)), ("model_insert_attribute", (index, attr, tuple(self.level_dict[attr]), self.probabilities[attr])))
+        self.notify("attributes", "insert", index, attr)
+
+    def model_delete_attribute(self, index):
+        attr = self.attribute_list.pop(index)
+        levels = self.level_dict.pop(attr, [])
+        weights = self.probabilities.get(attr, [])
+        self.remove_attribute_probability(attr)
+        self.record(("model_insert_attribute", (index, attr, levels, weights)), ("model_delete_attribute", (index,)))
+        self.notify("attributes", "delete", index, attr, levels)
+
+    def model_rename_attribute(self, index, new_attr):
+        old_attr = self.attribute_list[index]
+        self.attribute_list[index] = new_attr
+        if old_attr != new_attr:
+            self.level_dict[new_attr] = self.level_dict.pop(old_attr)
+            self.rename_attribute_probability(old_attr, new_attr)
+            self.rename_conditional_attribute(old_attr, new_attr)
+            if self.activeAttribute == old_attr:
+                self.activeAttribute = new_attr
+        self.record(("model_rename_attribute", (index, old_attr)), ("model_rename_attribute", (index, new_attr)))
+        self.notify("attributes", "update", index, new_attr, old_attr)
+
+    # Conditional weight tables are kept in step too; undo and redo restore the tables they recorded
+    def model_insert_level(self, attr, index, level, weights=None, conditional=None):
+        old_weights = self.probabilities.get(attr, [])
+        old_conditional = dict(self.conditional_weights)
+        self.level_dict[attr].insert(index, level)
+        if weights != None:
+            self.probabilities[attr] = list(weights)
+        else:
+            self.add_level_probability(attr, index)
+        if conditional == None:
+            conditional = self.conditional_level_inserted(attr, index)
+        self.replace_conditional(conditional)
+        self.record(("model_delete_level", (attr, index, old_weights, old_conditional)), ("model_insert_level", (attr, index, level, self.probabilities[attr], dict(self.conditional_weights))))
+        self.notify("levels", "insert", index, attr)
+
+    def model_delete_level(self, attr, index, weights=None, conditional=None):
+        old_weights = self.probabilities.get(attr, [])
+        old_conditional = dict(self.conditional_weights)
+        level = self.level_dict[attr].pop(index)
+        if weights != None:
+            self.probabilities[attr] = list(weights)
+        else:
+            self.remove_level_probability(attr, index)
+        if conditional == None:
+            conditional = self.conditional_level_deleted(attr, index, level)
+        self.replace_conditional(conditional)
+        self.record(("model_insert_level", (attr, index, level, old_weights, old_conditional)), ("model_delete_level", (attr, index, self.probabilities[attr], dict(self.conditional_weights))))
+        self.notify("levels", "delete", index, attr, level)
+
+    def model_rename_level(self, attr, index, level):
+        old_level = self.level_dict[attr][index]
+        self.level_dict[attr][index] = level
+        self.rename_conditional_level(attr, old_level, level)
+        self.record(("model_rename_level", (attr, index, old_level)), ("model_rename_level", (attr, index, level)))
+        self.notify("levels", "update", index, attr, old_level)
+
+    # Weight lists are replaced rather than edited in place, so history entries can share them
+    def model_set_weights(self, attr, weights):
+        old_weights = self.probabilities.get(attr, [])
+        self.probabilities[attr] = weights
+        self.record(("model_set_weights", (attr, old_weights)), ("model_set_weights", (attr, weights)))
+        self.notify("weights", "update", None, attr, old_weights)
+
+    # Conditional weight tables are replaced whole as well; table None removes the table of child
+    def model_set_conditional(self, child, table):
+        old_table = self.conditional_weights.get(child)
+        if table == None:
+            self.conditional_weights.pop(child, None)
+        else:
+            self.conditional_weights[child] = table
+        self.record(("model_set_conditional", (child, old_table)), ("model_set_conditional", (child, table)))
+        self.notify("conditional", "update", None, child, old_table)
+
+    def model_insert_restriction(self, index, restriction):
+        self.restrictions.insert(index, list(restriction))
+        self.record(("model_delete_restriction", (index,)), ("model_insert_restriction", (index, self.restrictions[index])))
+        self.notify("restrictions", "insert", index)
+
+    def model_delete_restriction(self, index):
+        restriction = self.restrictions.pop(index)
+        self.record(("model_insert_restriction", (index, restriction)), ("model_delete_restriction", (index,)))
+        self.notify("restrictions", "delete", index, None, restriction)
+
+    def model_set_restriction(self, index, restriction):
+        old_restriction = self.restrictions[index]
+        self.restrictions[index] = list(restriction)
+        self.record(("model_set_restriction", (index, old_restriction)), ("model_set_restriction", (index, self.restrictions[index])))
+        self.notify("restrictions", "update", index, None, old_restriction)
+
+    def model_insert_constraint(self, index, constraint):
+        self.constraints.insert(index, list(constraint))
+        self.record(("model_delete_constraint", (index,)), ("model_insert_constraint", (index, self.constraints[index])))
+        self.notify("constraints", "insert", index)
+
+    def model_delete_constraint(self, index):
+        constraint = self.constraints.pop(index)
+        self.record(("model_insert_constraint", (index, constraint)), ("model_delete_constraint", (index,)))
+        self.notify("constraints", "delete", index, None, constraint)
+
+    def model_set_constraint(self, index, constraint):
+        old_constraint = self.constraints[index]
+        self.constraints[index] = list(constraint)
+        self.record(("model_set_constraint", (index, old_constraint)), ("model_set_constraint", (index, self.constraints[index])))
+        self.notify("constraints", "update", index, None, old_constraint)
+
+    # -- Undo/Redo --
+    # Each history entry is a list of (undo, redo) operations, where an operation is a model_* method name
+    # and its arguments. Operations hold references to the (never mutated) weight and restriction lists
+    # they replaced, so history grows with the size of the edits rather than the size of the design.
+    def clear_history(self):
+        self.undo_stack = []
+        self.redo_stack = []
+        self.history_group = None
+        self.replaying = False
+
+    def record(self, undo_op, redo_op):
+        if self.replaying:
+            return
+        if self.history_group != None:
+            self.history_group.append((undo_op, redo_op))
+            return
+        self.undo_stack.append([(undo_op, redo_op)])
+        if len(self.undo_stack) > self.options["history_limit"]:
+            self.undo_stack.pop(0)
+        self.redo_stack = []
+
+    # Group several model edits into one undo step
+    def begin_history_group(self):
+        self.history_group = []
+
+    def end_history_group(self):
+        group = self.history_group
+        self.history_group = None
+        if group:
+            self.undo_stack.append(group)
+            if len(self.undo_stack) > self.options["history_limit"]:
+                self.undo_stack.pop(0)
+            self.redo_stack = []
+
+    def replay(self, ops):
+        self.replaying = True
+        try:
+            for op in ops:
+                getattr(self, op[0])(*op[1])
+        finally:
+            self.replaying = False
+
+    # Undo/redo are disabled while a modal dialog (e.g. the weight editor) holds the grab
+    def undo(self, event=None):
+        if len(self.undo_stack) > 0 and self.myParent.grab_current() == None:
+            entry = self.undo_stack.pop()
+            self.replay([pair[0] for pair in reversed(entry)])
+            self.redo_stack.append(entry)
+
+    def redo(self, event=None):
+        if len(self.redo_stack) > 0 and self.myParent.grab_current() == None:
+            entry = self.redo_stack.pop()
+            self.replay([pair[1] for pair in entry])
+            self.undo_stack.append(entry)
+
+    # -- Model change notifications --
+    # part is one of "attributes", "levels", "restrictions", "constraints", "weights", "conditional" or "reset" (whole design replaced)
+    # Callbacks are called as callback(action, index, attr, old) where action is "insert", "delete", "update" or "reset"
+    # and old is the value that was deleted or overwritten (the levels of a deleted attribute, the old name on a rename)
+    def subscribe(self, part, callback):
+        if callback not in self.listeners.setdefault(part, []):
+            self.listeners[part].append(callback)
+
+    def unsubscribe(self, part, callback):
+        if callback in self.listeners.get(part, []):
+            self.listeners[part].remove(callback)
+
+    def notify(self, part, action, index=None, attr=None, old=None):
+        for callback in list(self.listeners.get(part, [])):
+            callback(action, index, attr, old)
+
+    def attributes_changed(self, action, index, attr, old=None):
+        self.box_attributes.model_changed(action, index)
+        if self.search_var.get() != "":
+            self.box_attributes.set_filter(self.filter_attributes(self.search_var.get()))
+        if action == "insert" and self.activeAttribute == None:
+            self.activeAttribute = attr
+            self.update_listbox_levels()
+        elif action == "delete" and self.activeAttribute not in self.level_dict:
+            if len(self.attribute_list) > 0:
+                self.activeAttribute = self.attribute_list[0]
+            else:
+                self.activeAttribute = None
             self.update_listbox_levels()
-            self.update_listbox_attributes()
+        elif action == "update" and attr == self.activeAttribute:
+            self.update_levels_label()
+
+    def levels_changed(self, action, index, attr, old=None):
+        if attr == self.activeAttribute:
+            self.box_levels.model_changed(action, index)
+            if self.search_var.get() != "":
+                self.box_levels.set_filter(self.filter_levels(attr, self.search_var.get()))
+        if self.search_var.get() != "" and action != "update":
+            self.box_attributes.set_filter(self.filter_attributes(self.search_var.get()))
+
+    # -- Search --
+    # self.search_index holds attribute names ("attribute", attr), level names ("level", attr, level)
+    # and restrictions ("restriction", pairs) and is kept in step by the model notifications
+    def rebuild_search_index(self, *args):
+        self.search_index.clear()
+        self.search_rows = None
+        for attr in self.attribute_list:
+            self.index_attribute(attr, self.level_dict.get(attr, []))
+        for restriction in self.restrictions:
+            self.search_index.add(restriction_key(restriction), restriction_search_text(restriction))
+
+    def index_attribute(self, attr, levels, remove=False):
+        if remove:
+            self.search_index.remove(("attribute", attr))
+            for level in levels:
+                self.search_index.remove(("level", attr, level))
+        else:
+            self.search_index.add(("attribute", attr), attr)
+            for level in levels:
+                self.search_index.add(("level", attr, level), level)
+
+    def search_attributes_changed(self, action, index, attr, old=None):
+        self.search_rows = None
+        if action == "insert":
+            self.index_attribute(attr, self.level_dict[attr])
+        elif action == "delete":
+            self.index_attribute(attr, old, remove=True)
+        elif action == "update" and old != attr:
+            self.index_attribute(old, self.level_dict[attr], remove=True)
+            self.index_attribute(attr, self.level_dict[attr])
+
+    def search_levels_changed(self, action, index, attr, old=None):
+        self.search_rows = None
+        if action in ("delete", "update"):
+            self.search_index.remove(("level", attr, old))
+        if action in ("insert", "update"):
+            level = self.level_dict[attr][index]
+            self.search_index.add(("level", attr, level), level)
+
+    def search_restrictions_changed(self, action, index, attr, old=None):
+        self.search_rows = None
+        if action in ("delete", "update"):
+            self.search_index.remove(restriction_key(old))
+        if action in ("insert", "update"):
+            self.search_index.add(restriction_key(self.restrictions[index]), restriction_search_text(self.restrictions[index]))
+
+    # Row positions of the indexed keys, so a search costs as much as its matches rather than the design:
+    # {("attribute", attr): [i]}, {("level", attr, level): [k, ...]} and {restriction key: [i, ...]}
+    # (a key can occur more than once). They are rebuilt after an edit, on the next search
+    def search_positions(self):
+        if self.search_rows == None:
+            rows = {}
+            for i, attr in enumerate(self.attribute_list):
+                rows.setdefault(("attribute", attr), []).append(i)
+                for k, level in enumerate(self.level_dict.get(attr, [])):
+                    rows.setdefault(("level", attr, level), []).append(k)
+            for i, restriction in enumerate(self.restrictions):
+                rows.setdefault(restriction_key(restriction), []).append(i)
+            self.search_rows = rows
+        return self.search_rows
+
+    # Indices of attributes whose names match query
+    def filter_attribute_names(self, query):
+        if query == "":
+            return range(len(self.attribute_list))
+        rows = self.search_positions()
+        return sorted(i for key in self.search_index.search(query) if key[0] == "attribute" for i in rows.get(key, ()))
+
+    # Indices of attributes that match query by name or through one of their levels (None = no filter)
+    def filter_attributes(self, query):
+        if query == "":
+            return None
+        rows = self.search_positions()
+        hits = set(key[1] for key in self.search_index.search(query) if key[0] in ("attribute", "level"))
+        return sorted(i for attr in hits for i in rows.get(("attribute", attr), ()))
+
+    # Indices of the levels of attr that match query. If the attribute name itself matches
+    # (and by_attribute is set), all of its levels are shown (None = no filter)
+    def filter_levels(self, attr, query, by_attribute=True):
+        if query == "" or attr not in self.level_dict:
+            return None
+        matches = self.search_index.search(query)
+        if by_attribute and ("attribute", attr) in matches:
+            return None
+        rows = self.search_positions()
+        return sorted(k for key in matches if key[0] == "level" and key[1] == attr for k in rows.get(key, ()))
+
+    def filter_restrictions(self, query):
+        if query == "":
+            return None
+        rows = self.search_positions()
+        return sorted(i for key in self.search_index.search(query) if key[0] == "restriction" for i in rows.get(key, ()))
+
+    def apply_main_filter(self, *args):
+        query = self.search_var.get()
+        self.box_attributes.set_filter(self.filter_attributes(query))
+        self.box_levels.set_filter(self.filter_levels(self.activeAttribute, query))
         
     # -- List Box Functions
     
@@ -1133,21 +2098,23 @@ class conjointGUI:
         
         item = map(int, self.box_attributes.curselection())
 
-        
         if len(item) > 0:
             self.activeAttribute = self.attribute_list[item[0]]
-            if self.activeAttribute != None:
-                    self.levels_label.config(text="Levels - " + self.activeAttribute)
-            self.box_levels.delete(0,END)
-            for i in self.level_dict[self.attribute_list[item[0]]]:
-                self.box_levels.insert(END,i)
+        self.update_levels_label()
+        self.box_levels.model_changed("reset")
+        if self.search_var.get() != "":
+            self.box_levels.set_filter(self.filter_levels(self.activeAttribute, self.search_var.get()))
+
+    def update_levels_label(self):
+        if self.activeAttribute != None:
+            self.levels_label.config(text="Levels - " + self.activeAttribute)
         else:
-            self.box_levels.delete(0,END)
-            if self.activeAttribute != None:
-                    self.levels_label.config(text="Levels - " + self.activeAttribute)
-            if self.activeAttribute != None:
-                for i in self.level_dict[self.activeAttribute]:
-                    self.box_levels.insert(END,i)
+            self.levels_label.config(text="Levels")
+
+    def active_level_count(self):
+        if self.activeAttribute in self.level_dict:
+            return len(self.level_dict[self.activeAttribute])
+        return 0
 
     # Clears all stored data (attributes, levels, etc...)
     def clear_all_data(self):
@@ -1157,6 +2124,7 @@ class conjointGUI:
         self.restrictions = []
         self.constraints = []
         self.probabilities = {}
+        self.conditional_weights = {}
         self.update_listbox_attributes()
         self.update_listbox_levels()
         self.randomize_resp_attr = IntVar()
@@ -1165,23 +2133,194 @@ class conjointGUI:
         self.weighted_randomize_attr.set(0)
         self.no_duplicate_profiles = IntVar()
         self.no_duplicate_profiles.set(0)
+        self.record_telemetry = IntVar()
+        self.record_telemetry.set(0)
+        self.retry_budget_num = StringVar()
+        self.retry_budget_num.set(str(default_settings["retry_budget"]))
+        self.lazy_tasks = IntVar()
+        self.lazy_tasks.set(0)
+        self.session_cache = IntVar()
+        self.session_cache.set(1)
+        self.order_once = IntVar()
+        self.order_once.set(0)
+        self.fit_marginals = IntVar()
+        self.fit_marginals.set(0)
+        self.fallback = IntVar()
+        self.fallback.set(1)
         self.task_num = StringVar()
         self.task_num.set("5")
         self.profile_num = StringVar()
         self.profile_num.set("2")
         
     # -- Listbox --
-    # Update the displayed attributes listbox using the attribute_list
+    # Redraw the attributes listbox after the whole attribute_list has been replaced
     def update_listbox_attributes(self):
-        self.box_attributes.delete(0,END)
-        for i in self.attribute_list:
-            self.box_attributes.insert(END, i)
+        self.clear_history()
+        self.box_attributes.model_changed("reset")
+        self.notify("reset", "reset")
+        self.box_attributes.set_filter(self.filter_attributes(self.search_var.get()))
         
     # Update the displayed levels listbox using the active_attribute
     def update_listbox_levels(self):
         self.update_levels("")
 
 # General Utility Functions
+
+# Hashable search key for a restriction (a list of (attribute, level) pairs)
+def restriction_key(restriction):
+    return ("restriction", tuple(tuple(pair) for pair in restriction))
+
+def restriction_search_text(restriction):
+    return "; ".join(str(pair[0]) + ": " + str(pair[1]) for pair in restriction)
+
+# Exact sum of a list of weights
+def weight_sum(weights):
+    sum_out = Fraction()
+    for w in weights:
+        sum_out = sum_out + Fraction(w)
+    return sum_out
+
+# Rescale a list of weights to sum to 1, keeping their relative sizes
+# If the weights sum to zero, every level gets an even share
+def normalize_weights(weights):
+    if len(weights) == 0:
+        return []
+    total = weight_sum(weights)
+    if total == 0:
+        return [1/len(weights)]*len(weights)
+    if total == 1:
+        return [float(w) for w in weights]
+    return [float(Fraction(w)/total) for w in weights]
+
+# A typed weight as an exact fraction. Strings ("1/3", "0.25") are parsed exactly; floats
+# are taken as the nearest short fraction, so the model's own weights (1/3 as a float) sum to 1
+def weight_fraction(value):
+    if isinstance(value, float):
+        return Fraction(value).limit_denominator()
+    return Fraction(str(value).strip())
+
+# Parse and validate a table of weights in one pass
+# weight_table maps attribute names to lists of weights (numbers or strings such as "1/3")
+# Sums are checked with exact rationals. Returns the weights as floats and a list of errors
+def validate_weight_table(weight_table, level_dict):
+    parsed = {}
+    errors = []
+    for attr in weight_table:
+        values = weight_table[attr]
+        if attr not in level_dict:
+            errors.append("Attribute " + str(attr) + " does not exist")
+            continue
+        if len(values) != len(level_dict[attr]):
+            errors.append(str(attr) + ": expected " + str(len(level_dict[attr])) + " weights, got " + str(len(values)))
+            continue
+        try:
+            fracs = [weight_fraction(v) for v in values]
+        except (ValueError, ZeroDivisionError, OverflowError):
+            errors.append(str(attr) + ": weights must be numbers or fractions")
+            continue
+        if any(f < 0 or f > 1 for f in fracs):
+            errors.append(str(attr) + ": weights must be between 0 and 1")
+            continue
+        total = sum(fracs, Fraction())
+        if total != 1:
+            errors.append(str(attr) + ": weights sum to " + str(total) + ", not 1")
+            continue
+        parsed[attr] = [float(f) for f in fracs]
+    return parsed, errors
+
+# A weight as a fraction when it has a short one (1/3), otherwise as a decimal
+def weight_text(weight):
+    frac = Fraction(weight).limit_denominator()
+    if frac.denominator >= 1000:
+        return str(weight)
+    return str(frac.numerator) + "/" + str(frac.denominator)
+
+# Split pasted text into weights, one per non-empty line
+# The last tab/comma separated value on each line is the weight
+def parse_weight_column(text):
+    weights = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line != "":
+            weights.append(re.split("[\t,;]", line)[-1].strip())
+    return weights
+
+# Read a weight table from a .csv file: attribute name followed by its weights in level order
+def read_weights_csv(filename):
+    weight_table = {}
+    with open(filename, "rt", newline="") as open_file:
+        for line in csv.reader(open_file):
+            if len(line) > 0 and line[0] != "":
+                weight_table[line[0]] = [w for w in line[1:] if w.strip() != ""]
+    return weight_table
+
+# -- Conditional weights --
+# design["conditional_weights"] maps an attribute to the weights of its levels given the levels of one or more
+# parent attributes: {attribute: {"parents": [parent names], "rows": {tuple of parent level names: [weights]}}}.
+# Combinations of parent levels without a row use the attribute's own weights.
+
+# Attributes in an order where every attribute comes after the parents it depends on
+# parents_of maps each attribute to its parents; parents without conditional weights of their own can be anywhere
+def conditional_order(parents_of):
+    order = []
+    placed = set()
+    remaining = list(parents_of)
+    while len(remaining) > 0:
+        ready = [child for child in remaining if all(parent in placed or parent not in parents_of for parent in parents_of[child])]
+        if len(ready) == 0:
+            raise ValueError("Conditional weights depend on each other in a cycle: " + ", ".join(str(child) for child in remaining))
+        order.extend(ready)
+        placed.update(ready)
+        remaining = [child for child in remaining if child not in placed]
+    return order
+
+# Split pasted or typed rows of a conditional weight table, one row per non-empty line: the levels of the
+# parents followed by the weights, separated by tabs. Lines starting with # are headers.
+def parse_conditional_rows(text, num_parents):
+    rows = {}
+    for line in text.splitlines():
+        if line.strip() == "" or line.lstrip().startswith("#"):
+            continue
+        fields = [field.strip() for field in line.split("\t")]
+        rows[tuple(fields[:num_parents])] = [w for w in fields[num_parents:] if w != ""]
+    return rows
+
+# Parse and validate the conditional weight table of child, checked the same way as validate_weight_table
+# rows maps tuples of parent level names to weights; conditional_weights holds the tables of the other attributes,
+# which together with this one must not depend on each other in a cycle. Returns the table and a list of errors
+def validate_conditional_weights(child, parents, rows, level_dict, conditional_weights):
+    errors = []
+    if child not in level_dict:
+        return None, ["Attribute " + str(child) + " does not exist"]
+    if len(parents) == 0:
+        errors.append(str(child) + ": choose at least one attribute for the weights to depend on")
+    for parent in parents:
+        if parent not in level_dict:
+            errors.append("Attribute " + str(parent) + " does not exist")
+        elif parent == child:
+            errors.append(str(child) + ": an attribute cannot depend on itself")
+    if len(set(parents)) != len(parents):
+        errors.append(str(child) + ": an attribute is listed twice")
+    if len(errors) > 0:
+        return None, errors
+    parents_of = {other: table["parents"] for other, table in conditional_weights.items() if other != child}
+    parents_of[child] = list(parents)
+    try:
+        conditional_order(parents_of)
+    except ValueError as error:
+        errors.append(str(error))
+    table = {"parents": list(parents), "rows": {}}
+    for levels, weights in rows.items():
+        label = " / ".join(levels)
+        if len(levels) != len(parents) or any(level not in level_dict[parent] for parent, level in zip(parents, levels)):
+            errors.append(label + ": not a combination of levels of " + ", ".join(parents))
+            continue
+        parsed, row_errors = validate_weight_table({child: weights}, level_dict)
+        errors.extend(label + " - " + error for error in row_errors)
+        if child in parsed:
+            table["rows"][tuple(levels)] = parsed[child]
+    return table, errors
+
 # Output design to the R package
 def R_out(filename, attributes, level_dict, restrictions, constraints, probabilities, random, profiles, tasks, randomize):
     
@@ -1217,8 +2356,108 @@ def R_out(filename, attributes, level_dict, restrictions, constraints, probabili
          out_file.write(restrict_string + "\n")    
      out_file.close()
     
+# Show an exporter error in a dialog; from the command line (no display) it is only printed
+def show_export_error(message):
+    print(message)
+    try:
+        messagebox.showerror(title="Error", message=message)
+    except (TclError, RuntimeError):
+        pass
+
+# Same for warnings, after which the export goes ahead. Warnings are also collected in
+# export_warnings so export_design can keep them with a cached export
+export_warnings = []
+
+def show_export_warning(message):
+    export_warnings.append(message)
+    print(message)
+    try:
+        messagebox.showwarning(title="Warning", message=message)
+    except (TclError, RuntimeError):
+        pass
+
+# Insert text into an export template just after (or before) a line that occurs once in it
+def splice_template(template, anchor, text, before=False):
+    if before:
+        return replace_template(template, anchor, text + anchor)
+    return replace_template(template, anchor, anchor + text)
+
+# Replace a piece of an export template that occurs once in it
+def replace_template(template, old, new):
+    if template.count(old) != 1:
+        raise ValueError("Template anchor not found: " + old.strip())
+    return template.replace(old, new)
+
+# Replace the part of an export template from the line start through the line end (each occurs once)
+def replace_template_block(template, start, end, new):
+    first = template.find(start)
+    last = template.find(end, first)
+    if template.count(start) != 1 or last < 0:
+        raise ValueError("Template anchor not found: " + start.strip())
+    return template[:first] + new + template[last + len(end):]
+
+# Embedded data keys of the attribute shown in row a (1-based) of task t: F-[t]-[a], or F-order-[a] when the
+# order is stored once per respondent (it is the same in every task)
+def attribute_key(t, a, order_once=False):
+    if order_once:
+        return "F-order-" + str(a)
+    return "F-" + str(t) + "-" + str(a)
+
+# A list of literals as a PHP (php=True) or JavaScript literal
+def code_list(items, php=False):
+    if php:
+        return "array(" + ",".join(items) + ")"
+    return "[" + ",".join(items) + "]"
+
+# fallback_units tables as a PHP (php=True) or JavaScript literal
+def fallback_units_code(units, php=False):
+    def as_list(items):
+        return code_list(items, php)
+    return as_list(as_list([as_list(str(j) for j in component), as_list(as_list(str(k) for k in combo) for combo in combos),
+                            "null" if weights == None else as_list(repr(w) for w in weights)]) for component, combos, weights in units)
+
+# Conditional weights as a PHP (php=True) or JavaScript literal, parents first: for each attribute with
+# conditional weights its name, the names of its parents and the alias table (probabilities, aliases) of each
+# row, in conditional_row order
+def conditional_code(compiled, php=False):
+    def as_list(items):
+        return code_list(items, php)
+    conditionals = sampling_conditionals(compiled)
+    entries = []
+    for j in compiled.draw_order:
+        if j in conditionals:
+            parents, rows = conditionals[j]
+            tables = [alias_table(row) for row in rows]
+            entries.append(as_list(['"' + compiled.attributes[j] + '"', as_list('"' + compiled.attributes[p] + '"' for p in parents),
+                                    as_list(as_list([as_list(repr(w) for w in prob), as_list(str(k) for k in alias)]) for prob, alias in tables)]))
+    return as_list(entries)
+
+# One line on how the fit of fit_weights went, for the exports and the fit command
+def fit_summary(fit):
+    text = "Weights fitted so the level shares after restrictions match the design weights: "
+    if fit["converged"]:
+        text = text + "converged after " + str(fit["iterations"]) + " sweeps"
+    else:
+        text = text + "did not converge after " + str(fit["iterations"]) + " sweeps"
+    text = text + ", largest difference " + "%.3g" % fit["max_error"]
+    if fit["sampled"]:
+        text = text + " (on a sample of the allowed profiles)"
+    return text
+
+# Telemetry fields added to the embedded data of the PHP and JavaScript randomizers:
+#   F-time-ms - milliseconds spent generating the respondent's profiles
+#   F-retries - draws rejected (restrictions or duplicates) over all profiles
+#   F-max-retries - largest number of draws rejected for a single profile
+telemetry_fields = ["F-time-ms", "F-retries", "F-max-retries"]
+
 # Output results to a qualtrics-compatible php file
-def qualtrics_out(filename, attributes, level_dict, restrictions, constraints, probabilities, random, profiles, tasks, randomize, noDuplicates):
+# telemetry = True also records the telemetry_fields
+# Profiles not found within retry_budget draws are drawn from the fallback_units tables instead, when the design
+# needs them and fallback = True; otherwise they are counted in F-fallback-failed and drawn again
+# order_once = True stores the attribute order once per respondent (F-order-[attribute number])
+# With weighted randomization, attributes with conditional_weights are drawn again from the row for their parents' levels,
+# and fit_marginals = True writes the weights fitted by fit_weights instead of the design weights
+def qualtrics_out(filename, attributes, level_dict, restrictions, constraints, probabilities, random, profiles, tasks, randomize, noDuplicates, telemetry=False, retry_budget=1000, order_once=False, conditional_weights=None, fit_marginals=False, fallback=True):
     
     temp_1 = """<?php
 // Code to randomly generate conjoint profiles to send to a Qualtrics instance
@@ -1260,6 +2499,85 @@ function weighted_randomize($prob_array, $at_key)
 }
                     """
                     
+    temp_fallback = """// Draw an index from a list of weights (null for equal weights)
+function fallback_pick($weights, $count)
+{
+	if ($weights === null){
+		return mt_rand(0, $count - 1);
+	}
+	$unif_rand = (mt_rand() / mt_getrandmax()) * array_sum($weights);
+	for ($w = 0; $w < count($weights); $w++){
+		$unif_rand = $unif_rand - $weights[$w];
+		if ($unif_rand < 0){
+			return $w;
+		}
+	}
+	return count($weights) - 1;
+}
+
+// Draw a profile from the allowed combinations of each group of attributes. If duplicates are not allowed
+// and it matches a previous profile, step through the allowed profiles in order until one is new; the
+// exporter checked that there are enough of them, so this always ends.
+function fallback_profile($fallbackunits, $featurearray, $previous, $noDuplicateProfiles)
+{
+	$names = array_keys($featurearray);
+	$choice = array();
+	foreach ($fallbackunits as $unit){
+		array_push($choice, fallback_pick($unit[2], count($unit[1])));
+	}
+	while (True){
+		$profile = array();
+		for ($u = 0; $u < count($fallbackunits); $u++){
+			$combo = $fallbackunits[$u][1][$choice[$u]];
+			for ($a = 0; $a < count($combo); $a++){
+				$attribute = $names[$fallbackunits[$u][0][$a]];
+				$profile[$attribute] = $featurearray[$attribute][$combo[$a]];
+			}
+		}
+		$used = False;
+		if ($noDuplicateProfiles == True){
+			foreach ($previous as $previous_dict){
+				$identical = True;
+				foreach ($profile as $attribute => $level){
+					if ($previous_dict[$attribute] != $level){
+						$identical = False;
+					}
+				}
+				if ($identical == True){
+					$used = True;
+				}
+			}
+		}
+		if ($used == False){
+			return $profile;
+		}
+		// Next allowed profile
+		for ($u = 0; $u < count($fallbackunits); $u++){
+			$choice[$u] = $choice[$u] + 1;
+			if ($choice[$u] < count($fallbackunits[$u][1])){
+				break;
+			}
+			$choice[$u] = 0;
+		}
+	}
+}
+
+"""
+
+    temp_conditional = """// Draw a level index from one row of conditional weights (a Walker alias table)
+function conditional_draw($table)
+{
+	$count = count($table[0]);
+	$u = (mt_rand() / mt_getrandmax()) * $count;
+	$k = min((int)floor($u), $count - 1);
+	if ($u - $k < $table[0][$k]){
+		return $k;
+	}
+	return $table[1][$k];
+}
+
+"""
+
     temp_2_star = """// Place the $featurearray keys into a new array
 $featureArrayKeys = array();
 $incr = 0;
@@ -1338,16 +2656,21 @@ foreach($featureArrayKeys as $key){
 
 $returnarray = array();
 
+// Number of profiles drawn by the fallback
+$fallbacks = 0;
+
 // For each task $p
 for($p = 1; $p <= $K; $p++){
 
 	// For each profile $i
 	for($i = 1; $i <= $N; $i++){
 
-		// Repeat until non-restricted profile generated
+		// Repeat until non-restricted profile generated, or until the retry budget is used up
 		$complete = False;
+		$tries = 0;
 
 		while ($complete == False){
+			$tries = $tries + 1;
 
 			// Create a count for $attributes to be incremented in the next loop
 			$attr = 0;
@@ -1392,6 +2715,27 @@ for($p = 1; $p <= $K; $p++){
 
 			}
 
+			// Past the retry budget, draw the profile from the feasible combinations instead
+			if ($tries > $retry_budget){
+				$previous = array();
+				for($z = 1; $z < $i; $z++){
+					$previous_dict = array();
+					$attrTemp = 0;
+					foreach($featureArrayNew as $attribute => $levels){
+						$attrTemp = $attrTemp + 1;
+						$previous_dict[$attribute] = $returnarray["F-" . (string)$p . "-" . (string)$z . "-" . (string)$attrTemp];
+					}
+					array_push($previous, $previous_dict);
+				}
+				$profile_dict = fallback_profile($fallbackunits, $featurearray, $previous, $noDuplicateProfiles);
+				$attrTemp = 0;
+				foreach($featureArrayNew as $attribute => $levels){
+					$attrTemp = $attrTemp + 1;
+					$returnarray["F-" . (string)$p . "-" . (string)$i . "-" . (string)$attrTemp] = $profile_dict[$attribute];
+				}
+				$fallbacks = $fallbacks + 1;
+			}
+
 			$clear = True;
 			// Cycle through restrictions to confirm/reject profile
 			if(count($restrictionarray) != 0){
@@ -1453,11 +2797,29 @@ for($p = 1; $p <= $K; $p++){
 
 }
 
+// Flag respondents with profiles drawn by the fallback
+$returnarray["F-fallback"] = $fallbacks;
+
 // Return the array back to Qualtrics
 print  json_encode($returnarray);
 ?>
 """
-    # Drop attributes that don't have any levels
+    # One set of attribute name fields per respondent
+    if order_once:
+        temp_3 = replace_template(temp_3, '$attr_key = "F-" . (string)$p . "-" . (string)$attr;', '$attr_key = "F-order-" . (string)$attr;')
+
+    # Count the draws of each profile and time the script
+    if telemetry:
+        temp_3 = splice_template(temp_3, "$returnarray = array();\n", "\n// Telemetry: rejected draws over all profiles and for the worst profile\n$retries = 0;\n$max_retries = 0;\n")
+        temp_3 = splice_template(temp_3, "\t\t\t$complete = $clear;\n\t\t}\n", "\t\t$retries = $retries + $tries - 1;\n\t\t$max_retries = max($max_retries, $tries - 1);\n")
+        temp_3 = splice_template(temp_3, "// Flag respondents with profiles drawn by the fallback\n", """// Store the telemetry with the profiles
+$returnarray["F-time-ms"] = round((microtime(true) - $telemetry_start)*1000, 3);
+$returnarray["F-retries"] = $retries;
+$returnarray["F-max-retries"] = $max_retries;
+
+""", before=True)
+
+    # Drop attributes that don't have any levels
     attrout = []
     contin = True
     for i in range(len(attributes)):
@@ -1467,9 +2829,55 @@ print  json_encode($returnarray);
             contin = False
             print("Error: Attribute " + attributes[i] + " has no associated levels")
     if contin == False:
-        messagebox.showerror(title="Error",message="Error: Cannot export to PHP. Some attributes have no levels.")
+        show_export_error("Error: Cannot export to PHP. Some attributes have no levels.")
         return 
     
+    # Refuse designs that cannot fill a task, and build the fallback tables if the design needs them
+    try:
+        compiled = compiledDesign({"attributes": attrout, "level_dict": level_dict, "restrictions": restrictions, "constraints": constraints, "probabilities": probabilities,
+                                   "tasks": tasks, "profiles": profiles, "weighted": random, "no_duplicates": int(noDuplicates), "conditional_weights": conditional_weights or {},
+                                   "fit_marginals": int(fit_marginals)})
+        units, needed = fallback_units(compiled, retry_budget, enabled=fallback)
+    except ValueError as error:
+        show_export_error("Error: Cannot export to PHP. " + str(error) + ".")
+        return
+    
+    # Draw the attributes with conditional weights from their parents' levels
+    conditional = len(sampling_conditionals(compiled)) > 0
+    if conditional:
+        temp_3 = splice_template(temp_3, "\t\t\t// Past the retry budget, draw the profile from the feasible combinations instead\n", """\t\t\t// Draw the attributes with conditional weights again, from the row for their parents' levels
+\t\t\tforeach($conditionalarray as $conditional){
+\t\t\t\t$row = 0;
+\t\t\t\tforeach($conditional[1] as $parent){
+\t\t\t\t\t$row = $row*count($featurearray[$parent]) + array_search($profile_dict[$parent], $featurearray[$parent], true);
+\t\t\t\t}
+\t\t\t\t$chosen_level = $featurearray[$conditional[0]][conditional_draw($conditional[2][$row])];
+\t\t\t\t$profile_dict[$conditional[0]] = $chosen_level;
+\t\t\t\t$returnarray["F-" . (string)$p . "-" . (string)$i . "-" . (string)(array_search($conditional[0], array_keys($featureArrayNew)) + 1)] = $chosen_level;
+\t\t\t}
+
+""", before=True)
+    
+    # Conditional weight rows that no longer match the design fall back to the attribute's own weights
+    if compiled.conditional_dropped > 0 and random == 1:
+        show_export_warning("Warning: " + str(compiled.conditional_dropped) + " rows of conditional weights name levels or attributes that no longer exist or have the wrong number of weights. They were left out, so those combinations use the attribute's own weights.")
+
+    # Write the weights fitted to the restrictions instead of the design weights
+    if compiled.fit != None:
+        probabilities = {attr: list(weights) for attr, weights in zip(compiled.attributes, compiled.fit["weights"])}
+        if not compiled.fit["converged"]:
+            show_export_warning("Warning: " + fit_summary(compiled.fit) + ".")
+
+    # Without fallback tables, profiles past the retry budget are counted and drawn again
+    if units == None:
+        if needed and fallback:
+            show_export_warning("Warning: The restrictions link too many levels to include the fallback tables, so profiles that use up the retry budget are drawn again and counted in F-fallback-failed.")
+        temp_3 = replace_template_block(temp_3, "\t\t\t// Past the retry budget, draw the profile from the feasible combinations instead\n", "\t\t\t\t$fallbacks = $fallbacks + 1;\n\t\t\t}\n",
+                                        "\t\t\t// Past the retry budget, count the profile once and keep drawing\n\t\t\tif ($tries == $retry_budget + 1){\n\t\t\t\t$fallbacks = $fallbacks + 1;\n\t\t\t}\n")
+        temp_3 = replace_template(temp_3, "// Number of profiles drawn by the fallback\n", "// Number of profiles that used up the retry budget\n")
+        temp_3 = replace_template(temp_3, "// Flag respondents with profiles drawn by the fallback\n", "// Flag respondents with profiles that used up the retry budget\n")
+        temp_3 = replace_template(temp_3, '$returnarray["F-fallback"] = $fallbacks;\n', '$returnarray["F-fallback-failed"] = $fallbacks;\n')
+    
     # Drop any Null constraints
     constrai = []
     for c in constraints:
@@ -1481,6 +2889,8 @@ print  json_encode($returnarray);
     out_file = open(filename,"w", encoding="utf-8")
     out_file.write(temp_1)
     out_file.write("\n\n")
+    if telemetry:
+        out_file.write("// Start of the telemetry timer\n$telemetry_start = microtime(true);\n\n")
     arrayString = "$featurearray = array("
     for i in range(len(attrout)):
         attr = attrout[i]
@@ -1527,6 +2937,8 @@ print  json_encode($returnarray);
     
     out_file.write(restrictionString)    
     
+    if compiled.fit != None:
+        out_file.write("// " + fit_summary(compiled.fit) + "\n")
     if random == 1:
         probString = "$probabilityarray = array("
         for i in range(len(attrout)):
@@ -1565,6 +2977,19 @@ print  json_encode($returnarray);
         out_file.write("$noDuplicateProfiles = True;\n\n")
     else:
         out_file.write("$noDuplicateProfiles = False;\n\n")
+    if units != None:
+        out_file.write("// Draws per profile before switching to the fallback\n")
+    else:
+        out_file.write("// Draws per profile before it is counted in F-fallback-failed\n")
+    out_file.write("$retry_budget = " + str(retry_budget) + ";\n\n")
+    if units != None:
+        out_file.write("// Fallback: for each group of attributes linked by restrictions, the attribute indices, the allowed level index combinations and their weights\n")
+        out_file.write("$fallbackunits = " + fallback_units_code(units, php=True) + ";\n\n")
+        out_file.write(temp_fallback)
+    if conditional:
+        out_file.write("// Conditional weights: for each attribute drawn from its parents' levels (parents first), the attribute, its parents and the alias table (probabilities, aliases) of each combination of their levels\n")
+        out_file.write("$conditionalarray = " + conditional_code(compiled, php=True) + ";\n\n")
+        out_file.write(temp_conditional)
     
 
     if randomize == 1:
@@ -1602,7 +3027,18 @@ print  json_encode($returnarray);
     out_file.close()
     
 # Output results to a qualtrics-compatible javascript file
-def qualtrics_out_js(filename, attributes, level_dict, restrictions, constraints, probabilities, random, profiles, tasks, randomize, noDuplicates):
+# telemetry = True also records the telemetry_fields
+# Profiles not found within retry_budget draws are drawn from the fallback_units tables instead, when the design
+# needs them and fallback = True; otherwise they are counted in F-fallback-failed and drawn again
+# lazy = True writes a script for every page up to the last task instead of one page before the tasks:
+# the first page draws a seed, and each page generates the next task from a random stream that depends
+# only on the seed and the task, so the profiles are the same as generating every task at once
+# session_cache = True keeps the profiles (the seed when lazy) of a respondent who reloads the page or goes
+# back, checked against a hash of the design so a changed design is generated again
+# order_once = True stores the attribute order once per respondent (F-order-[attribute number])
+# With weighted randomization, attributes with conditional_weights are drawn again from the row for their parents' levels,
+# and fit_marginals = True writes the weights fitted by fit_weights instead of the design weights
+def qualtrics_out_js(filename, attributes, level_dict, restrictions, constraints, probabilities, random, profiles, tasks, randomize, noDuplicates, telemetry=False, retry_budget=1000, lazy=False, session_cache=False, order_once=False, conditional_weights=None, fit_marginals=False, fallback=True):
     
     temp_1 = """// Code to randomly generate conjoint profiles in a Qualtrics survey
 
@@ -1654,6 +3090,151 @@ function weighted_randomize(prob_array, at_key)
 }
                     """
                     
+    temp_fallback = """// Draw an index from a list of weights (null for equal weights)
+function fallback_pick(weights, count)
+{
+	if (weights === null){
+		return Math.floor(Math.random() * count);
+	}
+	var total = 0.0;
+	for (var w = 0; w < weights.length; w++){
+		total = total + weights[w];
+	}
+	var unif_rand = Math.random() * total;
+	for (var w = 0; w < weights.length; w++){
+		unif_rand = unif_rand - weights[w];
+		if (unif_rand < 0){
+			return w;
+		}
+	}
+	return weights.length - 1;
+}
+
+// Draw a profile from the allowed combinations of each group of attributes. If duplicates are not allowed
+// and it matches a previous profile, step through the allowed profiles in order until one is new; the
+// exporter checked that there are enough of them, so this always ends.
+function fallback_profile(previous)
+{
+	var names = Object.keys(featurearray);
+	var choice = [];
+	for (var u = 0; u < fallbackunits.length; u++){
+		choice.push(fallback_pick(fallbackunits[u][2], fallbackunits[u][1].length));
+	}
+	while (true){
+		var profile = {};
+		for (var u = 0; u < fallbackunits.length; u++){
+			var combo = fallbackunits[u][1][choice[u]];
+			for (var a = 0; a < combo.length; a++){
+				var attribute = names[fallbackunits[u][0][a]];
+				profile[attribute] = featurearray[attribute][combo[a]];
+			}
+		}
+		var used = false;
+		if (noDuplicateProfiles == true){
+			for (var z = 0; z < previous.length; z++){
+				var identical = true;
+				for (var attribute in profile){
+					if (previous[z][attribute] != profile[attribute]){
+						identical = false;
+					}
+				}
+				if (identical == true){
+					used = true;
+				}
+			}
+		}
+		if (used == false){
+			return profile;
+		}
+		// Next allowed profile
+		for (var u = 0; u < fallbackunits.length; u++){
+			choice[u] = choice[u] + 1;
+			if (choice[u] < fallbackunits[u][1].length){
+				break;
+			}
+			choice[u] = 0;
+		}
+	}
+}
+
+"""
+
+    temp_conditional = """// Draw a level index from one row of conditional weights (a Walker alias table)
+function conditional_draw(table)
+{
+	var u = Math.random() * table[0].length;
+	var k = Math.floor(u);
+	if (u - k < table[0][k]){
+		return k;
+	}
+	return table[1][k];
+}
+
+"""
+
+    temp_session = """// Profiles already generated for this respondent: the F-design field is set once the page that
+// generated them was submitted, and the browser's session storage keeps a copy in case the page is
+// reloaded before that. Both are only used if they come from this design.
+var design_hash = "DESIGN_HASH";
+var session_key = "conjointSDT-" + design_hash;
+var stored_design = null;
+try {
+	stored_design = JSON.parse(window.sessionStorage.getItem(session_key));
+} catch (error) {
+	stored_design = null;
+}
+var already_generated = ("${e://Field/F-design}" == design_hash) || (stored_design !== null);
+
+// The copy is removed when the page is submitted, since the embedded data keeps the profiles from then on,
+// so a later response in the same browser tab does not pick it up
+Qualtrics.SurveyEngine.addOnPageSubmit(function(){
+	try {
+		window.sessionStorage.removeItem(session_key);
+	} catch (error) {
+	}
+});
+
+"""
+
+    temp_lazy = """// Seeded random numbers for lazy generation (xmur3 hash of the text as the state of mulberry32)
+function seeded_stream(text){
+	var h = 1779033703 ^ text.length;
+	for (var c = 0; c < text.length; c++){
+		h = Math.imul(h ^ text.charCodeAt(c), 3432918353);
+		h = (h << 13) | (h >>> 19);
+	}
+	h = Math.imul(h ^ (h >>> 16), 2246822507);
+	h = Math.imul(h ^ (h >>> 13), 3266489909);
+	var state = (h ^ (h >>> 16)) >>> 0;
+	return function(){
+		state = (state + 0x6D2B79F5) | 0;
+		var t = Math.imul(state ^ (state >>> 15), 1 | state);
+		t = (t + Math.imul(t ^ (t >>> 7), 61 | t)) ^ t;
+		return ((t ^ (t >>> 14)) >>> 0) / 4294967296;
+	};
+}
+
+var conjoint_stream = Math.random;
+function conjoint_random(){
+	return conjoint_stream();
+}
+
+// The seed and the number of tasks already generated come from the earlier pages (empty on the first page)
+var conjoint_seed = "${e://Field/F-seed}";
+var lazy_task = parseInt("${e://Field/F-tasks-ready}") + 1;
+if (conjoint_seed == ""){
+	conjoint_seed = String(Math.floor(Math.random() * 4294967296));
+	lazy_task = 1;
+}
+if (isNaN(lazy_task)){
+	lazy_task = 1;
+}
+
+// The attribute order depends on the seed alone
+conjoint_stream = seeded_stream(conjoint_seed + "-order");
+
+"""
+
     temp_2_star = """// Place the $featurearray keys into a new array
 var featureArrayKeys = Object.keys(featurearray);"""
 
@@ -1715,16 +3296,21 @@ for (var h = 0; h < featureArrayKeys.length; h++){
 
 var returnarray = {};
 
+// Number of profiles drawn by the fallback
+var fallbacks = 0;
+
 // For each task $p
 for(var p = 1; p <= K; p++){
 
 	// For each profile $i
 	for(var i = 1; i <= N; i++){
 
-		// Repeat until non-restricted profile generated
+		// Repeat until non-restricted profile generated, or until the retry budget is used up
 		var complete = false;
+		var tries = 0;
 
 		while (complete == false){
+			tries = tries + 1;
 
 			// Create a count for $attributes to be incremented in the next loop
 			var attr = 0;
@@ -1771,6 +3357,23 @@ for(var p = 1; p <= K; p++){
 
 			}
 
+			// Past the retry budget, draw the profile from the feasible combinations instead
+			if (tries > retry_budget){
+				var previous = [];
+				for (var z = 1; z < i; z++){
+					var previous_dict = {};
+					for (var q = 0; q < featureArrayKeys.length; q++){
+						previous_dict[featureArrayKeys[q]] = returnarray["F-" + p + "-" + z + "-" + (q + 1)];
+					}
+					previous.push(previous_dict);
+				}
+				profile_dict = fallback_profile(previous);
+				for (var q = 0; q < featureArrayKeys.length; q++){
+					returnarray["F-" + p + "-" + i + "-" + (q + 1)] = profile_dict[featureArrayKeys[q]];
+				}
+				fallbacks = fallbacks + 1;
+			}
+
             var clear = true;
             
             // Cycle through restrictions to confirm/reject profile
@@ -1830,6 +3433,9 @@ for(var p = 1; p <= K; p++){
     }
 }
                             
+// Flag respondents with profiles drawn by the fallback
+returnarray["F-fallback"] = fallbacks;
+
 // Write returnarray to Qualtrics
 
 var returnarrayKeys = Object.keys(returnarray);
@@ -1841,6 +3447,65 @@ for (var pr = 0; pr < returnarrayKeys.length; pr++){
 
 
 """
+    # One set of attribute name fields per respondent
+    if order_once:
+        temp_3 = replace_template(temp_3, 'var attr_key = "F-" + p + "-" + attr;', 'var attr_key = "F-order-" + attr;')
+
+    # Count the draws of each profile and time the script
+    if telemetry:
+        elapsed = "telemetry_now() - telemetry_start"
+        if lazy:
+            # Lazy pages add to the telemetry of the earlier pages
+            elapsed = '(parseFloat("${e://Field/F-time-ms}") || 0) + ' + elapsed
+        temp_3 = splice_template(temp_3, "var returnarray = {};\n", "\n// Telemetry: rejected draws over all profiles and for the worst profile\nvar retries = 0;\nvar max_retries = 0;\n")
+        temp_3 = splice_template(temp_3, "            complete = clear;\n        }\n", "        retries = retries + tries - 1;\n        max_retries = Math.max(max_retries, tries - 1);\n")
+        temp_3 = splice_template(temp_3, "// Flag respondents with profiles drawn by the fallback\n", """// Store the telemetry with the profiles
+returnarray["F-time-ms"] = Math.round((""" + elapsed + """)*1000)/1000;
+returnarray["F-retries"] = retries;
+returnarray["F-max-retries"] = max_retries;
+
+""", before=True)
+        if lazy:
+            temp_3 = splice_template(temp_3, "var max_retries = 0;\n", 'retries = parseInt("${e://Field/F-retries}") || 0;\nmax_retries = parseInt("${e://Field/F-max-retries}") || 0;\n')
+
+    # Reuse the stored profiles instead of generating new ones; lazy scripts only need the stored seed
+    if session_cache and lazy:
+        temp_lazy = splice_template(temp_lazy, 'if (conjoint_seed == ""){\n', 'if (conjoint_seed == "" && stored_design !== null){\n\tconjoint_seed = String(stored_design["F-seed"]);\n}\n', before=True)
+        temp_lazy = splice_template(temp_lazy, "// The attribute order depends on the seed alone\n", """try {
+	window.sessionStorage.setItem(session_key, JSON.stringify({"F-seed": conjoint_seed}));
+} catch (error) {
+}
+
+""", before=True)
+    elif session_cache:
+        temp_3 = splice_template(temp_3, "// Write returnarray to Qualtrics\n", """// Keep a copy for a reload of this page
+returnarray["F-design"] = design_hash;
+try {
+	window.sessionStorage.setItem(session_key, JSON.stringify(returnarray));
+} catch (error) {
+}
+}
+else {
+	// Write the stored copy again (nothing to write if the fields were already saved)
+	var returnarray = (stored_design !== null) ? stored_design : {};
+}
+
+""", before=True)
+
+    # Generate only the next task, from its own random stream
+    if lazy:
+        temp_1 = temp_1.replace("Math.random()", "conjoint_random()")
+        temp_fallback = temp_fallback.replace("Math.random()", "conjoint_random()")
+        temp_conditional = temp_conditional.replace("Math.random()", "conjoint_random()")
+        temp_3 = temp_3.replace("Math.random()", "conjoint_random()")
+        temp_3 = splice_template(temp_3, "for(var p = 1; p <= K; p++){\n", "\tif (p != lazy_task){\n\t\tcontinue;\n\t}\n\tconjoint_stream = seeded_stream(conjoint_seed + \"-task-\" + p);\n")
+        temp_3 = splice_template(temp_3, "var fallbacks = 0;\n", 'fallbacks = parseInt("${e://Field/F-fallback}") || 0;\n')
+        temp_3 = splice_template(temp_3, "// Flag respondents with profiles drawn by the fallback\n", """// Keep the seed and the number of tasks generated for the next page
+returnarray["F-seed"] = conjoint_seed;
+returnarray["F-tasks-ready"] = Math.min(lazy_task, K);
+
+""", before=True)
+
     # Drop attributes that don't have any levels
     attrout = []
     contin = True
@@ -1851,9 +3516,60 @@ for (var pr = 0; pr < returnarrayKeys.length; pr++){
             contin = False
             print("Error: Attribute " + attributes[i] + " has no associated levels")
     if contin == False:
-        messagebox.showerror(title="Error",message="Error: Cannot export to JavaScript. Some attributes have no levels.")
+        show_export_error("Error: Cannot export to JavaScript. Some attributes have no levels.")
         return 
     
+    # Refuse designs that cannot fill a task, and build the fallback tables if the design needs them
+    design = {"attributes": attrout, "level_dict": level_dict, "restrictions": restrictions, "constraints": constraints, "probabilities": probabilities,
+              "tasks": tasks, "profiles": profiles, "weighted": random, "randomize": randomize, "no_duplicates": int(noDuplicates),
+              "telemetry": int(telemetry), "retry_budget": retry_budget, "lazy_tasks": int(lazy), "order_once": int(order_once),
+              "conditional_weights": conditional_weights or {}, "fit_marginals": int(fit_marginals)}
+    try:
+        compiled = compiledDesign(design)
+        units, needed = fallback_units(compiled, retry_budget, enabled=fallback)
+    except ValueError as error:
+        show_export_error("Error: Cannot export to JavaScript. " + str(error) + ".")
+        return
+    
+    # Draw the attributes with conditional weights from their parents' levels
+    conditional = len(sampling_conditionals(compiled)) > 0
+    if conditional:
+        temp_3 = splice_template(temp_3, "\t\t\t// Past the retry budget, draw the profile from the feasible combinations instead\n", """\t\t\t// Draw the attributes with conditional weights again, from the row for their parents' levels
+\t\t\tfor (var c = 0; c < conditionalarray.length; c++){
+\t\t\t\tvar cond_row = 0;
+\t\t\t\tfor (var pa = 0; pa < conditionalarray[c][1].length; pa++){
+\t\t\t\t\tvar parent_name = conditionalarray[c][1][pa];
+\t\t\t\t\tcond_row = cond_row*featurearray[parent_name].length + featurearray[parent_name].indexOf(profile_dict[parent_name]);
+\t\t\t\t}
+\t\t\t\tvar chosen_level = featurearray[conditionalarray[c][0]][conditional_draw(conditionalarray[c][2][cond_row])];
+\t\t\t\tprofile_dict[conditionalarray[c][0]] = chosen_level;
+\t\t\t\treturnarray["F-" + p + "-" + i + "-" + (featureArrayKeys.indexOf(conditionalarray[c][0]) + 1)] = chosen_level;
+\t\t\t}
+
+""", before=True)
+    
+    # Conditional weight rows that no longer match the design fall back to the attribute's own weights
+    if compiled.conditional_dropped > 0 and random == 1:
+        show_export_warning("Warning: " + str(compiled.conditional_dropped) + " rows of conditional weights name levels or attributes that no longer exist or have the wrong number of weights. They were left out, so those combinations use the attribute's own weights.")
+
+    # Write the weights fitted to the restrictions instead of the design weights
+    if compiled.fit != None:
+        probabilities = {attr: list(weights) for attr, weights in zip(compiled.attributes, compiled.fit["weights"])}
+        if not compiled.fit["converged"]:
+            show_export_warning("Warning: " + fit_summary(compiled.fit) + ".")
+
+    # Without fallback tables, profiles past the retry budget are counted and drawn again
+    if units == None:
+        if needed and fallback:
+            show_export_warning("Warning: The restrictions link too many levels to include the fallback tables, so profiles that use up the retry budget are drawn again and counted in F-fallback-failed.")
+        temp_3 = replace_template_block(temp_3, "\t\t\t// Past the retry budget, draw the profile from the feasible combinations instead\n", "\t\t\t\tfallbacks = fallbacks + 1;\n\t\t\t}\n",
+                                        "\t\t\t// Past the retry budget, count the profile once and keep drawing\n\t\t\tif (tries == retry_budget + 1){\n\t\t\t\tfallbacks = fallbacks + 1;\n\t\t\t}\n")
+        temp_3 = replace_template(temp_3, "// Number of profiles drawn by the fallback\n", "// Number of profiles that used up the retry budget\n")
+        temp_3 = replace_template(temp_3, "// Flag respondents with profiles drawn by the fallback\n", "// Flag respondents with profiles that used up the retry budget\n")
+        temp_3 = replace_template(temp_3, 'returnarray["F-fallback"] = fallbacks;\n', 'returnarray["F-fallback-failed"] = fallbacks;\n')
+        if lazy:
+            temp_3 = replace_template(temp_3, '"${e://Field/F-fallback}"', '"${e://Field/F-fallback-failed}"')
+    
     # Drop any Null constraints
     constrai = []
     for c in constraints:
@@ -1865,6 +3581,21 @@ for (var pr = 0; pr < returnarrayKeys.length; pr++){
     out_file = open(filename,"w", encoding="utf-8")
     out_file.write(temp_1)
     out_file.write("\n\n")
+    if telemetry:
+        out_file.write("""// Start of the telemetry timer (performance.now is finer than Date.now where available)
+function telemetry_now(){
+	if (typeof performance !== "undefined" && performance.now){
+		return performance.now();
+	}
+	return Date.now();
+}
+var telemetry_start = telemetry_now();
+
+""")
+    if session_cache:
+        out_file.write(temp_session.replace("DESIGN_HASH", design_hash(design)[:16]))
+    if lazy:
+        out_file.write(temp_lazy)
     arrayString = "var featurearray = {"
     for i in range(len(attrout)):
         attr = attrout[i]
@@ -1911,6 +3642,8 @@ for (var pr = 0; pr < returnarrayKeys.length; pr++){
     
     out_file.write(restrictionString)    
     
+    if compiled.fit != None:
+        out_file.write("// " + fit_summary(compiled.fit) + "\n")
     if random == 1:
         probString = "var probabilityarray = {"
         for i in range(len(attrout)):
@@ -1952,7 +3685,22 @@ for (var pr = 0; pr < returnarrayKeys.length; pr++){
         out_file.write("var noDuplicateProfiles = true;\n")
     else:
         out_file.write("var noDuplicateProfiles = false;\n")
+    if units != None:
+        out_file.write("\n// Draws per profile before switching to the fallback\n")
+    else:
+        out_file.write("\n// Draws per profile before it is counted in F-fallback-failed\n")
+    out_file.write("var retry_budget = " + str(retry_budget) + ";\n\n")
+    if units != None:
+        out_file.write("// Fallback: for each group of attributes linked by restrictions, the attribute indices, the allowed level index combinations and their weights\n")
+        out_file.write("var fallbackunits = " + fallback_units_code(units) + ";\n\n")
+        out_file.write(temp_fallback)
+    if conditional:
+        out_file.write("// Conditional weights: for each attribute drawn from its parents' levels (parents first), the attribute, its parents and the alias table (probabilities, aliases) of each combination of their levels\n")
+        out_file.write("var conditionalarray = " + conditional_code(compiled) + ";\n\n")
+        out_file.write(temp_conditional)
     
+    if session_cache and not lazy:
+        out_file.write("// Generate the profiles unless they were stored before\nif (already_generated == false){\n")
 
 
     if randomize == 1:
@@ -1990,7 +3738,8 @@ for (var pr = 0; pr < returnarrayKeys.length; pr++){
     out_file.close()
 
 # Output sample HTML template 
-def html_out(filename, num_attr, profiles, tasks):
+# order_once = True shows the attribute names stored once per respondent (F-order-[attribute number])
+def html_out(filename, num_attr, profiles, tasks, order_once=False):
     filename = filename.rstrip("html")
     filename = filename.rstrip(".")
     
@@ -2007,7 +3756,7 @@ def html_out(filename, num_attr, profiles, tasks):
         # Row Array
         rows = ["A"]*num_attr
         for m in range(num_attr):
-            rows[m] = "<tr>\n<td style='text-align: center;'><strong>${e://Field/F-" + str(i+1) + "-" + str(m+1) + "}</strong></td>\n"
+            rows[m] = "<tr>\n<td style='text-align: center;'><strong>${e://Field/" + attribute_key(i+1, m+1, order_once) + "}</strong></td>\n"
             for n in range(profiles):
                 rows[m] = rows[m] + "<td style='text-align: center;'>${e://Field/F-"+str(i+1) +"-" + str(n+1)+"-"+str(m+1)+"}</td>\n"
             rows[m] = rows[m] + "</tr>"
@@ -2028,9 +3777,2934 @@ def html_out(filename, num_attr, profiles, tasks):
         out_file.close()
     messagebox.showinfo(title="Files Created", message=str(tasks) + " files created\n\n" + filename + "_task#.html")
     
+# -- Design files --
+# .sdt files are a sequence of pickles: attribute_list, level_dict, restrictions, constraints,
+# probabilities, number of tasks, number of profiles, a dictionary of settings, then the conditional weights.
+# The settings dictionary and the conditional weights were added later, so files without them fall back to the
+# default settings and no conditional weights.
+default_settings = {"weighted": 0, "randomize": 1, "no_duplicates": 0, "telemetry": 0, "retry_budget": 1000, "lazy_tasks": 0, "session_cache": 1, "order_once": 0, "fit_marginals": 0, "fallback": 1}
+
+def read_design(filename):
+    design = {}
+    with open(filename, "rb") as open_file:
+        pick_in = pickle.Unpickler(open_file)
+        design["attributes"] = pick_in.load()
+        design["level_dict"] = pick_in.load()
+        design["restrictions"] = pick_in.load()
+        design["constraints"] = pick_in.load()
+        design["probabilities"] = pick_in.load()
+        design["tasks"] = int(pick_in.load())
+        design["profiles"] = int(pick_in.load())
+        try:
+            settings = pick_in.load()
+        except EOFError:
+            settings = {}
+        try:
+            design["conditional_weights"] = pick_in.load()
+        except EOFError:
+            design["conditional_weights"] = {}
+    for key in default_settings:
+        design[key] = settings.get(key, default_settings[key])
+    return design
+
+def write_design(filename, design):
+    with open(filename, "wb") as save_file:
+        pick_out = pickle.Pickler(save_file)
+        pick_out.dump(design["attributes"])
+        pick_out.dump(design["level_dict"])
+        pick_out.dump(design["restrictions"])
+        pick_out.dump(design["constraints"])
+        pick_out.dump(design["probabilities"])
+        pick_out.dump(design["tasks"])
+        pick_out.dump(design["profiles"])
+        pick_out.dump({key: design.get(key, default_settings[key]) for key in default_settings})
+        pick_out.dump(design.get("conditional_weights", {}))
+
+# compiledDesign holds a design as integer tables for the analysis tools
+# Attribute j (0-based) has levels coded 1..len(levels[j]); code 0 means missing
+# arguments: design - dictionary as returned by read_design
+class compiledDesign:
+
+    def __init__(self, design):
+        self.attributes = tuple(design["attributes"])
+        self.levels = tuple(tuple(design["level_dict"][attr]) for attr in self.attributes)
+        self.attr_index = {attr: j for j, attr in enumerate(self.attributes)}
+        # Level name -> code; duplicate level names map to their first occurrence
+        level_index = []
+        for levels in self.levels:
+            index = {}
+            for k in range(len(levels)):
+                if levels[k] not in index:
+                    index[levels[k]] = k + 1
+            level_index.append(index)
+        self.level_index = tuple(level_index)
+
+        weights = []
+        for attr, levels in zip(self.attributes, self.levels):
+            probs = design["probabilities"].get(attr, [])
+            if len(probs) != len(levels):
+                probs = [1]*len(levels)
+            weights.append(tuple(normalize_weights(probs)))
+        self.weights = tuple(weights)
+        self.tasks = int(design["tasks"])
+        self.profiles = int(design["profiles"])
+        self.weighted = int(design.get("weighted", 0))
+        self.randomize = int(design.get("randomize", 1))
+        self.no_duplicates = int(design.get("no_duplicates", 0))
+        self.order_once = int(design.get("order_once", 0))
+        self.retry_budget = int(design.get("retry_budget", default_settings["retry_budget"]))
+        self.fallback = int(design.get("fallback", 1))
+
+        # Order constraints as tuples of attribute indices; attributes that no longer exist are dropped
+        constraints = []
+        for constraint in design["constraints"]:
+            indices = tuple(self.attr_index[attr] for attr in constraint if attr in self.attr_index)
+            if len(indices) > 0:
+                constraints.append(indices)
+        self.constraints = tuple(constraints)
+
+        # Restrictions as tuples of (attribute index, level code) pairs
+        # Empty restrictions and restrictions naming a level that no longer exists never match, so they are dropped
+        restrictions = []
+        for restriction in design["restrictions"]:
+            pairs = []
+            for pair in restriction:
+                j = self.attr_index.get(pair[0])
+                if j != None and pair[1] in self.level_index[j]:
+                    pairs.append((j, self.level_index[j][pair[1]]))
+            if len(pairs) > 0 and len(pairs) == len(restriction):
+                restrictions.append(tuple(pairs))
+        self.restrictions = tuple(restrictions)
+
+        # Conditional weights as {attribute index: (parent indices, rows)} with one normalized weight row per
+        # combination of parent levels, the first parent's level varying slowest (conditional_row). Rows that
+        # were not given use the attribute's own weights. Tables naming an attribute that no longer exists are
+        # dropped, and so are rows naming a level that no longer exists or whose number of weights no longer
+        # matches the levels; conditional_dropped counts the rows left out (for the exporters' warning).
+        # draw_order lists the attributes with conditional weights after the parents they depend on (a cycle
+        # raises ValueError).
+        conditional = {}
+        self.conditional_dropped = 0
+        for child, table in design.get("conditional_weights", {}).items():
+            j = self.attr_index.get(child)
+            parents = tuple(self.attr_index.get(attr) for attr in table["parents"])
+            if j == None or len(parents) == 0 or None in parents or j in parents or len(set(parents)) != len(parents):
+                self.conditional_dropped = self.conditional_dropped + len(table["rows"])
+                continue
+            num_rows = 1
+            for p in parents:
+                num_rows = num_rows*len(self.levels[p])
+            rows = [self.weights[j]]*num_rows
+            for levels, weights in table["rows"].items():
+                if len(levels) != len(parents) or len(weights) != len(self.levels[j]):
+                    self.conditional_dropped = self.conditional_dropped + 1
+                    continue
+                codes = [self.level_index[p].get(level) for p, level in zip(parents, levels)]
+                if None in codes:
+                    self.conditional_dropped = self.conditional_dropped + 1
+                    continue
+                rows[conditional_row(self, parents, dict(zip(parents, codes)))] = tuple(normalize_weights(weights))
+            conditional[j] = (parents, tuple(rows))
+        self.conditional = conditional
+        self.draw_order = tuple(conditional_order({j: conditional[j][0] for j in conditional}))
+
+        # With fit_marginals (and weighted randomization), the randomizers draw with weights fitted so the level
+        # shares after restrictions equal self.weights; self.fit holds the result of fit_weights, otherwise None.
+        # The fit is only run the first time it is used
+        self.fit_marginals = int(design.get("fit_marginals", 0))
+        self.fit_result = None
+        self.fitted = False
+
+    @property
+    def fit(self):
+        if not self.fitted:
+            if self.fit_marginals == 1 and self.weighted == 1:
+                self.fit_result = fit_weights(self)
+            self.fitted = True
+        return self.fit_result
+
+    def num_levels(self, j):
+        return len(self.levels[j])
+
+# Index of the conditional weight row for the parents' levels (assigned maps attribute indices to level codes)
+def conditional_row(compiled, parents, assigned):
+    row = 0
+    for p in parents:
+        row = row*len(compiled.levels[p]) + assigned[p] - 1
+    return row
+
+# -- Design hashes and artifact cache --
+# design_hash identifies a design by its content. With text=True every name, number and setting that appears
+# in an export counts; with text=False only the structure does (level counts, restrictions and constraints as
+# indices, exact weights and conditional weights, randomization settings), so renaming attributes or levels
+# keeps the hash. Restrictions and constraints are sorted for the structural hash since their order does not
+# change what can be drawn. Conditional weights only add to the hash of designs that have them, and fitted
+# weights are represented by the design weights and the fit_marginals flag, so hashing never runs the fit.
+def design_hash(design, text=True):
+    settings = [int(design["tasks"]), int(design["profiles"]), int(design.get("weighted", 0)), int(design.get("randomize", 1)), int(design.get("no_duplicates", 0))]
+    if text:
+        payload = {"attributes": list(design["attributes"]),
+                   "levels": [list(design["level_dict"][attr]) for attr in design["attributes"]],
+                   "restrictions": [[list(pair) for pair in restriction] for restriction in design["restrictions"]],
+                   "constraints": [list(constraint) for constraint in design["constraints"]],
+                   "probabilities": [[str(prob) for prob in design["probabilities"].get(attr, [])] for attr in design["attributes"]],
+                   "settings": settings + [int(design.get("telemetry", 0)), int(design.get("retry_budget", default_settings["retry_budget"])), int(design.get("lazy_tasks", 0)), int(design.get("session_cache", 1)), int(design.get("order_once", 0)), int(design.get("fit_marginals", 0)), int(design.get("fallback", 1))]}
+        if len(design.get("conditional_weights", {})) > 0:
+            payload["conditional_weights"] = [[child, list(table["parents"]), sorted([list(levels), [str(w) for w in weights]] for levels, weights in table["rows"].items())]
+                                              for child, table in sorted(design["conditional_weights"].items())]
+    else:
+        compiled = compiledDesign(design)
+        payload = {"levels": [len(levels) for levels in compiled.levels],
+                   "restrictions": sorted(sorted(list(pair) for pair in restriction) for restriction in compiled.restrictions),
+                   "constraints": sorted(list(constraint) for constraint in compiled.constraints),
+                   "weights": [[str(w) for w in weights] for weights in exact_design_weights(compiled)],
+                   "settings": settings}
+        if compiled.fit_marginals == 1 and compiled.weighted == 1:
+            payload["settings"] = settings + ["fit_marginals"]
+        conditionals = exact_conditionals(compiled)
+        if len(conditionals) > 0:
+            payload["conditional"] = [[j, list(parents), [[str(w) for w in row] for row in rows]] for j, (parents, rows) in sorted(conditionals.items())]
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+# Version of each kind of cached artifact; bump it when the code producing that artifact changes so old
+# entries are no longer used
+artifact_versions = {"php": 8, "js": 11, "R": 1, "design_space": 2}
+
+# On-disk least-recently-used cache of derived artifacts, one file per key. Reading an entry marks it as
+# used; when the total size goes over max_bytes the least recently used entries are deleted.
+class artifactCache:
+
+    def __init__(self, directory=None, max_bytes=None):
+        if directory == None:
+            directory = default_options["cache_dir"]
+        if max_bytes == None:
+            max_bytes = default_options["cache_max_bytes"]
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def key(self, kind, digest, options=""):
+        return kind + "-" + str(artifact_versions[kind]) + "-" + digest + options
+
+    def get(self, key):
+        filename = os.path.join(self.directory, key)
+        try:
+            with open(filename, "rb") as in_file:
+                data = in_file.read()
+            os.utime(filename)
+            return data
+        except OSError:
+            return None
+
+    def put(self, key, data):
+        os.makedirs(self.directory, exist_ok=True)
+        filename = os.path.join(self.directory, key)
+        with open(filename + ".tmp", "wb") as out_file:
+            out_file.write(data)
+        os.replace(filename + ".tmp", filename)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(entry[1] for entry in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total = total - size
+
+    # JSON-serializable result of compute(), from the cache when possible
+    def cached_json(self, key, compute):
+        data = self.get(key)
+        if data != None:
+            return json.loads(data.decode("utf-8"))
+        value = compute()
+        self.put(key, json.dumps(value).encode("utf-8"))
+        return value
+
+# count_design_space, cached by structural hash. The cache holds the counts as strings (they can exceed any
+# float) and attributes by index, so a renamed design reads the same entry.
+def cached_design_space(design, cache):
+    def compute():
+        space = count_design_space(design)
+        index = {attr: j for j, attr in enumerate(design["attributes"])}
+        return {"profiles": str(space["profiles"]), "feasible": str(space["feasible"]), "acceptance": str(space["acceptance"]),
+                "components": [{"attributes": [index[attr] for attr in component["attributes"]], "profiles": str(component["profiles"]),
+                                "feasible": str(component["feasible"]), "acceptance": str(component["acceptance"])} for component in space["components"]]}
+    value = cache.cached_json(cache.key("design_space", design_hash(design, text=False)), compute)
+    components = [{"attributes": [design["attributes"][j] for j in component["attributes"]], "profiles": int(component["profiles"]),
+                   "feasible": int(component["feasible"]), "acceptance": Fraction(component["acceptance"])} for component in value["components"]]
+    return {"profiles": int(value["profiles"]), "feasible": int(value["feasible"]), "acceptance": Fraction(value["acceptance"]), "components": components}
+
+# Write the PHP, JavaScript or R export of a design (kind "php", "js" or "R"). With a cache, an unchanged
+# design is copied from the cache instead of being generated again, and the warnings the exporter gave
+# (kept in a second entry) are shown again. Returns False if the exporter refused the design.
+def export_design(kind, filename, design, cache=None):
+    args = (filename, design["attributes"], design["level_dict"], design["restrictions"], design["constraints"], design["probabilities"],
+            int(design.get("weighted", 0)), int(design["profiles"]), int(design["tasks"]), int(design.get("randomize", 1)))
+    key = None
+    if cache != None:
+        key = cache.key(kind, design_hash(design))
+        warnings = cache.get(key + "-warnings")
+        data = cache.get(key)
+        # An entry whose warnings were evicted is generated again rather than copied without them
+        if data != None and warnings != None:
+            with open(filename, "wb") as out_file:
+                out_file.write(data)
+            for message in json.loads(warnings.decode("utf-8")):
+                show_export_warning(message)
+            return True
+    if os.path.exists(filename):
+        os.remove(filename)
+    del export_warnings[:]
+    if kind == "php":
+        qualtrics_out(*args, int(design.get("no_duplicates", 0)), int(design.get("telemetry", 0)) == 1, int(design.get("retry_budget", default_settings["retry_budget"])),
+                      int(design.get("order_once", 0)) == 1, design.get("conditional_weights", {}), int(design.get("fit_marginals", 0)) == 1,
+                      int(design.get("fallback", 1)) == 1)
+    elif kind == "js":
+        qualtrics_out_js(*args, int(design.get("no_duplicates", 0)), int(design.get("telemetry", 0)) == 1, int(design.get("retry_budget", default_settings["retry_budget"])),
+                         int(design.get("lazy_tasks", 0)) == 1, int(design.get("session_cache", 1)) == 1, int(design.get("order_once", 0)) == 1,
+                         design.get("conditional_weights", {}), int(design.get("fit_marginals", 0)) == 1, int(design.get("fallback", 1)) == 1)
+    else:
+        R_out(*args)
+    if not os.path.exists(filename):
+        return False
+    if cache != None:
+        cache.put(key + "-warnings", json.dumps(export_warnings).encode("utf-8"))
+        with open(filename, "rb") as in_file:
+            cache.put(key, in_file.read())
+    return True
+
+# -- Long-format conjoint data --
+# Fielded data is stored one row per respondent x task x profile in a column store: a directory with
+# meta.json and one file of little-endian 32-bit integers per column. Columns are
+#   respondent (0-based index into respondents.txt), task, profile, selected (1/0, -1 if missing),
+#   L1..LA (level code of attribute j, 0 if missing) and P1..PA (display position of attribute j, 0 if missing)
+# Columns can be appended in chunks and read back through memory maps without copying.
+def long_columns(num_attributes):
+    return ["respondent", "task", "profile", "selected"] + ["L" + str(j+1) for j in range(num_attributes)] + ["P" + str(j+1) for j in range(num_attributes)]
+
+class columnWriter:
+
+    def __init__(self, out_dir, columns, meta):
+        self.out_dir = out_dir
+        self.columns = columns
+        self.meta = dict(meta)
+        self.rows = 0
+        os.makedirs(out_dir, exist_ok=True)
+        self.files = {col: open(os.path.join(out_dir, col + ".bin"), "wb") for col in columns}
+
+    # chunk maps every column name to an array('i') of the same length
+    def append(self, chunk):
+        length = len(chunk[self.columns[0]])
+        for col in self.columns:
+            values = chunk[col]
+            if sys.byteorder != "little":
+                values = array.array("i", values)
+                values.byteswap()
+            values.tofile(self.files[col])
+        self.rows = self.rows + length
+
+    def close(self):
+        for col in self.columns:
+            self.files[col].close()
+        self.meta["columns"] = self.columns
+        self.meta["rows"] = self.rows
+        with open(os.path.join(self.out_dir, "meta.json"), "w", encoding="utf-8") as meta_file:
+            json.dump(self.meta, meta_file, indent=1)
+
+def new_chunk(columns):
+    return {col: array.array("i") for col in columns}
+
+# Open a column store. Returns the metadata and a dictionary of read-only integer views,
+# memory-mapped from disk (nothing is read until it is used)
+def read_columns(store_dir, columns=None):
+    with open(os.path.join(store_dir, "meta.json"), encoding="utf-8") as meta_file:
+        meta = json.load(meta_file)
+    if columns == None:
+        columns = meta["columns"]
+    views = {}
+    for col in columns:
+        views[col] = map_int_file(os.path.join(store_dir, col + ".bin"))
+    return meta, views
+
+def map_int_file(filename):
+    if os.path.getsize(filename) == 0:
+        return memoryview(array.array("i"))
+    with open(filename, "rb") as in_file:
+        mapped = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapped).cast("i")
+    if sys.byteorder != "little":
+        swapped = array.array("i", view)
+        swapped.byteswap()
+        view = memoryview(swapped)
+    return view
+
+# Iterate over a column store in chunks of chunk_rows rows: yields dictionaries of column slices
+def iter_long_chunks(store_dir, columns=None, chunk_rows=100000):
+    meta, views = read_columns(store_dir, columns)
+    for start in range(0, meta["rows"], chunk_rows):
+        yield {col: views[col][start:start+chunk_rows] for col in views}
+
+def read_respondents(store_dir):
+    with open(os.path.join(store_dir, "respondents.txt"), encoding="utf-8") as in_file:
+        return [line.rstrip("\n") for line in in_file]
+
+# -- Qualtrics response ingestion --
+# Reads a Qualtrics .csv export row by row and writes the conjoint tasks in long format to out_dir.
+# The F-[task]-[attribute] fields give the attribute shown in each row of the table and the
+# F-[task]-[profile]-[attribute] fields the levels (see html_out); both are mapped back to integer codes
+# using the design. choice_columns lists, for each task, the column holding the chosen profile number.
+# Only chunk_rows output rows are held in memory at a time. Returns a summary dictionary.
+def ingest_qualtrics(csv_name, design, out_dir, choice_columns=None, id_column="ResponseId", chunk_rows=50000):
+    compiled = compiledDesign(design)
+    num_attributes = len(compiled.attributes)
+    columns = long_columns(num_attributes)
+    summary = {"respondents": 0, "rows": 0, "skipped": 0, "unknown_levels": 0, "missing_choices": 0}
+
+    with open(csv_name, "rt", encoding="utf-8-sig", newline="") as in_file:
+        reader = csv.reader(in_file)
+        header = next(reader)
+        layout = qualtrics_layout(header, choice_columns, id_column)
+        if layout["tasks"] == 0:
+            raise ValueError("No F-[task]-[profile]-[attribute] columns found in " + csv_name)
+
+        meta = {"attributes": list(compiled.attributes), "levels": [list(levels) for levels in compiled.levels],
+                "tasks": layout["tasks"], "profiles": layout["profiles"], "source": os.path.basename(csv_name)}
+        writer = columnWriter(out_dir, columns, meta)
+        respondent_file = open(os.path.join(out_dir, "respondents.txt"), "w", encoding="utf-8")
+        chunk = new_chunk(columns)
+        chunk_size = 0
+        try:
+            for row in reader:
+                if qualtrics_header_row(row, layout):
+                    continue
+                added = ingest_respondent(row, layout, compiled, summary["respondents"], chunk, summary)
+                if added == 0:
+                    summary["skipped"] = summary["skipped"] + 1
+                    continue
+                if layout["id"] != None and layout["id"] < len(row):
+                    respondent_file.write(row[layout["id"]].replace("\n", " ") + "\n")
+                else:
+                    respondent_file.write(str(summary["respondents"] + 1) + "\n")
+                summary["respondents"] = summary["respondents"] + 1
+                chunk_size = chunk_size + added
+                if chunk_size >= chunk_rows:
+                    writer.append(chunk)
+                    chunk = new_chunk(columns)
+                    chunk_size = 0
+            if chunk_size > 0:
+                writer.append(chunk)
+        finally:
+            writer.meta.update(summary)
+            writer.close()
+            respondent_file.close()
+    summary["rows"] = writer.rows
+    return summary
+
+# Work out, once from the header, which column holds each F-key and each task's choice
+def qualtrics_layout(header, choice_columns, id_column):
+    position = {name.strip(): i for i, name in enumerate(header)}
+    attr_cols = {}
+    level_cols = {}
+    order_cols = {}
+    for name, i in position.items():
+        match = re.match(r"^F-order-(\d+)$", name)
+        if match != None:
+            order_cols[int(match.group(1))] = i
+            continue
+        match = re.match(r"^F-(\d+)-(\d+)(?:-(\d+))?$", name)
+        if match == None:
+            continue
+        if match.group(3) == None:
+            attr_cols[(int(match.group(1)), int(match.group(2)))] = i
+        else:
+            level_cols[(int(match.group(1)), int(match.group(2)), int(match.group(3)))] = i
+    tasks = max([key[0] for key in level_cols], default=0)
+    profiles = max([key[1] for key in level_cols], default=0)
+    positions = max([key[2] for key in level_cols], default=0)
+    choices = []
+    if choice_columns != None:
+        for name in choice_columns:
+            if name not in position:
+                raise ValueError("Choice column " + name + " not found")
+            choices.append(position[name])
+    layout = {"tasks": tasks, "profiles": profiles, "positions": positions, "choices": choices,
+              "id": position.get(id_column), "first": level_cols.get((1, 1, 1))}
+    # Flat lists indexed [task][profile][position] / [task][position] so the per-row loop does no string work
+    # The attribute order stored once per respondent (F-order-[a]) stands in for every task without F-[t]-[a]
+    layout["attr"] = [[attr_cols.get((t, a), order_cols.get(a)) for a in range(1, positions+1)] for t in range(1, tasks+1)]
+    layout["level"] = [[[level_cols.get((t, p, a)) for a in range(1, positions+1)] for p in range(1, profiles+1)] for t in range(1, tasks+1)]
+    return layout
+
+# Qualtrics puts the question text (and, in newer exports, the import ids) under the header
+def qualtrics_header_row(row, layout):
+    first = layout["first"]
+    if first == None or first >= len(row):
+        return False
+    return row[first] == "F-1-1-1" or row[first].startswith('{"ImportId"')
+
+# Append one respondent's tasks to chunk. Returns the number of rows added
+def ingest_respondent(row, layout, compiled, respondent, chunk, summary):
+    num_attributes = len(compiled.attributes)
+    level_code = [chunk["L" + str(j+1)] for j in range(num_attributes)]
+    position_code = [chunk["P" + str(j+1)] for j in range(num_attributes)]
+    row_len = len(row)
+    added = 0
+    for t in range(layout["tasks"]):
+        # Attribute shown in each row of task t
+        shown = []
+        for col in layout["attr"][t]:
+            if col != None and col < row_len:
+                shown.append(compiled.attr_index.get(row[col], -1))
+            else:
+                shown.append(-1)
+        if all(j < 0 for j in shown):
+            continue
+        chosen = -1
+        if t < len(layout["choices"]) and layout["choices"][t] < row_len:
+            chosen = first_int(row[layout["choices"][t]])
+            if chosen == None:
+                chosen = -1
+                summary["missing_choices"] = summary["missing_choices"] + 1
+        for p in range(layout["profiles"]):
+            codes = [0]*num_attributes
+            places = [0]*num_attributes
+            level_row = layout["level"][t][p]
+            for a in range(len(shown)):
+                j = shown[a]
+                col = level_row[a]
+                if j < 0 or col == None or col >= row_len:
+                    continue
+                code = compiled.level_index[j].get(row[col], 0)
+                if code == 0:
+                    summary["unknown_levels"] = summary["unknown_levels"] + 1
+                codes[j] = code
+                places[j] = a + 1
+            chunk["respondent"].append(respondent)
+            chunk["task"].append(t + 1)
+            chunk["profile"].append(p + 1)
+            if chosen < 0:
+                chunk["selected"].append(-1)
+            else:
+                chunk["selected"].append(1 if chosen == p + 1 else 0)
+            for j in range(num_attributes):
+                level_code[j].append(codes[j])
+                position_code[j].append(places[j])
+            added = added + 1
+    return added
+
+def first_int(text):
+    match = re.search(r"\d+", text)
+    if match == None:
+        return None
+    return int(match.group(0))
+
+# -- Randomizer telemetry --
+# Summarizes the telemetry_fields recorded by a randomizer exported with telemetry, read row by row from a
+# Qualtrics .csv export. Returns one row per field with the number of respondents that have it, the mean,
+# quantiles and maximum; respondents without a value are counted as missing.
+def telemetry_report(csv_name, quantiles=(0.5, 0.9, 0.99)):
+    values = {field: array.array("d") for field in telemetry_fields}
+    missing = {field: 0 for field in telemetry_fields}
+    with open(csv_name, "rt", encoding="utf-8-sig", newline="") as in_file:
+        reader = csv.reader(in_file)
+        header = [name.strip() for name in next(reader)]
+        columns = {field: header.index(field) for field in telemetry_fields if field in header}
+        if len(columns) == 0:
+            raise ValueError("No telemetry columns (" + ", ".join(telemetry_fields) + ") found in " + csv_name)
+        first = list(columns.values())[0]
+        for row in reader:
+            # Qualtrics puts the question text and import ids under the header
+            if first < len(row) and (row[first] in telemetry_fields or row[first].startswith('{"ImportId"')):
+                continue
+            for field in columns:
+                col = columns[field]
+                try:
+                    values[field].append(float(row[col]))
+                except (IndexError, ValueError):
+                    missing[field] = missing[field] + 1
+    results = []
+    for field in columns:
+        ordered = sorted(values[field])
+        result = {"field": field, "respondents": len(ordered), "missing": missing[field], "mean": None}
+        if len(ordered) > 0:
+            result["mean"] = sum(ordered)/len(ordered)
+        for q in quantiles:
+            result["p" + ("%g" % (100*q))] = percentile(ordered, q)
+        result["max"] = ordered[-1] if len(ordered) > 0 else None
+        results.append(result)
+    return results
+
+# -- Estimation --
+# amceModel lays out the dummy-coded design matrix for the AMCE regression of the outcome on every attribute.
+# Each attribute gets a baseline level (by default its first level that appears in no restriction, so the
+# baseline is feasible with every level of the other attributes). Attributes that appear together in a
+# restriction are "linked": the regression then also includes their level-by-level interactions (except for
+# the cells the restrictions leave structurally empty) and each AMCE averages the conditional effects over the
+# levels of the linked attributes it can appear with, weighted by the design weights (Hainmueller, Hopkins and
+# Yamamoto 2014, Section 4).
+# Rows are stored sparsely as the list of column indices that are 1 (column 0 is the intercept).
+# arguments: compiled - compiledDesign, baselines - optional dictionary attribute name -> baseline level name
+class amceModel:
+
+    def __init__(self, compiled, baselines=None):
+        self.compiled = compiled
+        num_attributes = len(compiled.attributes)
+
+        # Levels ruled out entirely (single-pair restrictions) and pairs of levels ruled out together
+        restricted = [set() for j in range(num_attributes)]
+        self.forbidden = {}
+        self.links = [set() for j in range(num_attributes)]
+        for restriction in compiled.restrictions:
+            for pair in restriction:
+                restricted[pair[0]].add(pair[1])
+            for a in range(len(restriction)):
+                for b in range(a+1, len(restriction)):
+                    j, j2 = restriction[a][0], restriction[b][0]
+                    if j != j2:
+                        self.links[j].add(j2)
+                        self.links[j2].add(j)
+            if len(restriction) == 2:
+                (j, k), (j2, k2) = restriction
+                self.forbidden.setdefault((j, j2), set()).add((k, k2))
+                self.forbidden.setdefault((j2, j), set()).add((k2, k))
+
+        self.baseline = []
+        for j in range(num_attributes):
+            levels = compiled.levels[j]
+            base = None
+            if baselines != None and compiled.attributes[j] in baselines:
+                base = compiled.level_index[j].get(baselines[compiled.attributes[j]])
+            if base == None:
+                free = [k for k in range(1, len(levels)+1) if k not in restricted[j]]
+                base = free[0] if len(free) > 0 else 1
+            self.baseline.append(base)
+
+        # Column layout: intercept, main effects, then interactions of linked attributes
+        self.labels = [("(Intercept)",)]
+        self.main_column = []
+        for j in range(num_attributes):
+            table = [-1]*(len(compiled.levels[j]) + 1)
+            for k in range(1, len(compiled.levels[j]) + 1):
+                if k != self.baseline[j]:
+                    table[k] = len(self.labels)
+                    self.labels.append((j, k))
+            self.main_column.append(table)
+        self.interaction_column = {}
+        for j in range(num_attributes):
+            for j2 in sorted(self.links[j]):
+                if j2 <= j:
+                    continue
+                table = {}
+                for k in range(1, len(compiled.levels[j]) + 1):
+                    for k2 in range(1, len(compiled.levels[j2]) + 1):
+                        if k != self.baseline[j] and k2 != self.baseline[j2] and self.feasible(j, k, j2, k2):
+                            table[(k, k2)] = len(self.labels)
+                            self.labels.append((j, k, j2, k2))
+                self.interaction_column[(j, j2)] = table
+        self.pairs = sorted(self.interaction_column)
+        self.p = len(self.labels)
+
+    def feasible(self, j, k, j2, k2):
+        return (k, k2) not in self.forbidden.get((j, j2), ())
+
+    # Columns that are 1 for a profile with level codes codes[j] (all codes must be > 0)
+    def row_columns(self, codes):
+        cols = [0]
+        for j in range(len(codes)):
+            col = self.main_column[j][codes[j]]
+            if col >= 0:
+                cols.append(col)
+        for pair in self.pairs:
+            col = self.interaction_column[pair].get((codes[pair[0]], codes[pair[1]]))
+            if col != None:
+                cols.append(col)
+        return cols
+
+    # Linear combination of the coefficients (as {column: weight}) giving the AMCE of level k of attribute j
+    def amce_contrast(self, j, k):
+        contrast = {self.main_column[j][k]: 1.0}
+        for j2 in self.links[j]:
+            support = [k2 for k2 in range(1, len(self.compiled.levels[j2]) + 1) if self.feasible(j, k, j2, k2) and self.feasible(j, self.baseline[j], j2, k2)]
+            total = sum(self.compiled.weights[j2][k2-1] for k2 in support)
+            if total <= 0:
+                continue
+            for k2 in support:
+                if k2 == self.baseline[j2]:
+                    continue
+                key = (k, k2) if j < j2 else (k2, k)
+                col = self.interaction_column[(min(j, j2), max(j, j2))].get(key)
+                if col != None:
+                    contrast[col] = contrast.get(col, 0.0) + self.compiled.weights[j2][k2-1]/total
+        return contrast
+
+# Accumulate the grouped sufficient statistics of a column store: every distinct profile (tuple of level
+# codes) with its row count and outcome sum. Rows with a missing outcome or level are skipped.
+# The regression cross-products are then built once per distinct profile instead of once per row.
+def profile_counts(store_dir, num_attributes, chunk_rows=100000):
+    patterns = {}
+    level_cols = ["L" + str(j+1) for j in range(num_attributes)]
+    for chunk in iter_long_chunks(store_dir, ["selected"] + level_cols, chunk_rows):
+        selected = chunk["selected"]
+        for key, y in zip(zip(*[chunk[col] for col in level_cols]), selected):
+            if y < 0 or 0 in key:
+                continue
+            stats = patterns.get(key)
+            if stats == None:
+                patterns[key] = [1, y]
+            else:
+                stats[0] = stats[0] + 1
+                stats[1] = stats[1] + y
+    return patterns
+
+def cross_products(model, patterns):
+    p = model.p
+    xtx = [[0.0]*p for a in range(p)]
+    xty = [0.0]*p
+    n = 0
+    columns = {}
+    for key in patterns:
+        count, ysum = patterns[key]
+        cols = model.row_columns(key)
+        columns[key] = cols
+        for a in cols:
+            row = xtx[a]
+            xty[a] = xty[a] + ysum
+            for b in cols:
+                row[b] = row[b] + count
+        n = n + count
+    return xtx, xty, n, columns
+
+# Inverse of a symmetric positive semi-definite matrix (list of rows) by the sweep operator
+# Columns that are numerically a combination of earlier columns are not swept; they are returned as
+# aliased and their rows and columns of the inverse are set to zero
+def sweep_inverse(matrix, tol=1e-10):
+    p = len(matrix)
+    a = [list(row) for row in matrix]
+    aliased = []
+    for k in range(p):
+        d = a[k][k]
+        if matrix[k][k] <= 0 or d <= tol*matrix[k][k]:
+            aliased.append(k)
+            continue
+        rowk = a[k]
+        for j in range(p):
+            rowk[j] = rowk[j]/d
+        for i in range(p):
+            if i == k:
+                continue
+            rowi = a[i]
+            b = rowi[k]
+            if b != 0:
+                for j in range(p):
+                    rowi[j] = rowi[j] - b*rowk[j]
+                rowi[k] = -b/d
+        rowk[k] = 1/d
+    for k in aliased:
+        for j in range(p):
+            a[k][j] = 0.0
+            a[j][k] = 0.0
+    return a, aliased
+
+# Solves matrix*x = rhs for a symmetric positive semi-definite matrix by Cholesky decomposition, for when
+# only the coefficients are needed. Aliased columns (as in sweep_inverse) are dropped and get coefficient 0.
+def cholesky_solve(matrix, rhs, tol=1e-10):
+    p = len(matrix)
+    factor = [None]*p
+    kept = []
+    aliased = []
+    for k in range(p):
+        rowk = matrix[k]
+        column = [rowk[i] for i in kept]
+        for a in range(len(kept)):
+            fa = factor[kept[a]]
+            column[a] = (column[a] - sum(fa[b]*column[b] for b in range(a)))/fa[a]
+        d = rowk[k] - sum(v*v for v in column)
+        if rowk[k] <= 0 or d <= tol*rowk[k]:
+            aliased.append(k)
+            continue
+        column.append(math.sqrt(d))
+        factor[k] = column
+        kept.append(k)
+    z = []
+    for a in range(len(kept)):
+        fa = factor[kept[a]]
+        z.append((rhs[kept[a]] - sum(fa[b]*z[b] for b in range(a)))/fa[a])
+    x = [0.0]*p
+    for a in range(len(kept) - 1, -1, -1):
+        total = z[a] - sum(factor[kept[b]][a]*x[kept[b]] for b in range(a + 1, len(kept)))
+        x[kept[a]] = total/factor[kept[a]][a]
+    return x, aliased
+
+def mat_vec(matrix, vec):
+    return [sum(x*y for x, y in zip(row, vec)) for row in matrix]
+
+def mat_mul(left, right):
+    cols = list(zip(*right))
+    return [[sum(x*y for x, y in zip(row, col)) for col in cols] for row in left]
+
+def normal_p_value(z):
+    return math.erfc(abs(z)/math.sqrt(2))
+
+# Fit the AMCE regression (linear probability model) on a column store written by ingest_qualtrics and
+# return one result row per non-baseline level with respondent-clustered (CR1) standard errors.
+# The data are read twice through the memory maps: once for the grouped cross-products and once for
+# the per-respondent scores of the cluster-robust variance, so memory does not grow with the data.
+def estimate_amce(store_dir, design, baselines=None, chunk_rows=100000):
+    compiled = compiledDesign(design)
+    model = amceModel(compiled, baselines)
+    patterns = profile_counts(store_dir, len(compiled.attributes), chunk_rows)
+    xtx, xty, n, columns = cross_products(model, patterns)
+    if n == 0:
+        raise ValueError("No complete rows (outcome and all levels observed) in " + store_dir)
+    bread, aliased = sweep_inverse(xtx)
+    beta = mat_vec(bread, xty)
+    fitted = {key: sum(beta[c] for c in columns[key]) for key in columns}
+    meat, clusters = cluster_meat(store_dir, model, columns, fitted, chunk_rows)
+    vcov = mat_mul(mat_mul(bread, meat), bread)
+    rank = model.p - len(aliased)
+    correction = 1.0
+    if clusters > 1 and n > rank:
+        correction = (clusters/(clusters - 1))*((n - 1)/(n - rank))
+    vcov = [[v*correction for v in row] for row in vcov]
+
+    results = []
+    for j in range(len(compiled.attributes)):
+        for k in range(1, len(compiled.levels[j]) + 1):
+            result = {"attribute": compiled.attributes[j], "level": compiled.levels[j][k-1]}
+            if k == model.baseline[j]:
+                result.update({"estimate": 0.0, "std_error": None, "z": None, "p_value": None, "baseline": True})
+            else:
+                contrast = model.amce_contrast(j, k)
+                result.update(linear_estimate(contrast, beta, vcov, aliased))
+                result["baseline"] = False
+            results.append(result)
+    info = {"rows": n, "respondents": clusters, "columns": model.p, "aliased": [model.labels[k] for k in aliased]}
+    return results, info
+
+def linear_estimate(contrast, beta, vcov, aliased):
+    if any(col in aliased for col in contrast):
+        return {"estimate": None, "std_error": None, "z": None, "p_value": None}
+    estimate = sum(w*beta[col] for col, w in contrast.items())
+    variance = sum(w*w2*vcov[col][col2] for col, w in contrast.items() for col2, w2 in contrast.items())
+    se = math.sqrt(max(variance, 0.0))
+    if se > 0:
+        z = estimate/se
+        return {"estimate": estimate, "std_error": se, "z": z, "p_value": normal_p_value(z)}
+    return {"estimate": estimate, "std_error": se, "z": None, "p_value": None}
+
+# Sum over respondents of s_g s_g', where s_g = sum of x_i*(y_i - fitted_i) over respondent g's rows
+# Rows of a respondent are contiguous in the column store
+def cluster_meat(store_dir, model, columns, fitted, chunk_rows=100000):
+    p = model.p
+    meat = [[0.0]*p for a in range(p)]
+    num_attributes = len(model.compiled.attributes)
+    level_cols = ["L" + str(j+1) for j in range(num_attributes)]
+    current = None
+    score = {}
+    clusters = 0
+    for chunk in iter_long_chunks(store_dir, ["respondent", "selected"] + level_cols, chunk_rows):
+        for r, y, key in zip(chunk["respondent"], chunk["selected"], zip(*[chunk[col] for col in level_cols])):
+            if y < 0 or 0 in key:
+                continue
+            if r != current:
+                add_outer(meat, score)
+                score = {}
+                current = r
+                clusters = clusters + 1
+            e = y - fitted[key]
+            for c in columns[key]:
+                score[c] = score.get(c, 0.0) + e
+    add_outer(meat, score)
+    return meat, clusters
+
+def add_outer(matrix, vec):
+    items = list(vec.items())
+    for a, va in items:
+        row = matrix[a]
+        for b, vb in items:
+            row[b] = row[b] + va*vb
+
+def write_results_csv(filename, results):
+    with open(filename, "w", encoding="utf-8", newline="") as out_file:
+        writer = csv.writer(out_file)
+        keys = list(results[0].keys()) if len(results) > 0 else []
+        writer.writerow(keys)
+        for result in results:
+            writer.writerow(["" if result[key] == None else result[key] for key in keys])
+
+def print_results(results, keys=("attribute", "level", "estimate", "std_error", "p_value")):
+    for result in results:
+        fields = []
+        for key in keys:
+            value = result.get(key)
+            if isinstance(value, float):
+                fields.append("%.4f" % value)
+            elif value == None:
+                fields.append("-")
+            else:
+                fields.append(str(value))
+        print("\t".join(fields))
+
+# -- Marginal means and interactions --
+# cellTable numbers the cells for which means are reported: every level of every attribute, and every
+# pair of levels of every pair of attributes except the pairs a restriction rules out. It also lists for
+# each pair cell the average component interaction effects (ACIEs) it enters: the ACIE of levels (k, k2)
+# against the baselines (b, b2) is mean(k, k2) - mean(k, b2) - mean(b, k2) + mean(b, b2).
+class cellTable:
+
+    def __init__(self, model):
+        self.model = model
+        compiled = model.compiled
+        num_attributes = len(compiled.attributes)
+        self.cells = []
+        self.level_cell = []
+        for j in range(num_attributes):
+            self.level_cell.append([-1] + [self.add_cell((j, k)) for k in range(1, len(compiled.levels[j]) + 1)])
+        self.pairs = [(j, j2) for j in range(num_attributes) for j2 in range(j + 1, num_attributes)]
+        self.pair_cell = []
+        for j, j2 in self.pairs:
+            table = {}
+            for k in range(1, len(compiled.levels[j]) + 1):
+                for k2 in range(1, len(compiled.levels[j2]) + 1):
+                    if model.feasible(j, k, j2, k2):
+                        table[(k, k2)] = self.add_cell((j, k, j2, k2))
+            self.pair_cell.append(table)
+
+        self.acies = []
+        self.cell_acies = [[] for cell in self.cells]
+        for q in range(len(self.pairs)):
+            j, j2 = self.pairs[q]
+            b, b2 = model.baseline[j], model.baseline[j2]
+            table = self.pair_cell[q]
+            for k, k2 in table:
+                if k == b or k2 == b2:
+                    continue
+                terms = [((k, k2), 1), ((k, b2), -1), ((b, k2), -1), ((b, b2), 1)]
+                if any(key not in table for key, sign in terms):
+                    continue
+                for key, sign in terms:
+                    self.cell_acies[table[key]].append((len(self.acies), sign))
+                self.acies.append((j, k, j2, k2, [(table[key], sign) for key, sign in terms]))
+
+    def add_cell(self, label):
+        self.cells.append(label)
+        return len(self.cells) - 1
+
+    # Cells a profile with level codes key falls in
+    def profile_cells(self, key):
+        cells = [self.level_cell[j][key[j]] for j in range(len(key))]
+        for q in range(len(self.pairs)):
+            cell = self.pair_cell[q].get((key[self.pairs[q][0]], key[self.pairs[q][1]]))
+            if cell != None:
+                cells.append(cell)
+        return cells
+
+# Marginal means of every level, of every feasible pair of levels of every two attributes, and the ACIEs of
+# every attribute pair, all from one grouped pass over the column store (profile_counts). Standard errors
+# are clustered by respondent, from a second pass. Returns one result row per estimate.
+def estimate_marginal_means(store_dir, design, baselines=None, chunk_rows=100000):
+    compiled = compiledDesign(design)
+    model = amceModel(compiled, baselines)
+    table = cellTable(model)
+    num_cells = len(table.cells)
+    cell_n = [0]*num_cells
+    cell_y = [0]*num_cells
+    patterns = profile_counts(store_dir, len(compiled.attributes), chunk_rows)
+    cells_of = {}
+    for key in patterns:
+        count, ysum = patterns[key]
+        cells = table.profile_cells(key)
+        cells_of[key] = cells
+        for cell in cells:
+            cell_n[cell] = cell_n[cell] + count
+            cell_y[cell] = cell_y[cell] + ysum
+    if len(patterns) == 0:
+        raise ValueError("No complete rows (outcome and all levels observed) in " + store_dir)
+    mean = [cell_y[c]/cell_n[c] if cell_n[c] > 0 else None for c in range(num_cells)]
+    acie = []
+    for j, k, j2, k2, terms in table.acies:
+        if any(mean[cell] == None for cell, sign in terms):
+            acie.append(None)
+        else:
+            acie.append(sum(sign*mean[cell] for cell, sign in terms))
+
+    cell_var, acie_var, clusters = cell_cluster_variance(store_dir, table, cells_of, cell_n, mean, chunk_rows)
+
+    results = []
+    for c in range(num_cells):
+        label = table.cells[c]
+        names = cell_names(compiled, label)
+        result = {"quantity": "mm" if len(label) == 2 else "mm2"}
+        result.update(names)
+        result["rows"] = cell_n[c]
+        result.update(mean_estimate(mean[c], cell_var[c]))
+        results.append(result)
+    for a in range(len(table.acies)):
+        j, k, j2, k2, terms = table.acies[a]
+        result = {"quantity": "acie"}
+        result.update(cell_names(compiled, (j, k, j2, k2)))
+        result["rows"] = sum(cell_n[cell] for cell, sign in terms)
+        result.update(mean_estimate(acie[a], acie_var[a]))
+        results.append(result)
+    return results
+
+def cell_names(compiled, label):
+    names = {"attribute": compiled.attributes[label[0]], "level": compiled.levels[label[0]][label[1]-1], "attribute2": None, "level2": None}
+    if len(label) == 4:
+        names["attribute2"] = compiled.attributes[label[2]]
+        names["level2"] = compiled.levels[label[2]][label[3]-1]
+    return names
+
+def mean_estimate(estimate, variance):
+    if estimate == None:
+        return {"estimate": None, "std_error": None, "z": None, "p_value": None}
+    se = math.sqrt(max(variance, 0.0))
+    if se > 0:
+        return {"estimate": estimate, "std_error": se, "z": estimate/se, "p_value": normal_p_value(estimate/se)}
+    return {"estimate": estimate, "std_error": se, "z": None, "p_value": None}
+
+# Respondent-clustered variances of the cell means and ACIEs: for each respondent the residual
+# sums e_c = sum over the respondent's rows in cell c of (y - mean_c) give the score e_c/n_c of the mean
+def cell_cluster_variance(store_dir, table, cells_of, cell_n, mean, chunk_rows=100000):
+    cell_var = [0.0]*len(cell_n)
+    acie_var = [0.0]*len(table.acies)
+    level_cols = ["L" + str(j+1) for j in range(len(table.model.compiled.attributes))]
+    current = None
+    residual = {}
+    clusters = 0
+    for chunk in iter_long_chunks(store_dir, ["respondent", "selected"] + level_cols, chunk_rows):
+        for r, y, key in zip(chunk["respondent"], chunk["selected"], zip(*[chunk[col] for col in level_cols])):
+            if y < 0 or 0 in key:
+                continue
+            if r != current:
+                add_cell_scores(table, residual, cell_n, cell_var, acie_var)
+                residual = {}
+                current = r
+                clusters = clusters + 1
+            for cell in cells_of[key]:
+                residual[cell] = residual.get(cell, 0.0) + y - mean[cell]
+    add_cell_scores(table, residual, cell_n, cell_var, acie_var)
+    if clusters > 1:
+        correction = clusters/(clusters - 1)
+        cell_var = [v*correction for v in cell_var]
+        acie_var = [v*correction for v in acie_var]
+    return cell_var, acie_var, clusters
+
+def add_cell_scores(table, residual, cell_n, cell_var, acie_var):
+    scores = {}
+    for cell, e in residual.items():
+        score = e/cell_n[cell]
+        cell_var[cell] = cell_var[cell] + score*score
+        for a, sign in table.cell_acies[cell]:
+            scores[a] = scores.get(a, 0.0) + sign*score
+    for a, score in scores.items():
+        acie_var[a] = acie_var[a] + score*score
+
+# -- Respondent bootstrap --
+# Per-respondent sufficient statistics: the respondent's block of X'X (sparse, keyed by row*p + column),
+# of X'y, and the row count and outcome sum of every level (flat level index, see level_offsets).
+# A bootstrap replicate draws respondents with replacement and only adds up these blocks, so it never
+# touches the data again.
+def level_offsets(compiled):
+    offsets = [0]
+    for levels in compiled.levels:
+        offsets.append(offsets[-1] + len(levels))
+    return offsets
+
+def respondent_stats(store_dir, model, chunk_rows=100000):
+    p = model.p
+    offsets = level_offsets(model.compiled)
+    num_attributes = len(model.compiled.attributes)
+    level_cols = ["L" + str(j+1) for j in range(num_attributes)]
+    stats = []
+    columns = {}
+    current = None
+    for chunk in iter_long_chunks(store_dir, ["respondent", "selected"] + level_cols, chunk_rows):
+        for r, y, key in zip(chunk["respondent"], chunk["selected"], zip(*[chunk[col] for col in level_cols])):
+            if y < 0 or 0 in key:
+                continue
+            if r != current:
+                xtx, xty, levels = {}, {}, {}
+                stats.append((xtx, xty, levels))
+                current = r
+            cols = columns.get(key)
+            if cols == None:
+                cols = model.row_columns(key)
+                columns[key] = cols
+            for a in cols:
+                xty[a] = xty.get(a, 0) + y
+                for b in cols:
+                    xtx[a*p + b] = xtx.get(a*p + b, 0) + 1
+            for j in range(num_attributes):
+                index = offsets[j] + key[j] - 1
+                counts = levels.get(index)
+                if counts == None:
+                    levels[index] = [1, y]
+                else:
+                    counts[0] = counts[0] + 1
+                    counts[1] = counts[1] + y
+    return [(list(xtx.items()), list(xty.items()), [(index, c[0], c[1]) for index, c in levels.items()]) for xtx, xty, levels in stats]
+
+# AMCEs and marginal means of the respondents drawn with the given multiplicities
+# Returns two lists in design level order (the baselines' AMCE is 0.0; None where not estimable)
+def aggregate_estimates(model, stats, multiplicity):
+    p = model.p
+    num_levels = level_offsets(model.compiled)[-1]
+    xtx = [0.0]*(p*p)
+    xty = [0.0]*p
+    level_n = [0]*num_levels
+    level_y = [0]*num_levels
+    for g in range(len(stats)):
+        m = multiplicity[g]
+        if m == 0:
+            continue
+        block_xtx, block_xty, block_levels = stats[g]
+        for index, value in block_xtx:
+            xtx[index] = xtx[index] + m*value
+        for index, value in block_xty:
+            xty[index] = xty[index] + m*value
+        for index, count, ysum in block_levels:
+            level_n[index] = level_n[index] + m*count
+            level_y[index] = level_y[index] + m*ysum
+    beta, aliased = cholesky_solve([xtx[a*p:(a+1)*p] for a in range(p)], xty)
+    aliased = set(aliased)
+    amces = []
+    for j in range(len(model.compiled.attributes)):
+        for k in range(1, len(model.compiled.levels[j]) + 1):
+            if k == model.baseline[j]:
+                amces.append(0.0)
+                continue
+            contrast = model.amce_contrast(j, k)
+            if any(col in aliased for col in contrast):
+                amces.append(None)
+            else:
+                amces.append(sum(w*beta[col] for col, w in contrast.items()))
+    means = [level_y[i]/level_n[i] if level_n[i] > 0 else None for i in range(num_levels)]
+    return amces, means
+
+# Worker side of the bootstrap; the statistics are sent to each process once through the pool initializer
+bootstrap_state = {}
+
+def bootstrap_init(model, stats):
+    bootstrap_state["model"] = model
+    bootstrap_state["stats"] = stats
+
+# Runs one block of replicates. Every block has its own random stream seeded from (seed, block), so the
+# replicates are the same whatever the number of processes.
+def bootstrap_block(seed, block, replicates):
+    model = bootstrap_state["model"]
+    stats = bootstrap_state["stats"]
+    rng = random.Random(str(seed) + "-" + str(block))
+    G = len(stats)
+    draws = []
+    for b in range(replicates):
+        multiplicity = [0]*G
+        for i in range(G):
+            g = rng.randrange(G)
+            multiplicity[g] = multiplicity[g] + 1
+        draws.append(aggregate_estimates(model, stats, multiplicity))
+    return draws
+
+def percentile(sorted_values, q):
+    if len(sorted_values) == 0:
+        return None
+    position = q*(len(sorted_values) - 1)
+    low = int(math.floor(position))
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low])*(position - low)
+
+def bootstrap_summary(estimate, draws, level):
+    values = sorted(value for value in draws if value != None)
+    result = {"estimate": estimate, "std_error": None, "ci_lower": None, "ci_upper": None, "replicates": len(values)}
+    if len(values) > 1:
+        mean = sum(values)/len(values)
+        result["std_error"] = math.sqrt(sum((value - mean)**2 for value in values)/(len(values) - 1))
+        result["ci_lower"] = percentile(values, (1 - level)/2)
+        result["ci_upper"] = percentile(values, 1 - (1 - level)/2)
+    return result
+
+# Respondent-clustered bootstrap of the AMCEs and the marginal means (mean outcome by level).
+# Replicates are split into blocks of block_size and run on a pool of processes (processes=1 runs them
+# in this process). Returns one row per level and quantity ("amce" or "mm") with the full-sample estimate,
+# the bootstrap standard error and the percentile confidence interval.
+def bootstrap_amce(store_dir, design, replicates=1000, processes=None, seed=0, baselines=None, level=0.95, block_size=25, chunk_rows=100000):
+    compiled = compiledDesign(design)
+    model = amceModel(compiled, baselines)
+    stats = respondent_stats(store_dir, model, chunk_rows)
+    if len(stats) == 0:
+        raise ValueError("No complete rows (outcome and all levels observed) in " + store_dir)
+    amces, means = aggregate_estimates(model, stats, [1]*len(stats))
+
+    blocks = [(seed, block, min(block_size, replicates - block*block_size)) for block in range((replicates + block_size - 1)//block_size)]
+    if processes == 1:
+        bootstrap_init(model, stats)
+        outputs = [bootstrap_block(*args) for args in blocks]
+    else:
+        with multiprocessing.Pool(processes, bootstrap_init, (model, stats)) as pool:
+            outputs = pool.starmap(bootstrap_block, blocks)
+    draws = [draw for output in outputs for draw in output]
+
+    results = []
+    i = 0
+    for j in range(len(compiled.attributes)):
+        for k in range(1, len(compiled.levels[j]) + 1):
+            for quantity, estimate, position in (("amce", amces[i], 0), ("mm", means[i], 1)):
+                result = {"quantity": quantity, "attribute": compiled.attributes[j], "level": compiled.levels[j][k-1]}
+                if quantity == "amce" and k == model.baseline[j]:
+                    result.update({"estimate": 0.0, "std_error": None, "ci_lower": None, "ci_upper": None, "replicates": 0})
+                else:
+                    result.update(bootstrap_summary(estimate, [draw[position][i] for draw in draws], level))
+                results.append(result)
+            i = i + 1
+    return results
+
+# -- Randomization diagnostics --
+# Level draw probabilities used by the exported randomizers (even unless weighted randomization is on, fitted
+# if the weights are fitted to the restrictions)
+def sampling_weights(compiled):
+    if compiled.weighted == 1:
+        if compiled.fit != None:
+            return compiled.fit["weights"]
+        return compiled.weights
+    return tuple(tuple([1.0/len(levels)]*len(levels)) for levels in compiled.levels)
+
+# Conditional weights used by the exported randomizers (only with weighted randomization), as
+# compiledDesign.conditional
+def sampling_conditionals(compiled):
+    if compiled.weighted == 1:
+        return compiled.conditional
+    return {}
+
+# Draw probability of a combination of levels (codes, one per attribute in component) before restrictions: the
+# product of the level weights, using the row for the parents' levels for attributes with conditional weights
+# (their parents are always in the same component)
+def profile_weight(compiled, weights, conditionals, component, codes):
+    assigned = dict(zip(component, codes))
+    weight = 1
+    for j, k in assigned.items():
+        if j in conditionals:
+            parents, rows = conditionals[j]
+            weight = weight*rows[conditional_row(compiled, parents, assigned)][k-1]
+        else:
+            weight = weight*weights[j][k-1]
+    return weight
+
+# Groups of attributes connected through restrictions or conditional weights. Attributes in different groups
+# are drawn independently, even after restricted profiles are rejected.
+def restriction_components(compiled):
+    parent = list(range(len(compiled.attributes)))
+    def find(j):
+        while parent[j] != j:
+            parent[j] = parent[parent[j]]
+            j = parent[j]
+        return j
+    for restriction in compiled.restrictions:
+        for pair in restriction[1:]:
+            parent[find(pair[0])] = find(restriction[0][0])
+    for j, (parents, rows) in sampling_conditionals(compiled).items():
+        for p in parents:
+            parent[find(p)] = find(j)
+    groups = {}
+    for j in range(len(compiled.attributes)):
+        groups.setdefault(find(j), []).append(j)
+    return [tuple(group) for group in groups.values()]
+
+# Exact distribution of the levels of a group of attributes in a generated profile: the draw probabilities
+# (profile_weight) of the combinations no restriction rules out, renormalized (the randomizers redraw
+# restricted profiles). Returns {tuple of level codes: probability}.
+def component_distribution(compiled, component, weights, max_cells=2000000):
+    cells = 1
+    for j in component:
+        cells = cells*len(compiled.levels[j])
+    if cells > max_cells:
+        raise ValueError("Too many level combinations (" + str(cells) + ") among restricted attributes to enumerate")
+    position = {j: a for a, j in enumerate(component)}
+    restrictions = [tuple((position[j], k) for j, k in restriction) for restriction in compiled.restrictions if restriction[0][0] in position]
+    conditionals = sampling_conditionals(compiled)
+    distribution = {}
+    total = 0.0
+    for codes in itertools.product(*[range(1, len(compiled.levels[j]) + 1) for j in component]):
+        if any(all(codes[a] == k for a, k in restriction) for restriction in restrictions):
+            continue
+        prob = profile_weight(compiled, weights, conditionals, component, codes)
+        distribution[codes] = prob
+        total = total + prob
+    if total <= 0:
+        raise ValueError("The restrictions rule out every profile")
+    return {codes: prob/total for codes, prob in distribution.items()}
+
+# Expected level probabilities of a generated profile, for every level and every pair of attributes
+# Returns (marginal, joint): marginal[j][k-1] and joint[(j, j2)][(k-1)*len(levels j2) + k2-1] for j < j2
+def expected_level_probabilities(compiled):
+    weights = sampling_weights(compiled)
+    num_attributes = len(compiled.attributes)
+    marginal = [list(w) for w in weights]
+    joint = {}
+    component_of = {}
+    for component in restriction_components(compiled):
+        for j in component:
+            component_of[j] = component
+        if len(component) == 1:
+            continue
+        for j in component:
+            marginal[j] = [0.0]*len(compiled.levels[j])
+        pairs = [(a, b) for a in range(len(component)) for b in range(a + 1, len(component))]
+        for a, b in pairs:
+            joint[(component[a], component[b])] = [0.0]*(len(compiled.levels[component[a]])*len(compiled.levels[component[b]]))
+        for codes, prob in component_distribution(compiled, component, weights).items():
+            for a in range(len(component)):
+                marginal[component[a]][codes[a]-1] = marginal[component[a]][codes[a]-1] + prob
+            for a, b in pairs:
+                table = joint[(component[a], component[b])]
+                index = (codes[a]-1)*len(compiled.levels[component[b]]) + codes[b]-1
+                table[index] = table[index] + prob
+    for j in range(num_attributes):
+        for j2 in range(j + 1, num_attributes):
+            if (j, j2) not in joint:
+                joint[(j, j2)] = [p*p2 for p in marginal[j] for p2 in marginal[j2]]
+    return marginal, joint
+
+# Expected display position probabilities under attribute order randomization. The randomizers shuffle the
+# attributes that do not follow another one in an order constraint, then insert each constraint's other
+# attributes right after its first. Returns position[j][r-1] = probability attribute j is shown in row r.
+def expected_position_probabilities(compiled):
+    num_attributes = len(compiled.attributes)
+    position = [[0.0]*num_attributes for j in range(num_attributes)]
+    if compiled.randomize != 1:
+        for j in range(num_attributes):
+            position[j][j] = 1.0
+        return position
+    tails = set()
+    blocks = {}
+    for constraint in compiled.constraints:
+        if len(constraint) > 1:
+            blocks[constraint[0]] = constraint
+            tails.update(constraint[1:])
+    units = [blocks.get(j, (j,)) for j in range(num_attributes) if j not in tails]
+    M = len(units)
+    for u in range(M):
+        # ways[c][s]: number of c-subsets of the other units whose sizes add up to s
+        ways = [[0]*(num_attributes + 1) for c in range(M)]
+        ways[0][0] = 1
+        for v in range(M):
+            if v == u:
+                continue
+            size = len(units[v])
+            for c in range(M - 1, 0, -1):
+                for s in range(num_attributes, size - 1, -1):
+                    ways[c][s] = ways[c][s] + ways[c-1][s-size]
+        for c in range(M):
+            for s in range(num_attributes + 1):
+                if ways[c][s] == 0:
+                    continue
+                prob = ways[c][s]/math.comb(M - 1, c)/M
+                for offset in range(len(units[u])):
+                    position[units[u][offset]][s + offset] = position[units[u][offset]][s + offset] + prob
+    return position
+
+# Chi-square goodness of fit of observed counts to expected probabilities. Cells with zero probability are
+# left out of the statistic; any count in them is reported as impossible.
+def chi_square_test(observed, probabilities):
+    n = sum(observed)
+    statistic = 0.0
+    cells = 0
+    impossible = 0
+    for count, prob in zip(observed, probabilities):
+        if prob <= 0:
+            impossible = impossible + count
+            continue
+        expected = n*prob
+        statistic = statistic + (count - expected)**2/expected
+        cells = cells + 1
+    df = cells - 1
+    p_value = chi_square_sf(statistic, df) if df > 0 and n > 0 else None
+    return {"n": n, "statistic": statistic, "df": df, "p_value": p_value, "impossible": impossible}
+
+# Upper tail probability of the chi-square distribution (regularized upper incomplete gamma function)
+def chi_square_sf(x, df):
+    a = df/2.0
+    x = x/2.0
+    if x <= 0:
+        return 1.0
+    log_front = a*math.log(x) - x - math.lgamma(a)
+    if x < a + 1:
+        term = 1.0/a
+        total = term
+        n = a
+        while abs(term) > abs(total)*1e-15:
+            n = n + 1
+            term = term*x/n
+            total = total + term
+        return max(0.0, 1.0 - total*math.exp(log_front))
+    # Continued fraction (modified Lentz)
+    tiny = 1e-300
+    b = x + 1 - a
+    c = 1/tiny
+    d = 1/b
+    h = d
+    for i in range(1, 1000):
+        an = -i*(i - a)
+        b = b + 2
+        d = an*d + b
+        d = tiny if abs(d) < tiny else d
+        c = b + an/c
+        c = tiny if abs(c) < tiny else c
+        d = 1/d
+        delta = d*c
+        h = h*delta
+        if abs(delta - 1) < 1e-15:
+            break
+    return math.exp(log_front)*h
+
+# Compare fielded data with what the design's randomizer should produce: level frequencies of every attribute,
+# co-occurrence of the levels of every pair of attributes within a profile, and display positions of every
+# attribute (counted once per respondent, from the first task, since the order is drawn once).
+# The column store is read in one pass; only the count tables are kept. Every table gets a chi-square test
+# against the exact expected probabilities and is flagged when its p-value is below alpha (or when it has
+# counts in cells the restrictions rule out).
+# Expected probabilities ignore the rejection of duplicate profiles within a task.
+def balance_diagnostics(store_dir, design, alpha=0.01, chunk_rows=100000):
+    compiled = compiledDesign(design)
+    num_attributes = len(compiled.attributes)
+    level_cols = ["L" + str(j+1) for j in range(num_attributes)]
+    position_cols = ["P" + str(j+1) for j in range(num_attributes)]
+    level_counts = [array.array("q", [0]*len(levels)) for levels in compiled.levels]
+    pair_counts = {}
+    for j in range(num_attributes):
+        for j2 in range(j + 1, num_attributes):
+            pair_counts[(j, j2)] = array.array("q", [0]*(len(compiled.levels[j])*len(compiled.levels[j2])))
+    position_counts = [array.array("q", [0]*num_attributes) for j in range(num_attributes)]
+    # Each chunk is counted per attribute and per pair of attributes, so memory stays at the size of the tables
+    for chunk in iter_long_chunks(store_dir, ["task", "profile"] + level_cols + position_cols, chunk_rows):
+        for j in range(num_attributes):
+            for k, count in collections.Counter(chunk[level_cols[j]]).items():
+                if 0 < k <= len(compiled.levels[j]):
+                    level_counts[j][k-1] = level_counts[j][k-1] + count
+            for j2 in range(j + 1, num_attributes):
+                width = len(compiled.levels[j2])
+                for (k, k2), count in collections.Counter(zip(chunk[level_cols[j]], chunk[level_cols[j2]])).items():
+                    if 0 < k <= len(compiled.levels[j]) and 0 < k2 <= width:
+                        index = (k-1)*width + k2-1
+                        pair_counts[(j, j2)][index] = pair_counts[(j, j2)][index] + count
+        for i in range(len(chunk["task"])):
+            if chunk["task"][i] == 1 and chunk["profile"][i] == 1:
+                for j in range(num_attributes):
+                    position = chunk[position_cols[j]][i]
+                    if 0 < position <= num_attributes:
+                        position_counts[j][position-1] = position_counts[j][position-1] + 1
+
+    marginal, joint = expected_level_probabilities(compiled)
+    positions = expected_position_probabilities(compiled)
+    results = []
+    for j in range(num_attributes):
+        results.append(balance_row("levels", compiled.attributes[j], None, level_counts[j], marginal[j], alpha))
+    for j, j2 in sorted(pair_counts):
+        results.append(balance_row("pairs", compiled.attributes[j], compiled.attributes[j2], pair_counts[(j, j2)], joint[(j, j2)], alpha))
+    for j in range(num_attributes):
+        results.append(balance_row("positions", compiled.attributes[j], None, position_counts[j], positions[j], alpha))
+    return results
+
+def balance_row(table, attribute, attribute2, observed, probabilities, alpha):
+    row = {"table": table, "attribute": attribute, "attribute2": attribute2}
+    row.update(chi_square_test(observed, probabilities))
+    row["flagged"] = row["impossible"] > 0 or (row["p_value"] != None and row["p_value"] < alpha)
+    return row
+
+# -- Design space --
+# Restrictions as {attribute index: level code}; restrictions that ask for two levels of one attribute never
+# match and are left out
+def restriction_requirements(compiled):
+    requirements = []
+    for restriction in compiled.restrictions:
+        required = {}
+        for j, k in restriction:
+            if required.get(j, k) != k:
+                required = None
+                break
+            required[j] = k
+        if required != None:
+            requirements.append(required)
+    return requirements
+
+# Exact level weights as fractions (the float weights are converted through their shortest decimal form)
+def exact_weights(weights):
+    fractions = [Fraction(repr(w)) for w in weights]
+    total = sum(fractions)
+    return [w/total for w in fractions]
+
+def exact_sampling_weights(compiled):
+    return [exact_weights(weights) for weights in sampling_weights(compiled)]
+
+# The same before any fitting to the restrictions (what the design weights say)
+def exact_design_weights(compiled):
+    if compiled.weighted == 1:
+        return [exact_weights(weights) for weights in compiled.weights]
+    return exact_sampling_weights(compiled)
+
+# sampling_conditionals with exact rows
+def exact_conditionals(compiled):
+    return {j: (parents, [exact_weights(row) for row in rows]) for j, (parents, rows) in sampling_conditionals(compiled).items()}
+
+# Number (or total weight, if weights are given) of the level combinations of the attributes in component that
+# no restriction rules out, by dynamic programming over the attributes: the state is the set of restrictions
+# that have matched every attribute assigned so far but still have attributes to come. Levels that no
+# restriction in play mentions lead to the same state and are counted together.
+def count_component(compiled, component, requirements, weights=None):
+    requirements = [required for required in requirements if any(j in required for j in component)]
+    # Attribute order: next the attribute that closes the most open restrictions and opens the fewest new ones
+    order = []
+    remaining = set(component)
+    while len(remaining) > 0:
+        def cost(j):
+            opened = set(order) | {j}
+            open_after = sum(1 for r in requirements if any(a in opened for a in r) and not all(a in opened for a in r))
+            return (open_after, j)
+        j = min(remaining, key=cost)
+        order.append(j)
+        remaining.remove(j)
+    position = {j: p for p, j in enumerate(order)}
+    first = [min(position[j] for j in r) for r in requirements]
+    last = [max(position[j] for j in r) for r in requirements]
+
+    states = {frozenset(): 1}
+    for p, j in enumerate(order):
+        touching = [r for r in range(len(requirements)) if j in requirements[r]]
+        if weights != None:
+            level_weight = weights[j]
+        else:
+            level_weight = [1]*len(compiled.levels[j])
+        mentioned = sorted(set(requirements[r][j] for r in touching))
+        other = sum(level_weight[k-1] for k in range(1, len(level_weight) + 1) if k not in mentioned)
+        new_states = {}
+        for alive, value in states.items():
+            # Levels no touching restriction mentions end every touching restriction
+            if other != 0:
+                key = alive.difference(touching)
+                new_states[key] = new_states.get(key, 0) + value*other
+            for k in mentioned:
+                if level_weight[k-1] == 0:
+                    continue
+                next_alive = set(alive)
+                rejected = False
+                for r in touching:
+                    if first[r] < p and r not in alive:
+                        continue
+                    if requirements[r][j] != k:
+                        next_alive.discard(r)
+                    elif last[r] == p:
+                        rejected = True
+                        break
+                    else:
+                        next_alive.add(r)
+                if rejected:
+                    continue
+                key = frozenset(next_alive)
+                new_states[key] = new_states.get(key, 0) + value*level_weight[k-1]
+        states = new_states
+    return sum(states.values())
+
+# Size of the design space: the number of distinct profiles with and without the restrictions, and the
+# probability that a profile drawn with the design's level weights passes the restrictions (the randomizers
+# redraw the others, so 1/acceptance is the expected number of draws per profile). The attributes are split
+# into groups connected by restrictions and each group is counted separately; all counts are exact. The weight
+# of a group with conditional weights is summed over its allowed combinations instead of counted.
+def count_design_space(design):
+    compiled = compiledDesign(design)
+    requirements = restriction_requirements(compiled)
+    weights = exact_sampling_weights(compiled)
+    conditionals = exact_conditionals(compiled)
+    profiles = 1
+    feasible = 1
+    acceptance = Fraction(1)
+    components = []
+    for component in restriction_components(compiled):
+        size = 1
+        for j in component:
+            size = size*len(compiled.levels[j])
+        count = count_component(compiled, component, requirements)
+        if any(j in conditionals for j in component):
+            mass = sum(profile_weight(compiled, weights, conditionals, component, combo) for combo in component_profiles(compiled, component, requirements))
+        else:
+            mass = count_component(compiled, component, requirements, weights)
+        profiles = profiles*size
+        feasible = feasible*count
+        acceptance = acceptance*mass
+        if len(component) > 1:
+            components.append({"attributes": [compiled.attributes[j] for j in component], "profiles": size, "feasible": count, "acceptance": mass})
+    return {"profiles": profiles, "feasible": feasible, "acceptance": acceptance, "components": components}
+
+# Fallback tables for the exported randomizers: for each group of attributes connected by restrictions
+# (single attributes included), the level combinations that no restriction rules out and that have a
+# positive weight, as (attribute indices, combinations of 0-based level indices, combination weights or
+# None for equal weights). Drawing one combination per group with these weights gives the same
+# distribution as redrawing restricted profiles, and stepping through the combinations in order visits
+# every allowed profile.
+# The tables are only needed when a respondent is likely to reach the retry budget: when the chance that any
+# of their profiles is rejected retry_budget times in a row is over fallback_risk, or when duplicates are not
+# allowed and there are fewer than 10 allowed profiles per profile in a task. Returns (units, needed), with
+# units None if the tables are not needed, would exceed max_entries combinations, or enabled is False.
+# Raises ValueError if no profile is allowed, or if a task cannot be filled with distinct profiles when
+# duplicates are not allowed.
+fallback_risk = 1e-6
+
+def fallback_units(compiled, retry_budget=1000, max_entries=1000000, enabled=True):
+    requirements = restriction_requirements(compiled)
+    weights = sampling_weights(compiled)
+    conditionals = sampling_conditionals(compiled)
+    # Levels of attributes with conditional weights are only ruled out by a zero in their rows
+    positive = [[1 if w > 0 or j in conditionals else 0 for w in weights[j]] for j in range(len(weights))]
+
+    def allowed(component):
+        combos = []
+        combo_weights = []
+        for combo in component_profiles(compiled, component, requirements):
+            weight = profile_weight(compiled, weights, conditionals, component, combo)
+            if weight > 0:
+                combos.append(tuple(k - 1 for k in combo))
+                combo_weights.append(weight)
+        return combos, combo_weights
+
+    components = restriction_components(compiled)
+    tables = {}
+    distinct = 1
+    entries = 0
+    acceptance = 1.0
+    for c, component in enumerate(components):
+        count = count_component(compiled, component, requirements, positive)
+        entries = entries + count
+        if any(j in conditionals for j in component):
+            # The weight of the allowed combinations has to be summed over them; a group too large to list
+            # is taken to need the fallback
+            if count <= max_entries:
+                tables[c] = allowed(component)
+                count = len(tables[c][0])
+                acceptance = acceptance*sum(tables[c][1])
+            else:
+                acceptance = 0.0
+        else:
+            acceptance = acceptance*count_component(compiled, component, requirements, weights)
+        if count == 0:
+            raise ValueError("The restrictions rule out every profile of " + ", ".join(compiled.attributes[j] for j in component))
+        distinct = distinct*count
+    if compiled.no_duplicates == 1 and distinct < compiled.profiles:
+        raise ValueError("The design allows only " + str(distinct) + " distinct profiles, fewer than the " + str(compiled.profiles) + " profiles in each task")
+    risk = compiled.tasks*compiled.profiles*max(0.0, 1 - acceptance)**max(retry_budget, 0)
+    needed = risk > fallback_risk or (compiled.no_duplicates == 1 and distinct < 10*compiled.profiles)
+    if not needed or not enabled or entries > max_entries:
+        return None, needed
+    units = []
+    for c, component in enumerate(components):
+        combos, combo_weights = tables[c] if c in tables else allowed(component)
+        units.append((component, combos, combo_weights if compiled.weighted == 1 else None))
+    return units, needed
+
+# -- Marginal fitting --
+# The randomizers redraw restricted profiles, so levels that appear in many restrictions are shown less often
+# than their weight says. fit_weights finds the weights to draw with so that the level shares of the generated
+# profiles (expected_level_probabilities) equal the design's weights again, by iterative proportional fitting
+# over the allowed level combinations of each group of attributes linked by restrictions: each attribute's
+# weights are multiplied in turn by target share/current share, until the largest difference between the shares
+# and the targets is at most tol. Groups with at most max_exact allowed combinations are fitted exactly, larger
+# ones on a fixed uniform sample of their allowed combinations (the shares are then estimates). Attributes with
+# conditional weights keep them and are not fitted. Returns a dictionary with the fitted weights of every
+# attribute, whether every group converged, the largest number of sweeps and the largest difference left,
+# whether any group was sampled, and one (attribute index, level code, target, share before, share after)
+# entry per level of the fitted attributes.
+def fit_weights(compiled, tol=1e-9, max_iter=1000, max_exact=100000, samples=20000, seed=0):
+    requirements = restriction_requirements(compiled)
+    conditionals = sampling_conditionals(compiled)
+    targets = [list(w) for w in compiled.weights]
+    weights = [list(w) for w in compiled.weights]
+    ones = [[1]*len(levels) for levels in compiled.levels]
+    rng = random.Random(seed)
+    result = {"converged": True, "iterations": 0, "max_error": 0.0, "sampled": False, "levels": []}
+    for component in restriction_components(compiled):
+        fitted = [a for a, j in enumerate(component) if j not in conditionals]
+        if len(component) == 1:
+            j = component[0]
+            result["levels"].extend((j, k + 1, targets[j][k], targets[j][k], targets[j][k]) for k in range(len(targets[j])))
+            continue
+        if count_component(compiled, component, requirements) <= max_exact:
+            combos = component_profiles(compiled, component, requirements)
+        else:
+            combos = sample_feasible(compiled, component, requirements, samples, rng)
+            result["sampled"] = True
+        if len(combos) == 0 or len(fitted) == 0:
+            continue
+        # Conditional weights stay fixed; the fitted weights are multiplied in
+        fixed = [profile_weight(compiled, ones, conditionals, component, combo) for combo in combos]
+
+        def combo_weights():
+            return [fixed[c]*math.prod(weights[component[a]][combo[a]-1] for a in fitted) for c, combo in enumerate(combos)]
+
+        def shares(current, a):
+            share = [0.0]*len(compiled.levels[component[a]])
+            for c, combo in enumerate(combos):
+                share[combo[a]-1] = share[combo[a]-1] + current[c]
+            total = sum(share)
+            return [s/total for s in share] if total > 0 else share
+
+        current = combo_weights()
+        before = {a: shares(current, a) for a in fitted}
+        for sweep in range(max_iter + 1):
+            error = max(abs(s - t) for a in fitted for s, t in zip(shares(current, a), targets[component[a]]))
+            if error <= tol or sweep == max_iter:
+                break
+            for a in fitted:
+                j = component[a]
+                share = shares(current, a)
+                # Levels that no allowed combination can show keep their weight
+                factor = [t/s if s > 0 else 1.0 for s, t in zip(share, targets[j])]
+                weights[j] = normalize_weights([w*f for w, f in zip(weights[j], factor)])
+                current = [current[c]*factor[combo[a]-1] for c, combo in enumerate(combos)]
+            # Start each sweep from the weights themselves so rounding does not build up
+            current = combo_weights()
+        result["converged"] = result["converged"] and error <= tol
+        result["iterations"] = max(result["iterations"], sweep)
+        result["max_error"] = max(result["max_error"], error)
+        for a in fitted:
+            j = component[a]
+            after = shares(current, a)
+            result["levels"].extend((j, k + 1, targets[j][k], before[a][k], after[k]) for k in range(len(targets[j])))
+    result["weights"] = tuple(tuple(w) for w in weights)
+    return result
+
+# A uniform random sample (with replacement) of the level combinations of the attributes in component that no
+# restriction rules out, drawn by rejection
+def sample_feasible(compiled, component, requirements, samples, rng):
+    requirements = [required for required in requirements if any(j in required for j in component)]
+    sizes = [len(compiled.levels[j]) for j in component]
+    combos = []
+    draws = 0
+    while len(combos) < samples:
+        draws = draws + 1
+        if draws > 1000*samples:
+            raise ValueError("The restrictions allow too few profiles of " + ", ".join(compiled.attributes[j] for j in component) + " to sample them")
+        combo = tuple(rng.randrange(size) + 1 for size in sizes)
+        assigned = dict(zip(component, combo))
+        if not any(all(assigned[j] == k for j, k in required.items()) for required in requirements):
+            combos.append(combo)
+    return combos
+
+# -- Feasible profile enumeration --
+# Every profile the restrictions allow, written to disk: a directory with meta.json and profiles.bin, one row
+# per profile of one unsigned little-endian level code per attribute (1 byte each, or 2 if an attribute has
+# more than 255 levels), in design attribute order.
+# The allowed profiles are the Cartesian product of the allowed level combinations of each group of attributes
+# connected by restrictions (restriction_components), so only those groups are filtered against the
+# restrictions; the product is then written without further checks. Rows are split into shards over the
+# combinations of the largest group, and each worker process writes its shard straight into its slice of the
+# memory-mapped output file.
+def component_profiles(compiled, component, requirements):
+    requirements = [required for required in requirements if any(j in required for j in component)]
+    combos = []
+    assigned = {}
+    def extend(a):
+        if a == len(component):
+            combos.append(tuple(assigned[j] for j in component))
+            return
+        j = component[a]
+        for k in range(1, len(compiled.levels[j]) + 1):
+            assigned[j] = k
+            if not any(all(assigned.get(j2) == k2 for j2, k2 in required.items()) for required in requirements if j in required):
+                extend(a + 1)
+        del assigned[j]
+    extend(0)
+    return combos
+
+# Packed row fragments of a group's combinations: the sum of one fragment per group is the row read as a
+# little-endian integer
+def packed_fragments(component, combos, width):
+    return [sum(k << (8*width*j) for j, k in zip(component, combo)) for combo in combos]
+
+def enumerate_shard(filename, row_bytes, width, start_row, parts, block_rows=65536):
+    with open(filename, "r+b") as out_file:
+        mapped = mmap.mmap(out_file.fileno(), 0)
+        try:
+            position = start_row*row_bytes
+            rows = (sum(fragments) for fragments in itertools.product(*parts))
+            while True:
+                block = b"".join(value.to_bytes(row_bytes, "little") for value in itertools.islice(rows, block_rows))
+                if len(block) == 0:
+                    break
+                mapped[position:position + len(block)] = block
+                position = position + len(block)
+            mapped.flush()
+        finally:
+            mapped.close()
+
+def enumerate_profiles(design, out_dir, processes=None, shards=None, max_bytes=2**34):
+    compiled = compiledDesign(design)
+    num_attributes = len(compiled.attributes)
+    width = 1 if max(len(levels) for levels in compiled.levels) <= 255 else 2
+    row_bytes = width*num_attributes
+    requirements = restriction_requirements(compiled)
+    components = restriction_components(compiled)
+    total = 1
+    for component in components:
+        total = total*count_component(compiled, component, requirements)
+    if total*row_bytes > max_bytes:
+        raise ValueError("The design allows " + str(total) + " profiles (" + str(total*row_bytes) + " bytes), more than the limit of " + str(max_bytes) + " bytes")
+
+    parts = [packed_fragments(component, component_profiles(compiled, component, requirements), width) for component in components]
+    parts.sort(key=len, reverse=True)
+    os.makedirs(out_dir, exist_ok=True)
+    filename = os.path.join(out_dir, "profiles.bin")
+    with open(filename, "wb") as out_file:
+        out_file.truncate(total*row_bytes)
+
+    if total > 0:
+        if processes == None:
+            processes = os.cpu_count() or 1
+        if shards == None:
+            shards = 4*processes
+        leading = parts[0]
+        rest_rows = total//len(leading)
+        step = max(1, -(-len(leading)//shards))
+        jobs = [(filename, row_bytes, width, start*rest_rows, [leading[start:start+step]] + parts[1:]) for start in range(0, len(leading), step)]
+        if processes == 1:
+            for job in jobs:
+                enumerate_shard(*job)
+        else:
+            with multiprocessing.Pool(processes) as pool:
+                pool.starmap(enumerate_shard, jobs)
+
+    meta = {"attributes": list(compiled.attributes), "levels": [list(levels) for levels in compiled.levels], "rows": total, "width": width}
+    with open(os.path.join(out_dir, "meta.json"), "w", encoding="utf-8") as meta_file:
+        json.dump(meta, meta_file)
+    return meta
+
+# Open an enumerated profile file. Returns the metadata and a read-only view indexed view[row, attribute]
+# (level codes), memory-mapped from disk
+def read_profiles(profile_dir):
+    with open(os.path.join(profile_dir, "meta.json"), encoding="utf-8") as meta_file:
+        meta = json.load(meta_file)
+    shape = [meta["rows"], len(meta["attributes"])]
+    code = "B" if meta["width"] == 1 else "H"
+    filename = os.path.join(profile_dir, "profiles.bin")
+    if meta["rows"] == 0 or shape[1] == 0:
+        # memoryview cannot have an empty dimension
+        return meta, memoryview(array.array(code))
+    with open(filename, "rb") as in_file:
+        mapped = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+    if code == "H" and sys.byteorder != "little":
+        swapped = array.array(code, mapped)
+        swapped.byteswap()
+        return meta, memoryview(swapped).cast("B").cast(code, shape)
+    return meta, memoryview(mapped).cast(code, shape)
+
+# -- Profile generation --
+# profileGenerator is the Python counterpart of the exported randomizers: given the same design it draws
+# attribute orders and profiles with the same distribution as the PHP and JavaScript exports.
+# The design is compiled once into tuples of integers: Walker alias tables for the level draws (one per row of
+# conditional weights), restrictions indexed by the level they start with, the blocks of the attribute order,
+# and the embedded data keys.
+# Like the exports, it redraws a profile at most retry_budget times and then draws it from the fallback_units
+# tables (when the design needs them), and construction raises ValueError for designs that cannot fill a task.
+# Nothing is changed after construction, so one generator can be shared by any number of threads as long
+# as each thread draws from its own random stream (new_stream). Profiles are tuples of level codes in design
+# attribute order; an attribute order is a tuple of attribute indices in display order.
+def alias_table(weights):
+    n = len(weights)
+    total = float(sum(weights))
+    scaled = [w*n/total for w in weights]
+    prob = [1.0]*n
+    alias = list(range(n))
+    small = [k for k in range(n) if scaled[k] < 1.0]
+    large = [k for k in range(n) if scaled[k] >= 1.0]
+    while len(small) > 0 and len(large) > 0:
+        s = small.pop()
+        l = large.pop()
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] = scaled[l] + scaled[s] - 1.0
+        if scaled[l] < 1.0:
+            small.append(l)
+        else:
+            large.append(l)
+    return tuple(prob), tuple(alias)
+
+class profileGenerator:
+
+    def __init__(self, compiled):
+        self.compiled = compiled
+        self.num_attributes = len(compiled.attributes)
+        if any(len(levels) == 0 for levels in compiled.levels):
+            raise ValueError("Some attributes have no levels")
+        units, needed = fallback_units(compiled, compiled.retry_budget, enabled=compiled.fallback == 1)
+        self.retry_budget = compiled.retry_budget
+        # Fallback tables as (attribute indices, combinations of level codes, cumulative weights or None)
+        self.units = None
+        if units != None:
+            self.units = tuple((tuple(component), tuple(tuple(k + 1 for k in combo) for combo in combos),
+                                None if weights == None else tuple(itertools.accumulate(weights))) for component, combos, weights in units)
+        self.sizes = tuple(len(levels) for levels in compiled.levels)
+        tables = [alias_table(weights) for weights in sampling_weights(compiled)]
+        self.alias_prob = tuple(table[0] for table in tables)
+        self.alias = tuple(table[1] for table in tables)
+
+        # Attributes with conditional weights are drawn again after the others, parents first, from the alias
+        # table of the row for their parents' levels: (attribute, parents, probabilities per row, aliases per row)
+        conditionals = sampling_conditionals(compiled)
+        redraws = []
+        for j in compiled.draw_order:
+            if j in conditionals:
+                parents, rows = conditionals[j]
+                row_tables = [alias_table(row) for row in rows]
+                redraws.append((j, parents, tuple(table[0] for table in row_tables), tuple(table[1] for table in row_tables)))
+        self.redraws = tuple(redraws)
+
+        # checks[j][k]: for each restriction whose first pair is level k of attribute j, its other pairs
+        checks = [[[] for k in range(size + 1)] for size in self.sizes]
+        for restriction in compiled.restrictions:
+            j, k = restriction[0]
+            checks[j][k].append(restriction[1:])
+        self.checks = tuple(tuple(tuple(level) for level in attribute) for attribute in checks)
+        self.restricted = len(compiled.restrictions) > 0
+        self.no_duplicates = compiled.no_duplicates == 1
+
+        # Attribute order: the free attributes are shuffled, then each is replaced by its block
+        tails = set()
+        blocks = {}
+        for constraint in compiled.constraints:
+            if len(constraint) > 1:
+                blocks[constraint[0]] = constraint
+                tails.update(constraint[1:])
+        self.free = tuple(j for j in range(self.num_attributes) if j not in tails)
+        self.blocks = tuple(blocks.get(j, (j,)) for j in range(self.num_attributes))
+        self.randomize = compiled.randomize == 1
+
+        # One tuple of attribute name keys per task, or a single one when the order is stored once
+        self.attribute_keys = tuple(tuple(attribute_key(t+1, a+1, compiled.order_once == 1) for a in range(self.num_attributes)) for t in range(1 if compiled.order_once == 1 else compiled.tasks))
+        self.level_keys = tuple(tuple(tuple("F-" + str(t+1) + "-" + str(i+1) + "-" + str(a+1) for a in range(self.num_attributes)) for i in range(compiled.profiles)) for t in range(compiled.tasks))
+
+    def new_stream(self, seed=None):
+        return random.Random(seed)
+
+    def attribute_order(self, rng):
+        if not self.randomize:
+            return tuple(range(self.num_attributes))
+        free = list(self.free)
+        rng.shuffle(free)
+        return tuple(j for unit in free for j in self.blocks[unit])
+
+    def allowed(self, profile):
+        for j in range(self.num_attributes):
+            for others in self.checks[j][profile[j]]:
+                if all(profile[j2] == k2 for j2, k2 in others):
+                    return False
+        return True
+
+    # Draw profiles until one is not ruled out by a restriction (nor, if duplicates are rejected, identical
+    # to one already in the task), or from the fallback tables once retry_budget draws have failed
+    def profile(self, rng, task=()):
+        sizes = self.sizes
+        alias_prob = self.alias_prob
+        alias = self.alias
+        draw = rng.random
+        tries = 0
+        while True:
+            tries = tries + 1
+            if tries > self.retry_budget and self.units != None:
+                return self.fallback_profile(rng, task)
+            profile = []
+            for j in range(self.num_attributes):
+                u = draw()*sizes[j]
+                k = int(u)
+                profile.append(k + 1 if u - k < alias_prob[j][k] else alias[j][k] + 1)
+            for j, parents, row_prob, row_alias in self.redraws:
+                row = 0
+                for p in parents:
+                    row = row*sizes[p] + profile[p] - 1
+                u = draw()*sizes[j]
+                k = int(u)
+                profile[j] = k + 1 if u - k < row_prob[row][k] else row_alias[row][k] + 1
+            profile = tuple(profile)
+            if self.restricted and not self.allowed(profile):
+                continue
+            if self.no_duplicates and profile in task:
+                continue
+            return profile
+
+    # One combination per group of attributes with the fallback weights; if duplicates are rejected, the
+    # allowed profiles are stepped through in order from there until one is new (fallback_units checked that
+    # there are enough), as in the exports
+    def fallback_profile(self, rng, task):
+        choice = []
+        for component, combos, cumulative in self.units:
+            if cumulative == None:
+                choice.append(rng.randrange(len(combos)))
+            else:
+                choice.append(min(bisect.bisect_right(cumulative, rng.random()*cumulative[-1]), len(combos) - 1))
+        while True:
+            profile = [0]*self.num_attributes
+            for u in range(len(self.units)):
+                component, combos, cumulative = self.units[u]
+                for j, k in zip(component, combos[choice[u]]):
+                    profile[j] = k
+            profile = tuple(profile)
+            if not (self.no_duplicates and profile in task):
+                return profile
+            for u in range(len(self.units)):
+                choice[u] = choice[u] + 1
+                if choice[u] < len(self.units[u][1]):
+                    break
+                choice[u] = 0
+
+    def task(self, rng):
+        task = []
+        for i in range(self.compiled.profiles):
+            task.append(self.profile(rng, task))
+        return tuple(task)
+
+    # One respondent: attribute order and the profiles of every task
+    def respondent(self, rng):
+        order = self.attribute_order(rng)
+        return order, tuple(self.task(rng) for t in range(self.compiled.tasks))
+
+    # A respondent's embedded data, with the keys in the order the PHP export fills them
+    def embedded_data(self, order, tasks):
+        attributes = self.compiled.attributes
+        levels = self.compiled.levels
+        fields = {}
+        for attribute_keys in self.attribute_keys:
+            for a in range(len(order)):
+                fields[attribute_keys[a]] = attributes[order[a]]
+        for t in range(len(tasks)):
+            for i in range(len(tasks[t])):
+                profile = tasks[t][i]
+                level_keys = self.level_keys[t][i]
+                for a in range(len(order)):
+                    j = order[a]
+                    fields[level_keys[a]] = levels[j][profile[j]-1]
+        return fields
+
+# -- Synthetic responses --
+# Part-worth utilities from a .json file {attribute: {level: utility}}; levels not listed have utility 0.
+# Returns utilities[j][k-1].
+def read_utilities(filename, compiled):
+    utilities = [[0.0]*len(levels) for levels in compiled.levels]
+    if filename == None:
+        return utilities
+    with open(filename, encoding="utf-8") as in_file:
+        table = json.load(in_file)
+    for attr, levels in table.items():
+        if attr not in compiled.attr_index:
+            raise ValueError("Unknown attribute in utilities: " + attr)
+        j = compiled.attr_index[attr]
+        for level, value in levels.items():
+            if level not in compiled.level_index[j]:
+                raise ValueError("Unknown level of " + attr + " in utilities: " + level)
+            utilities[j][compiled.level_index[j][level]-1] = float(value)
+    return utilities
+
+# Respondents choose the profile with the highest utility plus Gumbel noise (a multinomial logit model)
+def choose_profile(task, utilities, rng):
+    best = 0
+    best_value = None
+    for i in range(len(task)):
+        value = sum(utilities[j][task[i][j]-1] for j in range(len(task[i]))) - math.log(-math.log(1.0 - rng.random()))
+        if best_value == None or value > best_value:
+            best = i
+            best_value = value
+    return best + 1
+
+synthetic_state = {}
+
+def synthetic_init(compiled, utilities, output):
+    synthetic_state["compiled"] = compiled
+    synthetic_state["utilities"] = utilities
+    synthetic_state["output"] = output
+    synthetic_state["generator"] = profileGenerator(compiled)
+
+# Generates one block of respondents from its own random stream, as .csv rows or as a long-format chunk
+def synthetic_block(seed, block, first, count):
+    compiled = synthetic_state["compiled"]
+    utilities = synthetic_state["utilities"]
+    generator = synthetic_state["generator"]
+    rng = random.Random(str(seed) + "-" + str(block))
+    num_attributes = len(compiled.attributes)
+    if synthetic_state["output"] == "csv":
+        rows = []
+    else:
+        rows = new_chunk(long_columns(num_attributes))
+    for r in range(first, first + count):
+        order, tasks = generator.respondent(rng)
+        choices = [choose_profile(task, utilities, rng) for task in tasks]
+        if synthetic_state["output"] == "csv":
+            row = ["R_" + str(r + 1)]
+            for t in range(1 if compiled.order_once == 1 else compiled.tasks):
+                row.extend(compiled.attributes[j] for j in order)
+            for t in range(compiled.tasks):
+                for profile in tasks[t]:
+                    row.extend(compiled.levels[j][profile[j]-1] for j in order)
+            rows.append(row + choices)
+            continue
+        for t in range(compiled.tasks):
+            for i in range(compiled.profiles):
+                rows["respondent"].append(r)
+                rows["task"].append(t + 1)
+                rows["profile"].append(i + 1)
+                rows["selected"].append(1 if choices[t] == i + 1 else 0)
+                for a in range(num_attributes):
+                    rows["L" + str(order[a]+1)].append(tasks[t][i][order[a]])
+                    rows["P" + str(order[a]+1)].append(a + 1)
+    return rows
+
+def synthetic_header(compiled, choice_prefix):
+    header = ["ResponseId"]
+    for t in range(1, (1 if compiled.order_once == 1 else compiled.tasks) + 1):
+        header.extend(attribute_key(t, a, compiled.order_once == 1) for a in range(1, len(compiled.attributes) + 1))
+    for t in range(1, compiled.tasks + 1):
+        for p in range(1, compiled.profiles + 1):
+            header.extend("F-" + str(t) + "-" + str(p) + "-" + str(a) for a in range(1, len(compiled.attributes) + 1))
+    return header + [choice_prefix + str(t) for t in range(1, compiled.tasks + 1)]
+
+# Write synthetic fielded data for a design: a Qualtrics-style .csv export (output="csv", with the F- embedded
+# data fields and one choice column per task named choice_prefix + task number) or a long-format column store
+# as written by ingest_qualtrics (output="long"). Respondents are generated in blocks of block_size on a pool
+# of processes, each block from its own seeded random stream, and written in order as they arrive; at most a
+# few blocks per process are held in memory.
+def generate_responses(design, out_name, respondents, output="csv", utilities_file=None, seed=0, processes=None, block_size=1000, choice_prefix="C"):
+    compiled = compiledDesign(design)
+    if len(compiled.attributes) == 0 or any(len(levels) == 0 for levels in compiled.levels):
+        raise ValueError("Every attribute needs at least one level")
+    # Raises ValueError before any worker starts if the design cannot fill a task
+    profileGenerator(compiled)
+    utilities = read_utilities(utilities_file, compiled)
+    blocks = [(seed, block, block*block_size, min(block_size, respondents - block*block_size)) for block in range((respondents + block_size - 1)//block_size)]
+    if processes == 1:
+        synthetic_init(compiled, utilities, output)
+        results = itertools.starmap(synthetic_block, blocks)
+        synthetic_write(compiled, out_name, output, respondents, choice_prefix, results)
+    else:
+        if processes == None:
+            processes = os.cpu_count() or 1
+        with multiprocessing.Pool(processes, synthetic_init, (compiled, utilities, output)) as pool:
+            window = 4*processes
+            results = (result for start in range(0, len(blocks), window) for result in pool.starmap(synthetic_block, blocks[start:start+window]))
+            synthetic_write(compiled, out_name, output, respondents, choice_prefix, results)
+
+def synthetic_write(compiled, out_name, output, respondents, choice_prefix, results):
+    if output == "csv":
+        with open(out_name, "w", encoding="utf-8", newline="") as out_file:
+            writer = csv.writer(out_file)
+            writer.writerow(synthetic_header(compiled, choice_prefix))
+            for rows in results:
+                writer.writerows(rows)
+        return
+    meta = {"attributes": list(compiled.attributes), "levels": [list(levels) for levels in compiled.levels],
+            "tasks": compiled.tasks, "profiles": compiled.profiles, "source": "synthetic", "respondents": respondents}
+    writer = columnWriter(out_name, long_columns(len(compiled.attributes)), meta)
+    try:
+        for chunk in results:
+            writer.append(chunk)
+    finally:
+        writer.close()
+    with open(os.path.join(out_name, "respondents.txt"), "w", encoding="utf-8") as respondent_file:
+        for r in range(respondents):
+            respondent_file.write("R_" + str(r + 1) + "\n")
+
+# -- Efficient fixed designs --
+# A design set is a list of versions; a version is a list of tasks, a task a list of profiles and a profile
+# a list of level codes in design attribute order. Each respondent is shown one version.
+# Design sets are scored by the information matrix of the main effects in a conditional logit model at zero
+# utilities, M = sum over tasks of (1/N) sum over profiles of (x - task mean)(x - task mean)', where x is
+# the dummy coding of the profile with the first level of each attribute as baseline (D-efficiency).
+# columns[j][k] is the column of level k of attribute j (-1 for the baseline)
+def main_effect_columns(compiled):
+    columns = []
+    p = 0
+    for levels in compiled.levels:
+        table = [-1, -1]
+        for k in range(2, len(levels) + 1):
+            table.append(p)
+            p = p + 1
+        columns.append(table)
+    return columns, p
+
+# Rows x - task mean of a task, as sparse dictionaries
+def centered_rows(task, columns):
+    mean = {}
+    for profile in task:
+        for j in range(len(profile)):
+            col = columns[j][profile[j]]
+            if col >= 0:
+                mean[col] = mean.get(col, 0.0) + 1.0/len(task)
+    rows = []
+    for profile in task:
+        row = {col: -value for col, value in mean.items()}
+        for j in range(len(profile)):
+            col = columns[j][profile[j]]
+            if col >= 0:
+                row[col] = row[col] + 1.0
+        rows.append(row)
+    return rows
+
+def design_information(design_set, columns, p):
+    info = [[0.0]*p for a in range(p)]
+    for version in design_set:
+        for task in version:
+            for row in centered_rows(task, columns):
+                for a, va in row.items():
+                    for b, vb in row.items():
+                        info[a][b] = info[a][b] + va*vb/len(task)
+    return info
+
+def log_determinant(matrix):
+    p = len(matrix)
+    factor = [[0.0]*p for a in range(p)]
+    total = 0.0
+    for k in range(p):
+        for i in range(k, p):
+            value = matrix[i][k] - sum(factor[i][b]*factor[k][b] for b in range(k))
+            if i == k:
+                if value <= 1e-12:
+                    return None
+                factor[k][k] = math.sqrt(value)
+                total = total + math.log(value)
+            else:
+                factor[i][k] = value/factor[k][k]
+    return total
+
+def profile_allowed(compiled, task, i, profile):
+    if any(all(profile[j] == k for j, k in restriction) for restriction in compiled.restrictions):
+        return False
+    if compiled.no_duplicates == 1:
+        return all(tuple(task[i2]) != tuple(profile) for i2 in range(len(task)) if i2 != i)
+    return True
+
+# Coordinate exchange from one random start: visit every attribute of every profile in turn and move it to the
+# allowed level (no restriction broken, nonzero weight) that most increases det(M), until a full pass makes no
+# change. Changing one level of profile i is the rank-2 update M + U S U' with U = [c, delta], c the centered
+# row of profile i and delta the change in its coding, S = (1/N)[[0, 1], [1, 1 - 1/N]], so each candidate's
+# determinant ratio det(I + S U' M^-1 U) needs only a few entries of M^-1, and M^-1 is updated by the
+# Woodbury identity when a move is made.
+def coordinate_exchange(compiled, versions, rng, max_passes=20):
+    columns, p = main_effect_columns(compiled)
+    generator = profileGenerator(compiled)
+    weights = sampling_weights(compiled)
+    allowed = [[k for k in range(1, len(levels) + 1) if weights[j][k-1] > 0] for j, levels in enumerate(compiled.levels)]
+    N = compiled.profiles
+    gamma = 1.0 - 1.0/N
+
+    for attempt in range(10):
+        design_set = [[[list(profile) for profile in generator.task(rng)] for t in range(compiled.tasks)] for v in range(versions)]
+        info = design_information(design_set, columns, p)
+        log_det = log_determinant(info)
+        if log_det != None:
+            break
+    else:
+        raise ValueError("The main effects cannot all be estimated: add versions or tasks")
+
+    for sweep in range(max_passes):
+        inverse = sweep_inverse(info)[0]
+        moved = False
+        for version in design_set:
+            for task in version:
+                for i in range(N):
+                    for j in range(len(compiled.attributes)):
+                        if len(allowed[j]) < 2:
+                            continue
+                        c = centered_rows(task, columns)[i]
+                        a = sum(cx*cy*inverse[x][y] for x, cx in c.items() for y, cy in c.items())
+                        old = columns[j][task[i][j]]
+                        best = None
+                        best_ratio = 1.0 + 1e-9
+                        for k in allowed[j]:
+                            new = columns[j][k]
+                            if k == task[i][j]:
+                                continue
+                            b = 0.0
+                            d = 0.0
+                            if new >= 0:
+                                b = b + sum(cx*inverse[x][new] for x, cx in c.items())
+                                d = d + inverse[new][new]
+                            if old >= 0:
+                                b = b - sum(cx*inverse[x][old] for x, cx in c.items())
+                                d = d + inverse[old][old]
+                            if new >= 0 and old >= 0:
+                                d = d - 2*inverse[new][old]
+                            ratio = (1 + b/N)*(1 + (b + gamma*d)/N) - d*(a + gamma*b)/(N*N)
+                            if ratio > best_ratio:
+                                profile = list(task[i])
+                                profile[j] = k
+                                if profile_allowed(compiled, task, i, profile):
+                                    best = (k, new, a, b, d)
+                                    best_ratio = ratio
+                        if best == None:
+                            continue
+                        k, new, a, b, d = best
+                        # Woodbury update of M^-1 with K = S^-1 + U' M^-1 U
+                        Ac = [sum(inverse[r][x]*cx for x, cx in c.items()) for r in range(p)]
+                        Ad = [(inverse[r][new] if new >= 0 else 0.0) - (inverse[r][old] if old >= 0 else 0.0) for r in range(p)]
+                        k11, k12, k22 = a - gamma*N, b + N, d
+                        det = k11*k22 - k12*k12
+                        i11, i12, i22 = k22/det, -k12/det, k11/det
+                        for r in range(p):
+                            u = Ac[r]*i11 + Ad[r]*i12
+                            v = Ac[r]*i12 + Ad[r]*i22
+                            row = inverse[r]
+                            for s in range(p):
+                                row[s] = row[s] - u*Ac[s] - v*Ad[s]
+                        task[i][j] = k
+                        log_det = log_det + math.log(best_ratio)
+                        moved = True
+        info = design_information(design_set, columns, p)
+        log_det = log_determinant(info)
+        if not moved:
+            break
+    return log_det, design_set
+
+def efficient_start(compiled, versions, seed, start, max_passes):
+    rng = random.Random(str(seed) + "-" + str(start))
+    return coordinate_exchange(compiled, versions, rng, max_passes)
+
+# Search for a D-efficient design set with coordinate exchange from several random starts, run on a pool of
+# processes (processes=1 runs them in this process). Returns the best design set with its log det(M) and its
+# D-error det(M/(versions*tasks))^(-1/p).
+def efficient_design(design, versions=100, starts=4, seed=0, processes=None, max_passes=20):
+    compiled = compiledDesign(design)
+    columns, p = main_effect_columns(compiled)
+    if p == 0:
+        raise ValueError("The design has no attribute with more than one level")
+    jobs = [(compiled, versions, seed, start, max_passes) for start in range(starts)]
+    if processes == 1:
+        runs = list(itertools.starmap(efficient_start, jobs))
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            runs = pool.starmap(efficient_start, jobs)
+    best = max(range(len(runs)), key=lambda r: runs[r][0])
+    log_det, design_set = runs[best]
+    return {"versions": design_set, "log_det": log_det, "d_error": math.exp(-(log_det - p*math.log(versions*compiled.tasks))/p),
+            "start": best, "log_dets": [run[0] for run in runs]}
+
+# Design sets are saved as .json with the attribute and level names they refer to
+def write_design_set(filename, compiled, design_set):
+    with open(filename, "w", encoding="utf-8") as out_file:
+        json.dump({"attributes": list(compiled.attributes), "levels": [list(levels) for levels in compiled.levels], "versions": design_set}, out_file)
+
+def read_design_set(filename, compiled):
+    with open(filename, encoding="utf-8") as in_file:
+        table = json.load(in_file)
+    if table["attributes"] != list(compiled.attributes) or table["levels"] != [list(levels) for levels in compiled.levels]:
+        raise ValueError(filename + " was made for a different set of attributes and levels")
+    return table["versions"]
+
+# -- Design pool curation --
+# Chooses size versions out of a pool of candidate versions so that the level frequencies of every attribute
+# and the level pair frequencies of every two attributes come as close as possible to what the design's
+# randomizer would produce on average (expected_level_probabilities). The distance is the chi-square sum
+# of (count - target)^2/target over all level and pair cells.
+# Each candidate is summarized once as the list of cells its profiles add to; a swap of a selected version
+# for an unselected one only touches the cells of those two versions, so it is scored and applied in time
+# proportional to the size of a version, not of the pool.
+def balance_cell_offsets(compiled):
+    offsets = level_offsets(compiled)
+    pair_offsets = {}
+    total = offsets[-1]
+    for j in range(len(compiled.attributes)):
+        for j2 in range(j + 1, len(compiled.attributes)):
+            pair_offsets[(j, j2)] = total
+            total = total + len(compiled.levels[j])*len(compiled.levels[j2])
+    return offsets, pair_offsets, total
+
+def version_cells(compiled, version, offsets, pair_offsets):
+    pairs = [(j, j2, pair_offsets[(j, j2)] - len(compiled.levels[j2]) - 1, len(compiled.levels[j2])) for j, j2 in pair_offsets]
+    cells = collections.Counter()
+    for task in version:
+        for profile in task:
+            cells.update([offsets[j] + profile[j] - 1 for j in range(len(profile))])
+            cells.update([base + profile[j]*size + profile[j2] for j, j2, base, size in pairs])
+    return list(cells.items())
+
+def random_versions(compiled, count, rng):
+    generator = profileGenerator(compiled)
+    return [[[list(profile) for profile in generator.task(rng)] for t in range(compiled.tasks)] for v in range(count)]
+
+def curate_design_pool(design, candidates, size, iterations=None, seed=0):
+    compiled = compiledDesign(design)
+    if size > len(candidates):
+        raise ValueError("The pool has only " + str(len(candidates)) + " candidate versions")
+    offsets, pair_offsets, num_cells = balance_cell_offsets(compiled)
+    marginal, joint = expected_level_probabilities(compiled)
+    prob = [p for probs in marginal for p in probs]
+    for pair in sorted(pair_offsets, key=pair_offsets.get):
+        prob.extend(joint[pair])
+    profiles = sum(len(task) for version in candidates[:1] for task in version)
+    target = [p*size*profiles for p in prob]
+    weight = [1.0/t if t > 0 else 1.0 for t in target]
+    cells = [version_cells(compiled, version, offsets, pair_offsets) for version in candidates]
+
+    rng = random.Random(seed)
+    order = list(range(len(candidates)))
+    rng.shuffle(order)
+    selected = order[:size]
+    rest = order[size:]
+    counts = [0]*num_cells
+    for v in selected:
+        for cell, count in cells[v]:
+            counts[cell] = counts[cell] + count
+    def objective():
+        return sum(w*(c - t)**2 for w, c, t in zip(weight, counts, target))
+    start = objective()
+    # gradient[c] = 2*weight*(count - target), so a change of d in cell c changes the objective by d*(gradient + weight*d)
+    gradient = [2*w*(c - t) for w, c, t in zip(weight, counts, target)]
+
+    if iterations == None:
+        iterations = 20*size
+    swaps = 0
+    for it in range(iterations if len(rest) > 0 else 0):
+        a = rng.randrange(size)
+        b = rng.randrange(len(rest))
+        delta = {}
+        for cell, count in cells[selected[a]]:
+            delta[cell] = delta.get(cell, 0) - count
+        for cell, count in cells[rest[b]]:
+            delta[cell] = delta.get(cell, 0) + count
+        change = sum(d*(gradient[cell] + weight[cell]*d) for cell, d in delta.items())
+        if change < -1e-9:
+            for cell, d in delta.items():
+                counts[cell] = counts[cell] + d
+                gradient[cell] = 2*weight[cell]*(counts[cell] - target[cell])
+            selected[a], rest[b] = rest[b], selected[a]
+            swaps = swaps + 1
+
+    total = size*profiles
+    deviation = [abs(counts[c]/total - prob[c]) for c in range(num_cells)]
+    summary = {"objective_before": start, "objective": objective(), "swaps": swaps,
+               "max_level_deviation": max(deviation[:offsets[-1]]), "max_pair_deviation": max(deviation[offsets[-1]:], default=0.0)}
+    return [candidates[v] for v in selected], summary
+
+# -- Design set exports --
+# Randomizers that show each respondent one version of a fixed design set, drawn at random, with the same
+# F- embedded data fields as qualtrics_out and qualtrics_out_js (and F-version, the version number).
+# Attribute order randomization and order constraints work as in the other exports.
+def php_quote(text):
+    return "'" + text.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+def php_list(items):
+    return "array(" + ",".join(items) + ")"
+
+def design_table_settings(compiled):
+    constraints = [[compiled.attributes[j] for j in constraint] for constraint in compiled.constraints if len(constraint) > 1]
+    return constraints, (compiled.randomize if compiled.randomize == 1 else 0)
+
+table_php_template = """
+// Attribute order: shuffle the attributes that do not follow another one in an order constraint,
+// then insert each constraint's other attributes right after its first
+$featureArrayKeys = array_keys($featurearray);
+$attributeindex = array_flip($featureArrayKeys);
+if ($randomize == 1){
+	$tails = array();
+	foreach ($attrconstraintarray as $constraints){
+		$tails = array_merge($tails, array_slice($constraints, 1));
+	}
+	$free = array_values(array_diff($featureArrayKeys, $tails));
+	shuffle($free);
+	$featureArrayKeys = array();
+	foreach ($free as $attribute){
+		array_push($featureArrayKeys, $attribute);
+		foreach ($attrconstraintarray as $constraints){
+			if ($constraints[0] == $attribute){
+				$featureArrayKeys = array_merge($featureArrayKeys, array_slice($constraints, 1));
+			}
+		}
+	}
+}
+
+// Draw the version shown to this respondent
+$version = mt_rand(0, count($designarray) - 1);
+
+$returnarray = array();
+$returnarray["F-version"] = $version + 1;
+for($p = 1; $p <= $K; $p++){
+	for($i = 1; $i <= $N; $i++){
+		for($a = 1; $a <= count($featureArrayKeys); $a++){
+			$attribute = $featureArrayKeys[$a-1];
+			$returnarray["F-" . (string)$p . "-" . (string)$a] = $attribute;
+			$level_index = $designarray[$version][$p-1][$i-1][$attributeindex[$attribute]];
+			$returnarray["F-" . (string)$p . "-" . (string)$i . "-" . (string)$a] = $featurearray[$attribute][$level_index];
+		}
+	}
+}
+
+// Return the array back to Qualtrics
+print  json_encode($returnarray);
+?>
+"""
+
+def design_table_php(filename, compiled, design_set):
+    constraints, randomize = design_table_settings(compiled)
+    with open(filename, "w", encoding="utf-8") as out_file:
+        out_file.write("<?php\n// Code to show conjoint profiles from a fixed design set in a Qualtrics survey\n")
+        out_file.write("// $designarray[version][task][profile][attribute] holds level indices, attributes in $featurearray order\n\n")
+        out_file.write("$featurearray = " + php_list([php_quote(attr) + " => " + php_list([php_quote(level) for level in levels]) for attr, levels in zip(compiled.attributes, compiled.levels)]) + ";\n\n")
+        out_file.write("$designarray = " + php_list([php_list([php_list([php_list([str(k - 1) for k in profile]) for profile in task]) for task in version]) for version in design_set]) + ";\n\n")
+        out_file.write("// K = Number of tasks displayed to the respondent\n$K = " + str(compiled.tasks) + ";\n\n")
+        out_file.write("// N = Number of profiles displayed in each task\n$N = " + str(compiled.profiles) + ";\n\n")
+        out_file.write("$randomize = " + str(randomize) + ";\n\n")
+        out_file.write("$attrconstraintarray = " + php_list([php_list([php_quote(attr) for attr in constraint]) for constraint in constraints]) + ";\n")
+        template = table_php_template
+        if compiled.order_once == 1:
+            template = replace_template(template, '$returnarray["F-" . (string)$p . "-" . (string)$a] = $attribute;', '$returnarray["F-order-" . (string)$a] = $attribute;')
+        out_file.write(template)
+
+table_js_template = """
+// Attribute order: shuffle the attributes that do not follow another one in an order constraint,
+// then insert each constraint's other attributes right after its first
+var featureArrayKeys = Object.keys(featurearray);
+var attributeindex = {};
+for (var a = 0; a < featureArrayKeys.length; a++){
+	attributeindex[featureArrayKeys[a]] = a;
+}
+if (randomize == 1){
+	var tails = [];
+	for (const constraints of attrconstraintarray){
+		tails = tails.concat(constraints.slice(1));
+	}
+	var free = featureArrayKeys.filter(function(attribute){ return !tails.includes(attribute); });
+	for (var f = free.length - 1; f > 0; f--){
+		var g = Math.floor(Math.random() * (f + 1));
+		var temp = free[f];
+		free[f] = free[g];
+		free[g] = temp;
+	}
+	featureArrayKeys = [];
+	for (const attribute of free){
+		featureArrayKeys.push(attribute);
+		for (const constraints of attrconstraintarray){
+			if (constraints[0] == attribute){
+				featureArrayKeys = featureArrayKeys.concat(constraints.slice(1));
+			}
+		}
+	}
+}
+
+// Draw the version shown to this respondent
+var version = Math.floor(Math.random() * designarray.length);
+
+var returnarray = {};
+returnarray["F-version"] = version + 1;
+for (var p = 1; p <= K; p++){
+	for (var i = 1; i <= N; i++){
+		for (var a = 1; a <= featureArrayKeys.length; a++){
+			var attribute = featureArrayKeys[a-1];
+			returnarray["F-" + p + "-" + a] = attribute;
+			var level_index = designarray[version][p-1][i-1][attributeindex[attribute]];
+			returnarray["F-" + p + "-" + i + "-" + a] = featurearray[attribute][level_index];
+		}
+	}
+}
+
+// Write returnarray to Qualtrics
+var returnarrayKeys = Object.keys(returnarray);
+for (var pr = 0; pr < returnarrayKeys.length; pr++){
+	Qualtrics.SurveyEngine.setEmbeddedData(returnarrayKeys[pr], returnarray[returnarrayKeys[pr]]);
+}
+"""
+
+def design_table_js(filename, compiled, design_set):
+    constraints, randomize = design_table_settings(compiled)
+    features = "{" + ",".join(json.dumps(attr, ensure_ascii=False) + " : " + json.dumps(list(levels), ensure_ascii=False) for attr, levels in zip(compiled.attributes, compiled.levels)) + "}"
+    with open(filename, "w", encoding="utf-8") as out_file:
+        out_file.write("// Code to show conjoint profiles from a fixed design set in a Qualtrics survey\n")
+        out_file.write("// designarray[version][task][profile][attribute] holds level indices, attributes in featurearray order\n\n")
+        out_file.write("var featurearray = " + features + ";\n\n")
+        out_file.write("var designarray = " + json.dumps([[[[k - 1 for k in profile] for profile in task] for task in version] for version in design_set], separators=(",", ":")) + ";\n\n")
+        out_file.write("// K = Number of tasks displayed to the respondent\nvar K = " + str(compiled.tasks) + ";\n\n")
+        out_file.write("// N = Number of profiles displayed in each task\nvar N = " + str(compiled.profiles) + ";\n\n")
+        out_file.write("var randomize = " + str(randomize) + ";\n\n")
+        out_file.write("var attrconstraintarray = " + json.dumps(constraints, ensure_ascii=False) + ";\n")
+        template = table_js_template
+        if compiled.order_once == 1:
+            template = replace_template(template, 'returnarray["F-" + p + "-" + a] = attribute;', 'returnarray["F-order-" + a] = attribute;')
+        out_file.write(template)
+
+def write_design_table(filename, compiled, design_set):
+    if filename.endswith(".php"):
+        design_table_php(filename, compiled, design_set)
+    elif filename.endswith(".js"):
+        design_table_js(filename, compiled, design_set)
+    else:
+        write_design_set(filename, compiled, design_set)
+
+# -- Randomizer service --
+# Serves respondent designs over HTTP:
+#   GET /                     names of the loaded designs
+#   GET /<design>             one respondent's embedded data as JSON, as printed by the PHP export
+#   GET /<design>?seed=<text> the same, drawn from a random stream seeded with the text (replays exactly)
+# Designs are compiled once when the service starts, and a design that cannot fill a task raises ValueError
+# then rather than stalling every connection later. Connections are kept alive between requests.
+class randomizerService:
+
+    def __init__(self, designs):
+        self.designs = {}
+        for name, design in designs.items():
+            try:
+                self.designs[name] = profileGenerator(compiledDesign(design))
+            except ValueError as error:
+                raise ValueError(name + ": " + str(error))
+        self.rng = random.Random()
+        self.index = json.dumps(sorted(self.designs)).encode("utf-8")
+
+    def respond(self, target):
+        path, question, query = target.partition("?")
+        name = urllib.parse.unquote(path.strip("/"))
+        if name == "":
+            return 200, self.index
+        if name not in self.designs:
+            return 404, json.dumps({"error": "Unknown design " + name}).encode("utf-8")
+        generator = self.designs[name]
+        params = urllib.parse.parse_qs(query)
+        rng = generator.new_stream(params["seed"][0]) if "seed" in params else self.rng
+        order, tasks = generator.respondent(rng)
+        return 200, json.dumps(generator.embedded_data(order, tasks)).encode("utf-8")
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request = await reader.readline()
+                if not request:
+                    break
+                parts = request.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, colon, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                # A request body is read and ignored; a length that is not a count gets a 400 and closes the connection
+                try:
+                    length = int(headers.get("content-length", "0"))
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    parts = []
+                elif length > 0:
+                    await reader.readexactly(length)
+                if len(parts) != 3:
+                    status, body = 400, b'{"error": "Bad request"}'
+                elif parts[0] != "GET":
+                    status, body = 405, b'{"error": "Only GET is supported"}'
+                else:
+                    status, body = self.respond(parts[1])
+                keep_alive = len(parts) == 3 and parts[2] == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                writer.write(("HTTP/1.1 " + str(status) + " " + http.HTTPStatus(status).phrase + "\r\n"
+                              "Content-Type: application/json\r\nContent-Length: " + str(len(body)) + "\r\n"
+                              "Connection: " + ("keep-alive" if keep_alive else "close") + "\r\n\r\n").encode("latin-1") + body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            print("Serving " + ", ".join(sorted(self.designs)) + " on http://" + host + ":" + str(port) + "/")
+            await server.serve_forever()
+
+def serve_randomizer(design_files, host="127.0.0.1", port=8000):
+    designs = {}
+    for filename in design_files:
+        designs[os.path.splitext(os.path.basename(filename))[0]] = read_design(filename)
+    try:
+        asyncio.run(randomizerService(designs).serve(host, port))
+    except KeyboardInterrupt:
+        pass
+
+# -- Load testing --
+# Sends the given number of GET requests to url over concurrency kept-alive connections and reports the request rate and
+# latency percentiles (in milliseconds)
+async def load_test_connection(host, port, target, count, latencies, errors):
+    reader, writer = await asyncio.open_connection(host, port)
+    request = ("GET " + target + " HTTP/1.1\r\nHost: " + host + "\r\n\r\n").encode("latin-1")
+    try:
+        for n in range(count):
+            start = time.perf_counter()
+            writer.write(request)
+            await writer.drain()
+            status = (await reader.readline()).split()
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                if line.lower().startswith(b"content-length:"):
+                    length = int(line.split(b":")[1])
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start)
+            if len(status) < 2 or status[1] != b"200":
+                errors.append(status)
+    finally:
+        writer.close()
+
+async def run_load_test(url, requests, concurrency):
+    parts = urllib.parse.urlsplit(url)
+    target = parts.path or "/"
+    if parts.query:
+        target = target + "?" + parts.query
+    latencies = []
+    errors = []
+    counts = [requests//concurrency + (1 if c < requests % concurrency else 0) for c in range(concurrency)]
+    start = time.perf_counter()
+    await asyncio.gather(*[load_test_connection(parts.hostname, parts.port or 80, target, count, latencies, errors) for count in counts if count > 0])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {"requests": len(latencies), "errors": len(errors), "seconds": elapsed, "requests_per_second": len(latencies)/elapsed,
+            "mean_ms": 1000*sum(latencies)/len(latencies), "p50_ms": 1000*percentile(latencies, 0.5), "p99_ms": 1000*percentile(latencies, 0.99)}
+
+def load_test(url, requests=10000, concurrency=50):
+    return asyncio.run(run_load_test(url, requests, concurrency))
+
+# -- Command line --
+# python conjointSDT.py                 opens the design tool
+# python conjointSDT.py <command> ...   runs one of the analysis tools (see --help)
+def command_line(argv):
+    parser = argparse.ArgumentParser(prog="conjointSDT.py", description="Conjoint Survey Design Tool - command line tools")
+    commands = parser.add_subparsers(dest="command")
+
+    ingest = commands.add_parser("ingest", help="Convert a Qualtrics response export to long-format conjoint data")
+    ingest.add_argument("design", help="Design file (.sdt)")
+    ingest.add_argument("responses", help="Qualtrics response export (.csv)")
+    ingest.add_argument("out_dir", help="Output directory for the column store")
+    ingest.add_argument("--choices", nargs="*", default=None, help="Choice question column for each task, in task order")
+    ingest.add_argument("--id-column", default="ResponseId", help="Respondent id column (default ResponseId)")
+    ingest.add_argument("--chunk-rows", type=int, default=50000, help="Rows held in memory before writing (default 50000)")
+
+    amce = commands.add_parser("amce", help="Estimate AMCEs with respondent-clustered standard errors")
+    amce.add_argument("design", help="Design file (.sdt)")
+    amce.add_argument("data", help="Column store written by ingest")
+    amce.add_argument("--out", default=None, help="Write the estimates to this .csv file")
+    amce.add_argument("--baseline", nargs=2, action="append", metavar=("ATTRIBUTE", "LEVEL"), default=[], help="Baseline level for an attribute (can be repeated)")
+
+    means = commands.add_parser("mm", help="Marginal means by level and level pair, and interaction effects (ACIEs)")
+    means.add_argument("design", help="Design file (.sdt)")
+    means.add_argument("data", help="Column store written by ingest")
+    means.add_argument("--out", default=None, help="Write the estimates to this .csv file")
+    means.add_argument("--baseline", nargs=2, action="append", metavar=("ATTRIBUTE", "LEVEL"), default=[], help="Baseline level for an attribute (can be repeated)")
+
+    boot = commands.add_parser("bootstrap", help="Respondent bootstrap of AMCEs and marginal means")
+    boot.add_argument("design", help="Design file (.sdt)")
+    boot.add_argument("data", help="Column store written by ingest")
+    boot.add_argument("--replicates", type=int, default=1000, help="Number of bootstrap replicates (default 1000)")
+    boot.add_argument("--processes", type=int, default=None, help="Number of worker processes (default: one per CPU)")
+    boot.add_argument("--seed", type=int, default=0, help="Random seed (default 0)")
+    boot.add_argument("--level", type=float, default=0.95, help="Confidence level (default 0.95)")
+    boot.add_argument("--out", default=None, help="Write the estimates to this .csv file")
+    boot.add_argument("--baseline", nargs=2, action="append", metavar=("ATTRIBUTE", "LEVEL"), default=[], help="Baseline level for an attribute (can be repeated)")
+
+    balance = commands.add_parser("balance", help="Check level, pair and position frequencies against the design")
+    balance.add_argument("design", help="Design file (.sdt)")
+    balance.add_argument("data", help="Column store written by ingest")
+    balance.add_argument("--alpha", type=float, default=0.01, help="Flag tables with a chi-square p-value below this (default 0.01)")
+    balance.add_argument("--out", default=None, help="Write all tests to this .csv file")
+
+    synthetic = commands.add_parser("synthetic", help="Generate synthetic responses for a design")
+    synthetic.add_argument("design", help="Design file (.sdt)")
+    synthetic.add_argument("out", help="Output .csv file, or directory for --format long")
+    synthetic.add_argument("respondents", type=int, help="Number of respondents")
+    synthetic.add_argument("--format", choices=("csv", "long"), default="csv", help="Qualtrics-style .csv export (default) or long-format column store")
+    synthetic.add_argument("--utilities", default=None, help=".json file of part-worth utilities {attribute: {level: utility}}")
+    synthetic.add_argument("--seed", type=int, default=0, help="Random seed (default 0)")
+    synthetic.add_argument("--processes", type=int, default=None, help="Number of worker processes (default: one per CPU)")
+    synthetic.add_argument("--block-size", type=int, default=1000, help="Respondents generated per block (default 1000)")
+    synthetic.add_argument("--choice-prefix", default="C", help="Choice columns are named prefix + task number (default C)")
+
+    efficient = commands.add_parser("efficient", help="Search for a D-efficient fixed design set")
+    efficient.add_argument("design", help="Design file (.sdt)")
+    efficient.add_argument("out", help="Output file: .php or .js randomizer, or .json design set")
+    efficient.add_argument("--versions", type=int, default=100, help="Number of versions in the design set (default 100)")
+    efficient.add_argument("--starts", type=int, default=4, help="Number of random starts (default 4)")
+    efficient.add_argument("--seed", type=int, default=0, help="Random seed (default 0)")
+    efficient.add_argument("--processes", type=int, default=None, help="Number of worker processes (default: one per CPU)")
+    efficient.add_argument("--passes", type=int, default=20, help="Maximum coordinate exchange passes per start (default 20)")
+
+    curate = commands.add_parser("curate", help="Pick a balanced design set from a pool of candidate versions")
+    curate.add_argument("design", help="Design file (.sdt)")
+    curate.add_argument("out", help="Output file: .php or .js randomizer, or .json design set")
+    curate.add_argument("--size", type=int, default=1000, help="Number of versions to keep (default 1000)")
+    curate.add_argument("--pool", default=None, help=".json design set to choose from (default: draw random candidates)")
+    curate.add_argument("--candidates", type=int, default=10000, help="Number of random candidates to draw without --pool (default 10000)")
+    curate.add_argument("--iterations", type=int, default=None, help="Number of swaps tried (default 20 per kept version)")
+    curate.add_argument("--seed", type=int, default=0, help="Random seed (default 0)")
+
+    serve = commands.add_parser("serve", help="Serve respondent designs over HTTP")
+    serve.add_argument("designs", nargs="+", help="Design files (.sdt); each is served at /<file name without .sdt>")
+    serve.add_argument("--host", default="127.0.0.1", help="Address to listen on (default 127.0.0.1)")
+    serve.add_argument("--port", type=int, default=8000, help="Port to listen on (default 8000)")
+
+    loadtest = commands.add_parser("loadtest", help="Measure the request rate and latency of a randomizer service")
+    loadtest.add_argument("url", help="URL to request, e.g. http://127.0.0.1:8000/design")
+    loadtest.add_argument("--requests", type=int, default=10000, help="Total number of requests (default 10000)")
+    loadtest.add_argument("--concurrency", type=int, default=50, help="Number of simultaneous connections (default 50)")
+
+    count = commands.add_parser("count", help="Count the distinct profiles a design allows")
+    count.add_argument("design", help="Design file (.sdt)")
+
+    export = commands.add_parser("export", help="Export a design as a PHP, JavaScript or R randomizer")
+    export.add_argument("design", help="Design file (.sdt)")
+    export.add_argument("out", help="Output file: .php, .js or .R (other extensions export for R)")
+    export.add_argument("--no-cache", action="store_true", help="Always generate the export instead of using the cache")
+    export.add_argument("--telemetry", action="store_true", help="Record generation time and retries in the PHP or JavaScript randomizer")
+    export.add_argument("--lazy", action="store_true", help="JavaScript: generate each task on the page before it instead of all tasks at once")
+    export.add_argument("--order-once", action="store_true", help="Store the attribute order once per respondent (F-order-[attribute number]) instead of once per task")
+    export.add_argument("--no-session-cache", action="store_true", help="JavaScript: generate new profiles when a page is reloaded")
+    export.add_argument("--retry-budget", type=int, default=None, help="Draws per profile before the randomizer uses the precomputed allowed profiles (default: the design's setting)")
+    export.add_argument("--no-fallback", action="store_true", help="Leave out the precomputed allowed profiles; profiles past the retry budget are counted in F-fallback-failed")
+    export.add_argument("--fit-marginals", action="store_true", help="Write weights fitted so the level shares after restrictions match the design weights")
+
+    fit = commands.add_parser("fit", help="Fit the weights so the level shares after restrictions match the design weights")
+    fit.add_argument("design", help="Design file (.sdt)")
+    fit.add_argument("--tol", type=float, default=1e-9, help="Largest difference allowed between a level share and its target (default 1e-9)")
+    fit.add_argument("--max-iter", type=int, default=1000, help="Maximum number of sweeps (default 1000)")
+    fit.add_argument("--max-exact", type=int, default=100000, help="Fit groups of attributes with more allowed combinations than this on a sample (default 100000)")
+    fit.add_argument("--samples", type=int, default=20000, help="Size of the sample of allowed combinations (default 20000)")
+    fit.add_argument("--out", default=None, help="Write the fitted weights and level shares to this .csv file")
+
+    telemetry = commands.add_parser("telemetry", help="Summarize the randomizer telemetry in a Qualtrics response export")
+    telemetry.add_argument("responses", help="Qualtrics response export (.csv)")
+    telemetry.add_argument("--out", default=None, help="Write the summary to this .csv file")
+
+    enumerate_parser = commands.add_parser("enumerate", help="Write every profile the restrictions allow to a memory-mappable file")
+    enumerate_parser.add_argument("design", help="Design file (.sdt)")
+    enumerate_parser.add_argument("out_dir", help="Output directory")
+    enumerate_parser.add_argument("--processes", type=int, default=None, help="Number of worker processes (default: one per CPU)")
+    enumerate_parser.add_argument("--max-gb", type=float, default=16, help="Refuse to write more than this many gigabytes (default 16)")
+
+    args = parser.parse_args(argv)
+    if args.command == "ingest":
+        summary = ingest_qualtrics(args.responses, read_design(args.design), args.out_dir, args.choices, args.id_column, args.chunk_rows)
+        for key in summary:
+            print(key + ": " + str(summary[key]))
+    elif args.command == "amce":
+        results, info = estimate_amce(args.data, read_design(args.design), dict(args.baseline))
+        print("rows: " + str(info["rows"]) + ", respondents: " + str(info["respondents"]))
+        print_results(results)
+        if args.out != None:
+            write_results_csv(args.out, results)
+    elif args.command == "mm":
+        results = estimate_marginal_means(args.data, read_design(args.design), dict(args.baseline))
+        print_results(results, ("quantity", "attribute", "level", "attribute2", "level2", "estimate", "std_error"))
+        if args.out != None:
+            write_results_csv(args.out, results)
+    elif args.command == "balance":
+        results = balance_diagnostics(args.data, read_design(args.design), args.alpha)
+        flagged = [result for result in results if result["flagged"]]
+        print(str(len(results)) + " tables checked, " + str(len(flagged)) + " flagged")
+        print_results(flagged, ("table", "attribute", "attribute2", "statistic", "df", "p_value", "impossible"))
+        if args.out != None:
+            write_results_csv(args.out, results)
+    elif args.command == "synthetic":
+        try:
+            generate_responses(read_design(args.design), args.out, args.respondents, args.format, args.utilities, args.seed, args.processes, args.block_size, args.choice_prefix)
+        except ValueError as error:
+            print("Error: " + str(error) + ".")
+            return 1
+    elif args.command == "efficient":
+        design = read_design(args.design)
+        result = efficient_design(design, args.versions, args.starts, args.seed, args.processes, args.passes)
+        print("D-error: " + str(result["d_error"]) + " (best of " + str(args.starts) + " starts)")
+        write_design_table(args.out, compiledDesign(design), result["versions"])
+    elif args.command == "curate":
+        design = read_design(args.design)
+        compiled = compiledDesign(design)
+        if args.pool != None:
+            candidates = read_design_set(args.pool, compiled)
+        else:
+            candidates = random_versions(compiled, args.candidates, random.Random(args.seed))
+        versions, summary = curate_design_pool(design, candidates, args.size, args.iterations, args.seed)
+        for key in summary:
+            print(key + ": " + str(summary[key]))
+        write_design_table(args.out, compiled, versions)
+    elif args.command == "serve":
+        try:
+            serve_randomizer(args.designs, args.host, args.port)
+        except ValueError as error:
+            print("Error: " + str(error) + ".")
+            return 1
+    elif args.command == "loadtest":
+        summary = load_test(args.url, args.requests, args.concurrency)
+        for key in summary:
+            print(key + ": " + str(summary[key]))
+    elif args.command == "export":
+        kind = {".php": "php", ".js": "js"}.get(os.path.splitext(args.out)[1].lower(), "R")
+        design = read_design(args.design)
+        if args.telemetry:
+            design["telemetry"] = 1
+        if args.lazy:
+            design["lazy_tasks"] = 1
+        if args.no_session_cache:
+            design["session_cache"] = 0
+        if args.order_once:
+            design["order_once"] = 1
+        if args.retry_budget != None:
+            design["retry_budget"] = args.retry_budget
+        if args.no_fallback:
+            design["fallback"] = 0
+        if args.fit_marginals:
+            design["fit_marginals"] = 1
+        if not export_design(kind, args.out, design, None if args.no_cache else artifactCache()):
+            return 1
+    elif args.command == "fit":
+        design = read_design(args.design)
+        if int(design["weighted"]) != 1:
+            print("Note: weighted randomization is off in this design, so the exports do not use the fitted weights")
+        design["weighted"] = 1
+        design["fit_marginals"] = 0
+        compiled = compiledDesign(design)
+        fit = fit_weights(compiled, args.tol, args.max_iter, args.max_exact, args.samples)
+        print(fit_summary(fit))
+        results = [{"attribute": compiled.attributes[j], "level": compiled.levels[j][k-1], "target": target, "share": before, "fitted_share": after,
+                    "fitted_weight": fit["weights"][j][k-1]} for j, k, target, before, after in fit["levels"]]
+        print_results(results, ("attribute", "level", "target", "share", "fitted_share", "fitted_weight"))
+        if args.out != None:
+            write_results_csv(args.out, results)
+        if not fit["converged"]:
+            return 1
+    elif args.command == "telemetry":
+        results = telemetry_report(args.responses)
+        print_results(results, list(results[0].keys()))
+        if args.out != None:
+            write_results_csv(args.out, results)
+    elif args.command == "count":
+        space = cached_design_space(read_design(args.design), artifactCache())
+        print("profiles without restrictions: " + str(space["profiles"]))
+        print("profiles allowed by the restrictions: " + str(space["feasible"]))
+        print("share of weighted draws allowed: " + str(float(space["acceptance"])))
+        for component in space["components"]:
+            print("  " + ", ".join(component["attributes"]) + ": " + str(component["feasible"]) + " of " + str(component["profiles"]))
+    elif args.command == "enumerate":
+        meta = enumerate_profiles(read_design(args.design), args.out_dir, args.processes, max_bytes=int(args.max_gb*2**30))
+        print(str(meta["rows"]) + " profiles written to " + os.path.join(args.out_dir, "profiles.bin"))
+    elif args.command == "bootstrap":
+        results = bootstrap_amce(args.data, read_design(args.design), args.replicates, args.processes, args.seed, dict(args.baseline), args.level)
+        print_results(results, ("quantity", "attribute", "level", "estimate", "std_error", "ci_lower", "ci_upper"))
+        if args.out != None:
+            write_results_csv(args.out, results)
+    else:
+        parser.print_help()
+    return 0
+
 # Main Loop
 if __name__=="__main__":
     
+    # Command line tools
+    if len(sys.argv) > 1:
+        sys.exit(command_line(sys.argv[1:]))
+    
     # Create the root window
     root = Tk()
     root.title('Conjoint Survey Design Tool')